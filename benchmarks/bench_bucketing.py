@@ -0,0 +1,64 @@
+# Padding efficiency and training step time with random vs length-bucketed batches.
+# Run from the repository root: python -m benchmarks.bench_bucketing --model_path /path/to/paligemma-3b-pt-224
+import time
+
+import fire
+import torch
+from datasets import load_dataset
+from transformers import PaliGemmaProcessor
+
+from benchmarks.common import print_table, synchronize
+from bucket_sampler import BucketSampler, compute_lengths, padding_efficiency
+from utils import load_hf_model
+
+
+def main(model_path: str, num_examples: int = 2000, batch_size: int = 4, num_steps: int = 20,
+         bucket_size_multiplier: int = 50, device: str = "cpu", seed: int = 0):
+    processor = PaliGemmaProcessor.from_pretrained(model_path)
+    model, _ = load_hf_model(model_path, device)
+    model.train()
+
+    dataset = load_dataset('HuggingFaceM4/VQAv2', split=f"train[:{num_examples}]")
+    lengths = compute_lengths(dataset, processor)
+
+    orders = {
+        "random": torch.randperm(len(lengths), generator=torch.Generator().manual_seed(seed)).tolist(),
+        "bucketed": list(BucketSampler(lengths, batch_size, bucket_size_multiplier, seed)),
+    }
+
+    rows = []
+    for name, order in orders.items():
+        step_times = []
+        for step in range(num_steps + 1):
+            batch = dataset.select(order[step * batch_size:(step + 1) * batch_size])
+            tokens = processor(
+                text=["answer " + question for question in batch["question"]],
+                images=[image.convert("RGB") for image in batch["image"]],
+                suffix=batch["multiple_choice_answer"],
+                return_tensors="pt", padding="longest",
+            )
+            tokens = {k: v.to(device) for k, v in tokens.items() if k != "token_type_ids"}
+
+            synchronize(device)
+            start = time.perf_counter()
+            loss = model(**tokens).loss
+            loss.backward()
+            synchronize(device)
+            # The first step is warmup
+            if step > 0:
+                step_times.append(time.perf_counter() - start)
+            model.zero_grad(set_to_none=True)
+
+        rows.append([
+            name,
+            f"{padding_efficiency(lengths, order, batch_size):.1%}",
+            f"{sum(step_times) / len(step_times):.3f}",
+        ])
+
+    print_table(["order", "padding efficiency", "step time (s)"], rows)
+    speedup = float(rows[0][2]) / float(rows[1][2])
+    print(f"Bucketing speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
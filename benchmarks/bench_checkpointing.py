@@ -0,0 +1,55 @@
+# Peak training memory vs step time for the activation checkpointing modes of GemmaModel and SiglipEncoder.
+# Run from the repository root: python -m benchmarks.bench_checkpointing
+import fire
+import torch
+from peft import LoraConfig, get_peft_model
+
+from benchmarks.common import build_model, dummy_batch, peak_memory_mb, print_table, time_fn
+
+# (mode, every)
+SETTINGS = [
+    (None, 1),
+    ("layer", 1),
+    ("layer", 2),
+    ("layer", 4),
+    ("attention", 1),
+    ("mlp", 1),
+]
+
+
+def main(batch_size: int = 4, text_len: int = 32, num_text_layers: int = None, num_vision_layers: int = None,
+         dtype: str = "float32", device: str = "cpu", iters: int = 3):
+    model = build_model(num_text_layers, num_vision_layers, dtype=getattr(torch, dtype), device=device)
+
+    # Same trainable parameters as finetune.setup: LoRA plus the differential attention params
+    model = get_peft_model(model, LoraConfig(
+        r=32, lora_alpha=64, lora_dropout=0.1,
+        target_modules=r".*language_model.*\.(q_proj|o_proj|k_proj|v_proj|gate_proj|up_proj|down_proj)",
+    ))
+    for name, param in model.named_parameters():
+        if any(keyword in name for keyword in ["lambda_q1", "lambda_k1", "lambda_q2", "lambda_k2", "subln"]):
+            param.requires_grad = True
+    model.train()
+
+    batch = dummy_batch(model.config, batch_size, text_len, device=device)
+
+    def step():
+        loss = model(**batch).loss
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    rows = []
+    for mode, every in SETTINGS:
+        model.base_model.model.set_gradient_checkpointing(mode, every)
+        # The first step also allocates the gradients, measure memory on a warm step
+        step()
+        memory = peak_memory_mb(step, device)
+        step_time = time_fn(step, device, warmup=0, iters=iters)
+        rows.append([str(mode), every, f"{memory:.0f}", f"{step_time:.3f}"])
+
+    print(f"batch_size={batch_size}, seq_len={model.config.num_image_tokens + text_len}, dtype={dtype}")
+    print_table(["mode", "every", "peak memory (MiB)", "step time (s)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
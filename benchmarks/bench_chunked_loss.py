@@ -0,0 +1,52 @@
+# Memory and time of the training loss: full logits + shifted copy + CrossEntropyLoss (what PaliGemmaForConditionalGeneration
+# does without loss_chunk_size) vs chunked_loss.chunked_causal_lm_loss, on the lm_head with the full 257k vocabulary.
+# Run from the repository root: python -m benchmarks.bench_chunked_loss
+import fire
+import torch
+from torch import nn
+
+from benchmarks.common import peak_memory_mb, print_table, time_fn
+from chunked_loss import chunked_causal_lm_loss
+
+
+def full_logits_loss(hidden_states, lm_head, labels):
+    logits = lm_head(hidden_states).float()
+    shift_logits = logits[..., :-1, :].contiguous()
+    shift_labels = labels[..., 1:].contiguous()
+    return nn.CrossEntropyLoss(ignore_index=-100)(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+
+
+def main(batch_size: int = 4, seq_len: int = 288, supervised_len: int = 8, vocab_size: int = 257216, hidden_size: int = 2048,
+         chunk_size: int = 1024, dtype: str = "float32", iters: int = 3):
+    torch.manual_seed(0)
+    # Tied to the frozen embeddings when finetuning with LoRA, so no weight gradient
+    lm_head = nn.Linear(hidden_size, vocab_size, bias=False).to(getattr(torch, dtype)).requires_grad_(False)
+    hidden_states = torch.randn(batch_size, seq_len, hidden_size, dtype=getattr(torch, dtype), requires_grad=True)
+    # Image tokens and the prompt are ignored, only the answer (the last supervised_len tokens) is supervised
+    labels = torch.randint(0, vocab_size, (batch_size, seq_len))
+    labels[:, :seq_len - supervised_len] = -100
+
+    losses = {
+        "full logits": lambda: full_logits_loss(hidden_states, lm_head, labels),
+        f"chunked ({chunk_size})": lambda: chunked_causal_lm_loss(hidden_states, lm_head.weight, labels, chunk_size=chunk_size),
+    }
+    values = {name: loss_fn().item() for name, loss_fn in losses.items()}
+    print("losses: " + ", ".join(f"{name} {value:.6f}" for name, value in values.items()))
+
+    rows = []
+    for name, loss_fn in losses.items():
+        def step():
+            loss_fn().backward()
+            hidden_states.grad = None
+
+        step()
+        memory = peak_memory_mb(step)
+        seconds = time_fn(step, warmup=0, iters=iters)
+        rows.append([name, f"{memory:.0f}", f"{seconds * 1000:.1f}"])
+
+    print(f"batch_size={batch_size}, seq_len={seq_len}, supervised positions per row={supervised_len}, vocab={vocab_size}, dtype={dtype}")
+    print_table(["loss", "step peak (MiB)", "step time (ms)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
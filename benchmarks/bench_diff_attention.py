@@ -0,0 +1,81 @@
+# Gradient check of diff_attention.DifferentialAttentionFunction, then peak training memory and step time
+# with the attention maps stored by autograd vs recomputed in backward (recompute_attention).
+# Run from the repository root: python -m benchmarks.bench_diff_attention
+import fire
+import torch
+from peft import LoraConfig, get_peft_model
+
+from benchmarks.common import build_model, dummy_batch, peak_memory_mb, print_table, time_fn
+from diff_attention import DifferentialAttentionFunction
+
+
+def gradcheck():
+    # Small float64 problems: SigLIP's two maps with per-row lambdas (as with several adapters), and Gemma's
+    # single map with 3 query heads folded onto each KV head. Blocks of 2 queries so several blocks are used
+    torch.manual_seed(0)
+    batch_size, num_heads, q_len, kv_len, head_dim = 2, 2, 5, 7, 4
+    mask = torch.zeros(batch_size, 1, q_len, kv_len, dtype=torch.float64)
+    mask[1, :, :, -2:] = torch.finfo(torch.float64).min
+
+    def tensor(*shape):
+        return torch.randn(shape, dtype=torch.float64, requires_grad=True)
+
+    q1, q2 = tensor(batch_size, num_heads, q_len, head_dim), tensor(batch_size, num_heads, q_len, head_dim)
+    k1, k2 = tensor(batch_size, num_heads, kv_len, head_dim), tensor(batch_size, num_heads, kv_len, head_dim)
+    v = tensor(batch_size, num_heads, kv_len, 2 * head_dim)
+    two_maps = torch.autograd.gradcheck(
+        lambda q1, k1, q2, k2, v, lambda_full: DifferentialAttentionFunction.apply(q1, k1, q2, k2, v, mask, lambda_full, 0.5, 1, 2),
+        (q1, k1, q2, k2, v, tensor(batch_size, 1, 1, 1)),
+    )
+    groups = 3
+    folded = torch.autograd.gradcheck(
+        lambda q, k, v, lambda_full: DifferentialAttentionFunction.apply(q, k, None, None, v, mask, lambda_full, 0.5, groups, 2),
+        (tensor(batch_size, num_heads, groups * q_len, head_dim), k1, v, tensor()),
+    )
+    print(f"gradcheck: two maps {two_maps}, single folded map {folded}")
+
+
+def set_recompute_attention(model, enabled):
+    for module in model.modules():
+        if hasattr(module, "recompute_attention"):
+            module.recompute_attention = enabled
+
+
+def main(batch_size: int = 4, text_len: int = 32, num_text_layers: int = None, num_vision_layers: int = None,
+         vocab_size: int = 257216, dtype: str = "float32", device: str = "cpu", iters: int = 3):
+    gradcheck()
+
+    model = build_model(num_text_layers, num_vision_layers, dtype=getattr(torch, dtype), device=device, vocab_size=vocab_size)
+    model.config.image_token_index = min(model.config.image_token_index, vocab_size - 1)
+    # Same trainable parameters as finetune.setup: LoRA plus the differential attention params
+    model = get_peft_model(model, LoraConfig(
+        r=32, lora_alpha=64, lora_dropout=0.1,
+        target_modules=r".*language_model.*\.(q_proj|o_proj|k_proj|v_proj|gate_proj|up_proj|down_proj)",
+    ))
+    for name, param in model.named_parameters():
+        if any(keyword in name for keyword in ["lambda_q1", "lambda_k1", "lambda_q2", "lambda_k2", "subln"]):
+            param.requires_grad = True
+    model.train()
+
+    batch = dummy_batch(model.config, batch_size, text_len, device=device)
+
+    def step():
+        loss = model(**batch).loss
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    rows = []
+    for enabled in (False, True):
+        set_recompute_attention(model, enabled)
+        # The first step also allocates the gradients, measure memory on a warm step
+        step()
+        memory = peak_memory_mb(step, device)
+        step_time = time_fn(step, device, warmup=0, iters=iters)
+        rows.append(["recompute" if enabled else "autograd", f"{memory:.0f}", f"{step_time:.3f}"])
+
+    print(f"batch_size={batch_size}, seq_len={model.config.num_image_tokens + text_len}, dtype={dtype}")
+    print_table(["attention maps", "peak memory (MiB)", "step time (s)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
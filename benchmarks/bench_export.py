@@ -0,0 +1,60 @@
+# Parity and latency of the TorchScript graphs from export.export_torchscript vs eager PyTorch: the vision encoder,
+# the prefill and one decode step, plus the tokens of a greedy generation.
+# Run from the repository root: python -m benchmarks.bench_export
+import tempfile
+import warnings
+
+import fire
+import torch
+
+from benchmarks.common import build_model, dummy_batch, print_table, time_fn
+from export import DecodeGraph, PrefillGraph, VisionGraph, export_torchscript, generate_exported, load_torchscript
+from inference import generate
+
+
+def main(num_text_layers: int = 4, num_vision_layers: int = 4, batch_size: int = 1, text_len: int = 16, context_len: int = 512,
+         max_new_tokens: int = 8, iters: int = 5):
+    # The tracer warns about every shape it turns into a Python int
+    warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+    torch.manual_seed(0)
+    model = build_model(num_text_layers=num_text_layers, num_vision_layers=num_vision_layers, vocab_size=32000).eval()
+    model.config.image_token_index = model.config.vocab_size - 1
+    batch = dummy_batch(model.config, batch_size, text_len)
+    input_ids, attention_mask, pixel_values = batch["input_ids"], batch["attention_mask"], batch["pixel_values"]
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        export_torchscript(model, input_ids, attention_mask, pixel_values, output_dir)
+        graphs = load_torchscript(output_dir)
+    eager = (VisionGraph(model), PrefillGraph(model), DecodeGraph(model))
+
+    # Decode step at `context_len` cached positions, the graphs were traced with a shorter cache
+    num_kv_heads, head_dim = model.config.text_config.num_key_value_heads, model.config.text_config.head_dim
+    key_cache = torch.randn(num_text_layers, batch_size, num_kv_heads, context_len, head_dim)
+    value_cache = torch.randn_like(key_cache)
+    decode_ids = input_ids[:, -1:]
+    decode_mask = torch.ones(batch_size, context_len + 1, dtype=attention_mask.dtype)
+
+    rows = []
+    with torch.no_grad():
+        image_features = eager[0](pixel_values)
+        steps = {
+            "vision": lambda vision, prefill, decode: vision(pixel_values),
+            "prefill": lambda vision, prefill, decode: prefill(input_ids, attention_mask, image_features)[0],
+            f"decode step ({context_len} cached)": lambda vision, prefill, decode: decode(decode_ids, decode_mask, key_cache, value_cache)[0],
+        }
+        for name, step in steps.items():
+            difference = (step(*graphs) - step(*eager)).abs().max().item()
+            eager_seconds = time_fn(lambda: step(*eager), warmup=1, iters=iters)
+            graph_seconds = time_fn(lambda: step(*graphs), warmup=1, iters=iters)
+            rows.append([name, f"{difference:.2e}", f"{eager_seconds * 1000:.1f}", f"{graph_seconds * 1000:.1f}",
+                         f"{eager_seconds / graph_seconds:.2f}x"])
+
+    reference = generate(model, input_ids, attention_mask, pixel_values=pixel_values, max_new_tokens=max_new_tokens)
+    exported = generate_exported(*graphs, input_ids, attention_mask, pixel_values, max_new_tokens=max_new_tokens)
+    print(f"same tokens as inference.generate: {exported == reference}")
+    print(f"batch_size={batch_size}, {num_vision_layers} vision + {num_text_layers} text layers")
+    print_table(["graph", "max abs difference", "eager (ms)", "TorchScript (ms)", "speedup"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,81 @@
+# Inference latency of a PeftModel-wrapped model vs the same adapter merged with lora_merge.py.
+# Run from the repository root: python -m benchmarks.bench_lora_merge
+import copy
+import tempfile
+
+import fire
+import torch
+from peft import LoraConfig, get_peft_model
+
+from benchmarks.common import build_model, dummy_batch, print_table, time_fn
+from lora_merge import merge_adapter
+from modeling_gemma import KVCache
+
+
+def main(batch_size: int = 1, text_len: int = 32, num_text_layers: int = None, num_vision_layers: int = None,
+         dtype: str = "float32", device: str = "cpu", iters: int = 5, vocab_size: int = None):
+    torch.manual_seed(0)
+    # Two full copies of the model are alive at once, a smaller vocab_size keeps that within small hosts' memory
+    text_config = {} if vocab_size is None else {"vocab_size": vocab_size}
+    base = build_model(num_text_layers, num_vision_layers, dtype=getattr(torch, dtype), device=device, **text_config).eval()
+    if vocab_size is not None:
+        base.config.image_token_index = vocab_size - 1
+    merged = copy.deepcopy(base)
+
+    # Same adapter layout as finetune.setup. lora_B starts at zero, randomize it so the merge actually changes something
+    wrapped = get_peft_model(base, LoraConfig(
+        r=32, lora_alpha=64, lora_dropout=0.1,
+        target_modules=r".*language_model.*\.(q_proj|o_proj|k_proj|v_proj|gate_proj|up_proj|down_proj)",
+    )).eval()
+    with torch.no_grad():
+        for name, param in wrapped.named_parameters():
+            if "lora_B" in name:
+                param.normal_(std=0.02)
+            elif any(keyword in name for keyword in ["lambda_q1", "lambda_k1", "lambda_q2", "lambda_k2"]):
+                param.normal_(std=0.1)
+
+    with tempfile.TemporaryDirectory() as adapter_dir:
+        wrapped.save_pretrained(adapter_dir)
+        diff_params = {
+            name: param.detach() for name, param in wrapped.state_dict().items()
+            if any(keyword in name for keyword in ["lambda_q1", "lambda_k1", "lambda_q2", "lambda_k2", "subln"])
+        }
+        torch.save(diff_params, f"{adapter_dir}/diff_attention_params.pth")
+        merge_adapter(merged, adapter_dir, f"{adapter_dir}/diff_attention_params.pth")
+
+    batch = dummy_batch(merged.config, batch_size, text_len, device=device)
+    inputs = {name: batch[name] for name in ("input_ids", "pixel_values", "attention_mask")}
+    next_token = {
+        "input_ids": batch["input_ids"][:, -1:],
+        "attention_mask": torch.cat([batch["attention_mask"], batch["attention_mask"][:, -1:]], dim=-1),
+    }
+
+    rows = []
+    with torch.no_grad():
+        wrapped_logits = wrapped(**inputs).logits
+        merged_logits = merged(**inputs).logits
+        print(f"Max logit difference wrapped vs merged: {(wrapped_logits - merged_logits).abs().max().item():.2e}")
+
+        for name, model in (("PeftModel", wrapped), ("merged", merged)):
+            prefill = time_fn(lambda: model(**inputs), device, warmup=1, iters=iters)
+
+            # One decode step on top of a prefilled cache
+            kv_cache = KVCache()
+            model(**inputs, kv_cache=kv_cache)
+            num_items = kv_cache.num_items()
+
+            def decode():
+                model(**next_token, kv_cache=kv_cache)
+                # Drop the step's entries again so every iteration decodes at the same length
+                kv_cache.key_cache = [k[:, :, :num_items] for k in kv_cache.key_cache]
+                kv_cache.value_cache = [v[:, :, :num_items] for v in kv_cache.value_cache]
+
+            decode_time = time_fn(decode, device, warmup=1, iters=iters)
+            rows.append([name, f"{prefill * 1000:.1f}", f"{decode_time * 1000:.1f}"])
+
+    print(f"batch_size={batch_size}, seq_len={merged.config.num_image_tokens + text_len}, dtype={dtype}")
+    print_table(["model", "prefill (ms)", "decode step (ms)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,51 @@
+# Peak memory and throughput of one GemmaMLP over mlp_chunk_size, for prefill (no_grad) and a training step (chunk recomputation).
+# Run from the repository root: python -m benchmarks.bench_mlp_chunking
+import fire
+import torch
+
+from benchmarks.common import peak_memory_mb, print_table, time_fn
+from modeling_gemma import GemmaConfig, GemmaMLP
+
+CHUNK_SIZES = [None, 256, 128, 64, 32]
+
+
+def main(batch_size: int = 8, seq_len: int = 288, chunk_sizes=tuple(CHUNK_SIZES), dtype: str = "float32",
+         training: bool = True, iters: int = 3):
+    config = GemmaConfig()
+    torch.manual_seed(0)
+    # Frozen weights like the LoRA finetuning, so the peak is the activations and not the weight gradients
+    mlp = GemmaMLP(config).to(getattr(torch, dtype)).requires_grad_(False)
+    x = torch.randn(batch_size, seq_len, config.hidden_size, dtype=getattr(torch, dtype))
+    x_train = x.clone().requires_grad_()
+    grad = torch.randn_like(x)
+
+    def prefill():
+        with torch.no_grad():
+            mlp.eval()(x)
+
+    def train_step():
+        mlp.train()(x_train).backward(grad)
+        x_train.grad = None
+
+    rows = []
+    for chunk_size in chunk_sizes:
+        mlp.chunk_size, mlp.chunk_recompute = chunk_size, True
+        prefill_mb = peak_memory_mb(prefill)
+        prefill_seconds = time_fn(prefill, warmup=1, iters=iters)
+        row = [str(chunk_size), f"{prefill_mb:.0f}", f"{batch_size * seq_len / prefill_seconds:.0f}"]
+        if training:
+            train_step()
+            train_mb = peak_memory_mb(train_step)
+            train_seconds = time_fn(train_step, warmup=0, iters=iters)
+            row += [f"{train_mb:.0f}", f"{batch_size * seq_len / train_seconds:.0f}"]
+        rows.append(row)
+
+    print(f"batch_size={batch_size}, seq_len={seq_len}, hidden={config.hidden_size}, intermediate={config.intermediate_size}, dtype={dtype}")
+    header = ["chunk size", "prefill peak (MiB)", "prefill tokens/s"]
+    if training:
+        header += ["train peak (MiB)", "train tokens/s"]
+    print_table(header, rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
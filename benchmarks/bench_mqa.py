@@ -0,0 +1,56 @@
+# Decode step and prefill of one GemmaAttention layer (8 query heads sharing 1 KV head) at long contexts,
+# folding the query heads into the sequence dimension vs expanding the KV heads with repeat_kv.
+# Run from the repository root: python -m benchmarks.bench_mqa
+import fire
+import torch
+
+from benchmarks.common import peak_memory_mb, print_table, time_fn
+from modeling_gemma import GemmaAttention, GemmaConfig, KVCache
+
+CONTEXT_LENGTHS = [1024, 2048, 4096, 8192]
+
+
+def main(context_lengths=tuple(CONTEXT_LENGTHS), batch_size: int = 4, prefill_len: int = 1024, iters: int = 10):
+    config = GemmaConfig()
+    torch.manual_seed(0)
+    attention = GemmaAttention(config, layer_idx=0).eval()
+    num_kv_heads, head_dim = config.num_key_value_heads, config.head_dim
+
+    rows = []
+    with torch.no_grad():
+        for fold in (False, True):
+            attention.fold_query_heads = fold
+            name = "fold query heads" if fold else "repeat_kv"
+            for context_length in context_lengths:
+                # A filled cache, every decode step attends to context_length keys and then drops its own entry again
+                kv_cache = KVCache()
+                keys = torch.randn(batch_size, num_kv_heads, context_length - 1, head_dim)
+                values = torch.randn(batch_size, num_kv_heads, context_length - 1, head_dim)
+                hidden_states = torch.randn(batch_size, 1, config.hidden_size)
+                position_ids = torch.full((batch_size, 1), context_length)
+                mask = torch.zeros(batch_size, 1, 1, context_length)
+
+                def decode():
+                    kv_cache.key_cache, kv_cache.value_cache = [keys], [values]
+                    attention(hidden_states, attention_mask=mask, position_ids=position_ids, kv_cache=kv_cache)
+
+                seconds = time_fn(decode, warmup=2, iters=iters)
+                memory = peak_memory_mb(decode)
+                rows.append([name, f"decode @ {context_length}", f"{seconds * 1000:.2f}", f"{memory:.1f}"])
+
+            # Prefill without a cache: the whole prompt at once
+            hidden_states = torch.randn(batch_size, prefill_len, config.hidden_size)
+            position_ids = torch.arange(1, prefill_len + 1).expand(batch_size, -1)
+            mask = torch.zeros(batch_size, 1, prefill_len, prefill_len)
+            prefill = lambda: attention(hidden_states, attention_mask=mask, position_ids=position_ids)
+            seconds = time_fn(prefill, warmup=1, iters=max(1, iters // 5))
+            memory = peak_memory_mb(prefill)
+            rows.append([name, f"prefill {prefill_len}", f"{seconds * 1000:.2f}", f"{memory:.1f}"])
+
+    print(f"batch_size={batch_size}, query heads={config.num_attention_heads}, KV heads={num_kv_heads}, "
+          f"head_dim={head_dim}, torch threads={torch.get_num_threads()}")
+    print_table(["attention", "step", "time (ms)", "peak memory (MiB)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,75 @@
+# Prefill latency of one batch mixing several adapters (multi_lora.py) vs one batch per adapter and vs the bare base model.
+# Run from the repository root: python -m benchmarks.bench_multi_lora
+import tempfile
+
+import fire
+import torch
+from peft import LoraConfig, get_peft_model
+
+from benchmarks.common import build_model, dummy_batch, print_table, time_fn
+from multi_lora import AdapterRegistry
+
+
+def save_random_adapter(model, adapter_dir, rank, seed):
+    torch.manual_seed(seed)
+    wrapped = get_peft_model(model, LoraConfig(
+        r=rank, lora_alpha=2 * rank,
+        target_modules=r".*language_model.*\.(q_proj|o_proj|k_proj|v_proj|gate_proj|up_proj|down_proj)",
+    ))
+    with torch.no_grad():
+        for name, param in wrapped.named_parameters():
+            if "lora_B" in name:
+                param.normal_(std=0.02)
+    wrapped.save_pretrained(adapter_dir)
+    return wrapped.unload()
+
+
+def main(batch_size: int = 8, num_adapters: int = 4, rank: int = 32, text_len: int = 32, num_text_layers: int = None,
+         num_vision_layers: int = None, dtype: str = "float32", device: str = "cpu", iters: int = 3):
+    model = build_model(num_text_layers, num_vision_layers, dtype=getattr(torch, dtype), device=device).eval()
+
+    with tempfile.TemporaryDirectory() as root:
+        adapter_dirs = []
+        for i in range(num_adapters):
+            adapter_dirs.append(f"{root}/adapter-{i}")
+            model = save_random_adapter(model, adapter_dirs[-1], rank, seed=i)
+
+        batch = dummy_batch(model.config, batch_size, text_len, device=device)
+        inputs = {name: batch[name] for name in ("input_ids", "pixel_values", "attention_mask")}
+        with torch.no_grad():
+            base_time = time_fn(lambda: model(**inputs), device, warmup=1, iters=iters)
+
+        registry = AdapterRegistry(model, max_adapters=num_adapters, max_rank=rank)
+        names = [f"adapter-{i}" for i in range(num_adapters)]
+        for name, adapter_dir in zip(names, adapter_dirs):
+            registry.register(name, adapter_dir)
+        # Round robin, so every batch row uses a different adapter than its neighbour
+        row_adapters = [names[i % num_adapters] for i in range(batch_size)]
+        slot_ids = registry.slot_ids(row_adapters)
+
+    def mixed():
+        registry.context.slot_ids = slot_ids
+        model(**inputs)
+
+    def per_adapter():
+        # What serving one adapter per batch costs for the same requests
+        for slot in slot_ids.unique():
+            rows = (slot_ids == slot).nonzero().squeeze(-1)
+            registry.context.slot_ids = slot_ids[rows]
+            model(**{name: tensor[rows] for name, tensor in inputs.items()})
+
+    with torch.no_grad():
+        mixed_time = time_fn(mixed, device, warmup=1, iters=iters)
+        per_adapter_time = time_fn(per_adapter, device, warmup=1, iters=iters)
+    registry.context.slot_ids = None
+
+    print(f"batch_size={batch_size}, adapters={num_adapters}, rank={rank}, seq_len={model.config.num_image_tokens + text_len}")
+    print_table(["mode", "prefill (ms)"], [
+        ["base model, no adapters", f"{base_time * 1000:.1f}"],
+        ["one mixed batch", f"{mixed_time * 1000:.1f}"],
+        ["one batch per adapter", f"{per_adapter_time * 1000:.1f}"],
+    ])
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
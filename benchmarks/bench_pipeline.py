@@ -0,0 +1,46 @@
+# End-to-end throughput of generation over a stream of image batches: the serial path (vision encoding, then decoding,
+# batch after batch) vs pipelined_inference.PipelinedGenerator, which encodes the next batches on its own cores meanwhile.
+# The gain needs at least 2 cores, with one core both stages just take turns.
+# Run from the repository root: python -m benchmarks.bench_pipeline
+import os
+import time
+
+import fire
+import torch
+
+from benchmarks.common import build_model, dummy_batch, print_table
+from pipelined_inference import PipelinedGenerator, serial_generate, split_cores
+
+
+def main(num_batches: int = 8, batch_size: int = 2, text_len: int = 16, max_new_tokens: int = 8, num_text_layers: int = 4,
+         num_vision_layers=None, vision_fraction: float = 0.5, queue_size: int = 2):
+    torch.manual_seed(0)
+    model = build_model(num_text_layers=num_text_layers, num_vision_layers=num_vision_layers, vocab_size=32000).eval()
+    model.config.image_token_index = model.config.vocab_size - 1
+    batches = [dummy_batch(model.config, batch_size, text_len) for _ in range(num_batches)]
+    vision_cores, language_cores = split_cores(vision_fraction=vision_fraction)
+    num_images = num_batches * batch_size
+
+    # Warmup
+    list(serial_generate(model, batches[:1], max_new_tokens=max_new_tokens))
+    start = time.perf_counter()
+    serial = list(serial_generate(model, batches, max_new_tokens=max_new_tokens))
+    serial_seconds = time.perf_counter() - start
+
+    with PipelinedGenerator(model, vision_cores, language_cores, queue_size=queue_size) as pipeline:
+        list(pipeline.generate(batches[:1], max_new_tokens=max_new_tokens))
+        start = time.perf_counter()
+        pipelined = list(pipeline.generate(batches, max_new_tokens=max_new_tokens))
+        pipelined_seconds = time.perf_counter() - start
+    print(f"same tokens: {pipelined == serial}")
+
+    print(f"{num_batches} batches of {batch_size} images, {max_new_tokens} new tokens, {len(os.sched_getaffinity(0))} cores "
+          f"(vision {vision_cores}, language {language_cores}), queue_size={queue_size}")
+    print_table(["path", "time (s)", "images/s"], [
+        ["serial", f"{serial_seconds:.2f}", f"{num_images / serial_seconds:.2f}"],
+        ["pipelined", f"{pipelined_seconds:.2f}", f"{num_images / pipelined_seconds:.2f}"],
+    ])
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
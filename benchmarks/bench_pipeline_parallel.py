@@ -0,0 +1,87 @@
+# Generation throughput of pipeline_parallel.PipelineStage on localhost processes (gloo) vs one process running
+# inference.generate on the same micro-batches one after the other, plus the utilization of every stage.
+# Stages sharing a core also count the time they are preempted by the others as busy.
+# Run from the repository root: python -m benchmarks.bench_pipeline_parallel
+import os
+import pickle
+import tempfile
+import time
+
+import fire
+import torch
+
+from benchmarks.common import build_model, dummy_batch, print_table
+from inference import generate
+from pipeline_parallel import PipelineStage, launch
+
+
+def make_model(num_text_layers, num_vision_layers):
+    # Same seed in every process, so all the stages cut up the same model
+    torch.manual_seed(0)
+    model = build_model(num_text_layers=num_text_layers, num_vision_layers=num_vision_layers, vocab_size=32000).eval()
+    model.config.image_token_index = model.config.vocab_size - 1
+    return model
+
+
+def make_micro_batches(config, num_micro_batches, micro_batch_size, text_len):
+    torch.manual_seed(1)
+    return [dummy_batch(config, micro_batch_size, text_len) for _ in range(num_micro_batches)]
+
+
+def run_stage(rank, world_size, settings, result_path):
+    model = make_model(settings["num_text_layers"], settings["num_vision_layers"])
+    micro_batches = make_micro_batches(model.config, settings["num_micro_batches"], settings["micro_batch_size"], settings["text_len"])
+    stage = PipelineStage(model)
+    # Warmup
+    stage.generate(micro_batches[:1], max_new_tokens=2)
+    stage.busy_seconds = stage.wait_seconds = stage.wall_seconds = 0.0
+
+    start = time.perf_counter()
+    generated = stage.generate(micro_batches, max_new_tokens=settings["max_new_tokens"])
+    seconds = time.perf_counter() - start
+    stats = stage.stats()
+    if rank == 0:
+        with open(result_path, "wb") as f:
+            pickle.dump({"generated": generated, "seconds": seconds, "stats": stats}, f)
+
+
+def main(num_stages=(2, 4), num_micro_batches: int = 4, micro_batch_size: int = 2, text_len: int = 16, max_new_tokens: int = 8,
+         num_text_layers: int = 8, num_vision_layers: int = 8):
+    settings = dict(num_micro_batches=num_micro_batches, micro_batch_size=micro_batch_size, text_len=text_len,
+                    max_new_tokens=max_new_tokens, num_text_layers=num_text_layers, num_vision_layers=num_vision_layers)
+    num_tokens = num_micro_batches * micro_batch_size * max_new_tokens
+
+    model = make_model(num_text_layers, num_vision_layers)
+    micro_batches = make_micro_batches(model.config, num_micro_batches, micro_batch_size, text_len)
+    generate(model, micro_batches[0]["input_ids"], micro_batches[0]["attention_mask"], pixel_values=micro_batches[0]["pixel_values"], max_new_tokens=2)
+    start = time.perf_counter()
+    reference = [
+        generate(model, batch["input_ids"], batch["attention_mask"], pixel_values=batch["pixel_values"], max_new_tokens=max_new_tokens)
+        for batch in micro_batches
+    ]
+    seconds = time.perf_counter() - start
+    rows = [["1 (inference.generate)", f"{seconds:.2f}", f"{num_tokens / seconds:.1f}", "", ""]]
+    del model
+
+    stage_rows = []
+    for world_size in ([num_stages] if isinstance(num_stages, int) else num_stages):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_path = os.path.join(tmp_dir, "result.pkl")
+            launch(run_stage, world_size, settings, result_path, master_port=29500 + world_size)
+            with open(result_path, "rb") as f:
+                result = pickle.load(f)
+        rows.append([str(world_size), f"{result['seconds']:.2f}", f"{num_tokens / result['seconds']:.1f}",
+                     str(result["generated"] == reference),
+                     " ".join(f"{stats['utilization']:.0%}" for stats in result["stats"])])
+        stage_rows += [[str(world_size), str(stats["rank"]), str(stats["vision_layers"]), str(stats["text_layers"]),
+                        f"{stats['busy_seconds']:.2f}", f"{stats['wait_seconds']:.2f}", f"{stats['utilization']:.0%}"]
+                       for stats in result["stats"]]
+
+    print(f"{num_micro_batches} micro-batches of {micro_batch_size}, {max_new_tokens} new tokens, {num_vision_layers} vision + "
+          f"{num_text_layers} text layers, {len(os.sched_getaffinity(0))} cores")
+    print_table(["stages", "time (s)", "tokens/s", "same tokens", "stage utilization"], rows)
+    print_table(["stages", "rank", "vision layers", "text layers", "busy (s)", "waiting (s)", "utilization"], stage_rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,88 @@
+# Parity and throughput of image_preprocessing.BatchImagePreprocessor vs the HF SiglipImageProcessor path.
+# Run from the repository root: python -m benchmarks.bench_preprocessing
+import glob
+import io
+import time
+
+import fire
+import numpy as np
+import torch
+from PIL import Image
+from transformers import SiglipImageProcessor
+
+from benchmarks.common import print_table
+from image_preprocessing import BatchImagePreprocessor
+
+# Typical VQAv2/COCO image sizes, plus smaller ones that are upscaled to 224 on at least one axis
+SIZES = [(640, 480), (480, 640), (640, 427), (500, 375), (224, 224), (259, 194), (160, 120), (200, 300)]
+# resize_bicubic matches PIL's uint8 values up to float32 rounding on ties: at most one uint8 step
+TOLERANCE = 2 / 255 + 1e-5
+
+
+def make_images(num_images, seed=0):
+    # Repository images plus smooth synthetic ones, noise would exaggerate differences between resampling filters
+    images = [Image.open(path).convert("RGB") for path in sorted(glob.glob("images/*"))]
+    rng = np.random.default_rng(seed)
+    while len(images) < num_images:
+        width, height = SIZES[len(images) % len(SIZES)]
+        coarse = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        images.append(Image.fromarray(coarse).resize((width, height), Image.Resampling.BILINEAR))
+    return images[:num_images]
+
+
+def encode_jpeg(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def main(num_images: int = 64, batch_size: int = 32, num_threads: int = 4, iters: int = 3):
+    images = make_images(num_images)
+    encoded = [encode_jpeg(image) for image in images]
+    # PaliGemma's image processor settings
+    image_processor = SiglipImageProcessor(size={"height": 224, "width": 224}, image_mean=[0.5] * 3, image_std=[0.5] * 3, resample=3)
+    preprocessor = BatchImagePreprocessor.from_processor(image_processor, num_threads=num_threads, max_batch_size=batch_size)
+
+    # Parity on the exact same decoded images
+    reference = image_processor(images, return_tensors="pt")["pixel_values"]
+    ours = torch.cat([preprocessor(images[i:i + batch_size], copy=True) for i in range(0, num_images, batch_size)])
+    diff = (reference - ours).abs().flatten(1).max(dim=1).values
+    upscaled = torch.tensor([min(image.size) < 224 for image in images])
+    for name, mask in (("downscaled", ~upscaled), ("upscaled", upscaled)):
+        assert mask.any(), f"no {name} images to compare"
+        print(f"{name} ({mask.sum().item()} images): max abs difference {diff[mask].max().item():.6f} "
+              f"(one uint8 step is {2 / 255:.4f})")
+    assert diff.max().item() <= TOLERANCE, f"pixel_values differ by {diff.max().item():.4f} > one uint8 step"
+
+    def processor_path():
+        for i in range(0, num_images, batch_size):
+            batch = [Image.open(io.BytesIO(data)) for data in encoded[i:i + batch_size]]
+            image_processor(batch, return_tensors="pt")
+
+    def resize_then_processor_path():
+        # The previous main.py / evaluation/vqav2.py path: serial LANCZOS resize_images, then the processor again
+        for i in range(0, num_images, batch_size):
+            batch = [Image.open(io.BytesIO(data)).resize((224, 224), Image.Resampling.LANCZOS) for data in encoded[i:i + batch_size]]
+            image_processor(batch, return_tensors="pt")
+
+    def batched_path():
+        for i in range(0, num_images, batch_size):
+            preprocessor(encoded[i:i + batch_size])
+
+    rows = []
+    for name, fn in (("SiglipImageProcessor", processor_path), ("resize_images + processor", resize_then_processor_path),
+                     ("BatchImagePreprocessor", batched_path)):
+        fn()
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn()
+        seconds = (time.perf_counter() - start) / iters
+        rows.append([name, f"{num_images / seconds:.1f}"])
+
+    print(f"{num_images} JPEG images, batch_size={batch_size}, decode threads={num_threads}, torch threads={torch.get_num_threads()}")
+    print_table(["pipeline (decode included)", "images/sec"], rows)
+    preprocessor.close()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
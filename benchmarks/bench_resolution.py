@@ -0,0 +1,85 @@
+# Prefill latency (and, with a real checkpoint, VQAv2 accuracy) of the model at different input resolutions.
+# Other resolutions than 224 use the interpolated position embeddings of SiglipVisionEmbeddings.
+# Run from the repository root: python -m benchmarks.bench_resolution
+# With weights: python -m benchmarks.bench_resolution --model_path /path/to/paligemma-3b-pt-224 --adapter_path ... --new_weights_path ...
+import os
+import sys
+
+import fire
+import torch
+
+from benchmarks.common import build_model, print_table, time_fn
+
+# Multiples of the 14 pixel patch size, 224 is the native resolution (16x16 = 256 image tokens)
+RESOLUTIONS = [112, 168, 224, 280]
+
+
+@torch.no_grad()
+def vqav2_accuracy(model, processor, dataset, resolution, batch_size=8, max_new_tokens=10):
+    from image_preprocessing import BatchImagePreprocessor
+    from inference import generate
+    from utils import tokenize_prompts
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "evaluation"))
+    from vqav2 import vqav2_score
+
+    patch_size = model.config.vision_config.patch_size
+    preprocessor = BatchImagePreprocessor.from_processor(processor, image_size=resolution)
+    scores = []
+    for start in range(0, len(dataset), batch_size):
+        examples = dataset[start:start + batch_size]
+        # Same prompt as finetuning, with as many image tokens as the resolution has patches
+        inputs = tokenize_prompts(processor, ["answer " + question for question in examples["question"]],
+                                  image_seq_len=(resolution // patch_size) ** 2)
+        generated = generate(model, inputs["input_ids"], inputs["attention_mask"], pixel_values=preprocessor(examples["image"]),
+                             max_new_tokens=max_new_tokens, eos_token_id=processor.tokenizer.eos_token_id)
+        answers = processor.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        scores.extend(vqav2_score(gold, answer.strip()) for gold, answer in zip(examples["answers"], answers))
+    preprocessor.close()
+    return sum(scores) / len(scores)
+
+
+def main(resolutions=tuple(RESOLUTIONS), batch_size: int = 1, text_len: int = 16, num_text_layers: int = None,
+         num_vision_layers: int = None, model_path: str = None, adapter_path: str = None, new_weights_path: str = None,
+         num_examples: int = 200, iters: int = 3):
+    dataset, processor = None, None
+    if model_path is None:
+        # Latency only, random weights
+        model = build_model(num_text_layers, num_vision_layers).eval()
+    else:
+        from datasets import load_dataset
+        from lora_merge import load_merged_model
+
+        model, processor = load_merged_model(model_path, adapter_path, new_weights_path)
+        # Same held-out split as evaluation/vqav2.py
+        dataset = load_dataset("HuggingFaceM4/VQAv2", split="train[:100%]")
+        dataset = dataset.train_test_split(test_size=0.10, seed=42)["test"].select(range(num_examples))
+
+    config = model.config
+    patch_size = config.vision_config.patch_size
+    rows = []
+    for resolution in resolutions:
+        if resolution % patch_size != 0:
+            raise ValueError(f"Resolution {resolution} is not a multiple of the patch size {patch_size}")
+        num_image_tokens = (resolution // patch_size) ** 2
+        input_ids = torch.randint(2, 1000, (batch_size, num_image_tokens + text_len))
+        input_ids[:, :num_image_tokens] = config.image_token_index
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "pixel_values": torch.randn(batch_size, 3, resolution, resolution),
+        }
+        with torch.no_grad():
+            prefill = time_fn(lambda: model(**inputs), warmup=1, iters=iters)
+        row = [resolution, num_image_tokens, f"{prefill * 1000:.1f}"]
+        if dataset is not None:
+            row.append(f"{vqav2_accuracy(model, processor, dataset, resolution) * 100:.2f}")
+        rows.append(row)
+
+    header = ["resolution", "image tokens", "prefill (ms)"] + (["VQAv2 accuracy (%)"] if dataset is not None else [])
+    print(f"batch_size={batch_size}, text_len={text_len}")
+    print_table(header, rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,64 @@
+# Forward/backward time and saved activation memory of the RMSNorms: autograd through the reference ops vs rms_norm.RMSNormFunction.
+# Run from the repository root: python -m benchmarks.bench_rms_norm
+import fire
+import torch
+
+from benchmarks.common import print_table, time_fn
+from rms_norm import rms_norm
+
+# (name, input shape, unit_offset): Gemma's input/post-attention norms and the differential attention subln
+SHAPES = [
+    ("GemmaRMSNorm", (4, 512, 2048), True),
+    ("subln", (4, 8, 512, 256), False),
+    ("SigLIP RMSNorm", (4, 256, 1152), False),
+]
+
+
+def reference(x, weight, eps, unit_offset):
+    # The previous RMSNorm / GemmaRMSNorm forward
+    output = x.float() * torch.rsqrt(x.float().pow(2).mean(-1, keepdim=True) + eps)
+    if unit_offset:
+        return (output * (1.0 + weight.float())).type_as(x)
+    return output.type_as(x) * weight
+
+
+def saved_mb(fn):
+    # Bytes autograd keeps for backward, counted with saved tensor hooks
+    saved = []
+
+    def pack(tensor):
+        saved.append(tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(saved) / 2**20
+
+
+def main(dtypes=("float32", "bfloat16"), iters: int = 10):
+    rows = []
+    for dtype_name in dtypes:
+        dtype = getattr(torch, dtype_name)
+        for name, shape, unit_offset in SHAPES:
+            x = torch.randn(shape, dtype=dtype, requires_grad=True)
+            weight = torch.randn(shape[-1], requires_grad=True)
+            grad = torch.randn(shape, dtype=dtype)
+            for implementation, norm in (("autograd", reference), ("fused", rms_norm)):
+                forward = lambda: norm(x, weight, 1e-6, unit_offset)
+
+                def forward_backward():
+                    x.grad, weight.grad = None, None
+                    forward().backward(grad)
+
+                with torch.no_grad():
+                    inference = time_fn(forward, warmup=1, iters=iters)
+                training = time_fn(forward_backward, warmup=1, iters=iters)
+                rows.append([dtype_name, name, implementation, f"{inference * 1000:.2f}", f"{training * 1000:.2f}",
+                             f"{saved_mb(forward):.1f}"])
+
+    print(f"torch threads={torch.get_num_threads()}")
+    print_table(["dtype", "norm", "implementation", "forward no_grad (ms)", "forward+backward (ms)", "saved for backward (MiB)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
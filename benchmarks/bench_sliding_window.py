@@ -0,0 +1,64 @@
+# KV-Cache memory and decode latency vs context length, full attention vs sliding-window attention with a RollingKVCache.
+# Run from the repository root: python -m benchmarks.bench_sliding_window
+import fire
+import torch
+
+from benchmarks.common import build_model, peak_memory_mb, print_table, time_fn
+from modeling_gemma import KVCache, RollingKVCache
+
+CONTEXT_LENGTHS = [512, 1024, 2048, 4096]
+
+
+def cache_mb(kv_cache):
+    tensors = kv_cache.key_cache + kv_cache.value_cache
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+def decode_step_time(model, kv_cache, attention_mask, iters):
+    # Restore the cache after every step so each one decodes at the same context length
+    key_cache, value_cache, seen_tokens = list(kv_cache.key_cache), list(kv_cache.value_cache), kv_cache.num_items()
+    inputs = {
+        "input_ids": torch.randint(2, 1000, (attention_mask.shape[0], 1)),
+        "attention_mask": torch.cat([attention_mask, attention_mask[:, -1:]], dim=-1),
+    }
+
+    def decode():
+        model(**inputs, kv_cache=kv_cache)
+        kv_cache.key_cache, kv_cache.value_cache = list(key_cache), list(value_cache)
+        if isinstance(kv_cache, RollingKVCache):
+            kv_cache.seen_tokens = seen_tokens
+
+    return time_fn(decode, warmup=1, iters=iters)
+
+
+def main(context_lengths=tuple(CONTEXT_LENGTHS), window: int = 256, batch_size: int = 1, num_text_layers: int = 2,
+         num_vision_layers: int = 1, vocab_size: int = 32000, iters: int = 5):
+    rows = []
+    for sliding_window in (None, window):
+        # A smaller vocabulary keeps the embedding and lm_head small, they are the same for both variants
+        model = build_model(num_text_layers, num_vision_layers, vocab_size=vocab_size, sliding_window=sliding_window).eval()
+        config = model.config
+        config.image_token_index = vocab_size - 1
+        image_size = config.vision_config.image_size
+        for context_length in context_lengths:
+            input_ids = torch.randint(2, 1000, (batch_size, context_length))
+            input_ids[:, :config.num_image_tokens] = config.image_token_index
+            inputs = {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "pixel_values": torch.randn(batch_size, 3, image_size, image_size),
+            }
+            kv_cache = KVCache() if sliding_window is None else RollingKVCache(sliding_window)
+            with torch.no_grad():
+                prefill_mb = peak_memory_mb(lambda: model(**inputs, kv_cache=kv_cache))
+                decode = decode_step_time(model, kv_cache, inputs["attention_mask"], iters)
+            rows.append(["full" if sliding_window is None else f"window {sliding_window}", context_length,
+                         f"{cache_mb(kv_cache):.2f}", f"{prefill_mb:.0f}", f"{decode * 1000:.1f}"])
+        del model
+
+    print(f"batch_size={batch_size}, text layers={num_text_layers}, image prefix={config.num_image_tokens} tokens")
+    print_table(["attention", "context", "KV-Cache (MiB)", "prefill peak (MiB)", "decode step (ms)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,91 @@
+# Cold start of a fresh process, split into import, model construction, checkpoint load and the first generated token,
+# building the model with the random init vs under modeling_gemma.no_init_weights.
+# Run from the repository root: python -m benchmarks.bench_startup
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import fire
+import torch
+from safetensors.torch import save_file
+
+from benchmarks.common import build_model, print_table
+
+# Runs in a fresh interpreter, so the imports are timed cold
+STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+import torch
+torch_imported = time.perf_counter()
+from modeling_gemma import PaliGemmaForConditionalGeneration, init_missing_weights, no_init_weights
+from inference import generate
+imported = time.perf_counter()
+
+from safetensors.torch import load_file
+from benchmarks.common import build_config, dummy_batch
+checkpoint, no_init, num_text_layers, num_vision_layers, text_len = sys.argv[1:]
+config = build_config(int(num_text_layers), int(num_vision_layers), vocab_size=32000)
+config.image_token_index = config.vocab_size - 1
+
+construct_start = time.perf_counter()
+if no_init == "1":
+    with no_init_weights():
+        model = PaliGemmaForConditionalGeneration(config)
+else:
+    model = PaliGemmaForConditionalGeneration(config)
+constructed = time.perf_counter()
+
+missing_keys = model.load_state_dict(load_file(checkpoint), strict=False).missing_keys
+init_missing_weights(model, missing_keys)
+model.tie_weights()
+loaded = time.perf_counter()
+
+torch.manual_seed(0)
+batch = dummy_batch(config, 1, int(text_len))
+tokens = generate(model.eval(), batch["input_ids"], batch["attention_mask"], batch["pixel_values"], max_new_tokens=1)
+first_token = time.perf_counter()
+print(json.dumps({
+    "import torch": torch_imported - start, "import model": imported - torch_imported,
+    "construct": constructed - construct_start, "load": loaded - constructed, "first token": first_token - loaded,
+    "tokens": tokens,
+}))
+"""
+
+PHASES = ["import torch", "import model", "construct", "load", "first token"]
+
+
+def main(num_text_layers: int = 4, num_vision_layers: int = 4, text_len: int = 16, repeats: int = 3):
+    torch.manual_seed(0)
+    model = build_model(num_text_layers=num_text_layers, num_vision_layers=num_vision_layers, vocab_size=32000)
+    # The lm_head is tied to the embeddings and not saved, like in the PaliGemma checkpoints
+    state_dict = {name: tensor.contiguous() for name, tensor in model.state_dict().items()
+                  if name != "language_model.lm_head.weight"}
+    del model
+
+    rows, tokens = [], {}
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = os.path.join(tmp, "model.safetensors")
+        save_file(state_dict, checkpoint)
+        del state_dict
+        print(f"Checkpoint: {os.path.getsize(checkpoint) / 2**20:.0f} MiB")
+        for name, no_init in [("random init", "0"), ("no_init_weights", "1")]:
+            runs = []
+            for _ in range(repeats):
+                output = subprocess.run(
+                    [sys.executable, "-c", STARTUP, checkpoint, no_init, str(num_text_layers), str(num_vision_layers), str(text_len)],
+                    capture_output=True, text=True, check=True,
+                )
+                runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+            tokens[name] = runs[0]["tokens"]
+            # Best of the repeats, the first one also warms the page cache
+            best = {phase: min(run[phase] for run in runs) for phase in PHASES}
+            rows.append([name] + [f"{best[phase]:.3f}" for phase in PHASES] + [f"{sum(best.values()):.3f}"])
+
+    print_table(["construction"] + [f"{phase} s" for phase in PHASES] + ["total s"], rows)
+    print(f"Same first token: {len(set(json.dumps(t) for t in tokens.values())) == 1}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,69 @@
+# Time to first byte of the streaming APIs in inference.py vs the blocking generate, which shows nothing before
+# all max_new_tokens are done. Text streaming needs the real tokenizer (--tokenizer_path, the model then gets
+# its vocabulary), without it the token stream of generate_steps is timed.
+# Run from the repository root: python -m benchmarks.bench_streaming
+import asyncio
+import time
+
+import fire
+import torch
+
+from benchmarks.common import build_model, dummy_batch, print_table
+from inference import astream_generate, generate, generate_steps, stream_generate
+
+
+def time_stream(stream):
+    start = time.perf_counter()
+    first = None
+    for _ in stream:
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+def time_async_stream(stream):
+    async def consume():
+        start = time.perf_counter()
+        first = None
+        async for _ in stream:
+            if first is None:
+                first = time.perf_counter() - start
+        return first, time.perf_counter() - start
+    return asyncio.run(consume())
+
+
+def main(num_text_layers: int = 4, num_vision_layers: int = 4, text_len: int = 16, max_new_tokens: int = 32,
+         tokenizer_path: str = None):
+    tokenizer = None
+    text_config = {"vocab_size": 32000}
+    if tokenizer_path is not None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        text_config = {"vocab_size": len(tokenizer)}
+    torch.manual_seed(0)
+    model = build_model(num_text_layers=num_text_layers, num_vision_layers=num_vision_layers, **text_config).eval()
+    model.config.image_token_index = model.config.vocab_size - 1
+    batch = dummy_batch(model.config, 1, text_len)
+    inputs = {"input_ids": batch["input_ids"], "attention_mask": batch["attention_mask"], "pixel_values": batch["pixel_values"]}
+    # Warmup
+    generate(model, **inputs, max_new_tokens=2)
+
+    start = time.perf_counter()
+    generate(model, **inputs, max_new_tokens=max_new_tokens)
+    seconds = time.perf_counter() - start
+    rows = [["generate (blocking)", f"{seconds * 1000:.0f}", f"{seconds * 1000:.0f}"]]
+
+    timings = {"generate_steps (tokens)": time_stream(generate_steps(model, **inputs, max_new_tokens=max_new_tokens))}
+    if tokenizer is not None:
+        timings["stream_generate (text)"] = time_stream(stream_generate(model, tokenizer, **inputs, max_new_tokens=max_new_tokens))
+        timings["astream_generate (text)"] = time_async_stream(astream_generate(model, tokenizer, **inputs, max_new_tokens=max_new_tokens))
+    for name, (first, total) in timings.items():
+        rows.append([name, f"{first * 1000:.0f}", f"{total * 1000:.0f}"])
+
+    print(f"batch size 1, {model.config.num_image_tokens} image + {text_len} text tokens, {max_new_tokens} new tokens, "
+          f"{num_vision_layers} vision + {num_text_layers} text layers")
+    print_table(["api", "time to first byte (ms)", "total (ms)"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,102 @@
+# Latency of a single request (batch size 1) with tensor_parallel.shard_model over 1, 2, 4 ... localhost processes (gloo):
+# prefill and per-token decode time (single-token forwards on a prefilled KV cache). Every rank builds the model on the meta device and loads its shards from one
+# memory-mapped checkpoint. Ranks sharing a core only get slower, the scaling needs a core per rank.
+# Run from the repository root: python -m benchmarks.bench_tensor_parallel
+import os
+import pickle
+import tempfile
+import time
+
+import fire
+import torch
+
+from benchmarks.common import build_model, dummy_batch, print_table
+from inference import generate
+from modeling_gemma import KVCache, PaliGemmaForConditionalGeneration
+from pipeline_parallel import launch
+from tensor_parallel import load_sharded_state_dict, shard_model
+
+
+def run_rank(rank, world_size, config, weights_path, batch, max_new_tokens, iters, result_path):
+    with torch.device("meta"):
+        model = PaliGemmaForConditionalGeneration(config)
+    shard_model(model)
+    load_sharded_state_dict(model, torch.load(weights_path, mmap=True, weights_only=True))
+
+    def prefill():
+        with torch.no_grad():
+            model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"], pixel_values=batch["pixel_values"])
+
+    # max_new_tokens single-token steps on top of a prefilled cache, the way generate() decodes
+    kv_cache = KVCache()
+    with torch.no_grad():
+        model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"], pixel_values=batch["pixel_values"],
+              kv_cache=kv_cache)
+    num_items = kv_cache.num_items()
+    next_token = batch["input_ids"][:, -1:]
+
+    def decode():
+        attention_mask = batch["attention_mask"]
+        with torch.no_grad():
+            for _ in range(max_new_tokens):
+                attention_mask = torch.cat([attention_mask, attention_mask[:, -1:]], dim=-1)
+                model(input_ids=next_token, attention_mask=attention_mask, kv_cache=kv_cache)
+        # Drop the steps' entries again so every iteration decodes at the same lengths
+        kv_cache.key_cache = [k[:, :, :num_items] for k in kv_cache.key_cache]
+        kv_cache.value_cache = [v[:, :, :num_items] for v in kv_cache.value_cache]
+
+    # Warmup, and all the ranks start timing together
+    generated = generate(model, batch["input_ids"], batch["attention_mask"], pixel_values=batch["pixel_values"],
+                         max_new_tokens=max_new_tokens)
+    decode()
+    prefill_seconds, decode_seconds = [], []
+    for _ in range(iters):
+        torch.distributed.barrier()
+        start = time.perf_counter()
+        prefill()
+        prefill_seconds.append(time.perf_counter() - start)
+        torch.distributed.barrier()
+        start = time.perf_counter()
+        decode()
+        decode_seconds.append((time.perf_counter() - start) / max_new_tokens)
+    if rank == 0:
+        with open(result_path, "wb") as f:
+            pickle.dump({"generated": generated, "prefill": min(prefill_seconds), "decode": min(decode_seconds)}, f)
+
+
+def main(world_sizes=(1, 2, 4), num_text_layers: int = 4, num_vision_layers: int = 2, text_len: int = 16, max_new_tokens: int = 8,
+         iters: int = 3):
+    torch.manual_seed(0)
+    model = build_model(num_text_layers=num_text_layers, num_vision_layers=num_vision_layers, vocab_size=32000).eval()
+    model.config.image_token_index = model.config.vocab_size - 1
+    config = model.config
+    batch = dummy_batch(config, 1, text_len)
+    reference = generate(model, batch["input_ids"], batch["attention_mask"], pixel_values=batch["pixel_values"], max_new_tokens=max_new_tokens)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Every parameter and buffer, the ranks build the model on the meta device
+        weights_path = os.path.join(tmp_dir, "weights.pt")
+        tensors = {name: param.detach() for name, param in model.named_parameters(remove_duplicate=False)}
+        tensors.update(dict(model.named_buffers(remove_duplicate=False)))
+        torch.save(tensors, weights_path)
+        del model, tensors
+
+        result_path = os.path.join(tmp_dir, "result.pkl")
+        for world_size in ([world_sizes] if isinstance(world_sizes, int) else world_sizes):
+            launch(run_rank, world_size, config, weights_path, batch, max_new_tokens, iters, result_path, master_port=29500 + world_size)
+            with open(result_path, "rb") as f:
+                result = pickle.load(f)
+            decode_ms = result["decode"] * 1000
+            if not rows:
+                base_prefill, base_decode = result["prefill"] * 1000, decode_ms
+            rows.append([str(world_size), f"{result['prefill'] * 1000:.1f}", f"{base_prefill / (result['prefill'] * 1000):.2f}x",
+                         f"{decode_ms:.1f}", f"{base_decode / decode_ms:.2f}x", str(result["generated"] == reference)])
+
+    print(f"batch size 1, {text_len} text tokens, {max_new_tokens} new tokens, {num_vision_layers} vision + {num_text_layers} text "
+          f"layers, {len(os.sched_getaffinity(0))} cores")
+    print_table(["ranks", "prefill (ms)", "speedup", "decode (ms/token)", "speedup", "same tokens"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
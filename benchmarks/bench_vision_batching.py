@@ -0,0 +1,66 @@
+# Throughput and latency of single-image vision requests arriving at random (Poisson) times, encoded one by one
+# (max_batch_size=1) vs micro-batched by vision_batcher.VisionBatcher. Arrival rates are multiples of the
+# batch-1 capacity measured first.
+# Run from the repository root: python -m benchmarks.bench_vision_batching
+import asyncio
+import random
+import statistics
+import time
+
+import fire
+import torch
+
+from benchmarks.common import build_model, print_table, time_fn
+from vision_batcher import VisionBatcher
+
+LOAD_FACTORS = [0.25, 0.5, 1.0, 2.0, 4.0]
+
+
+async def serve(model, images, arrival_rate, max_batch_size, max_wait_ms, seed=0):
+    rng = random.Random(seed)
+    latencies = []
+    async with VisionBatcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms) as batcher:
+        async def request(image):
+            start = time.perf_counter()
+            await batcher.encode(image)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        tasks = []
+        for image in images:
+            tasks.append(asyncio.create_task(request(image)))
+            await asyncio.sleep(rng.expovariate(arrival_rate))
+        await asyncio.gather(*tasks)
+        seconds = time.perf_counter() - start
+        mean_batch_size = batcher.mean_batch_size()
+    return len(images) / seconds, latencies, mean_batch_size
+
+
+def main(num_requests: int = 64, num_vision_layers: int = 4, max_batch_size: int = 8, max_wait_ms: float = 5.0,
+         load_factors=tuple(LOAD_FACTORS)):
+    torch.manual_seed(0)
+    model = build_model(num_text_layers=1, num_vision_layers=num_vision_layers, vocab_size=32000).eval()
+    image_size = model.config.vision_config.image_size
+    images = torch.randn(num_requests, 3, image_size, image_size)
+
+    with torch.no_grad():
+        batch_1 = time_fn(lambda: model.multi_modal_projector(model.vision_tower(images[:1])), warmup=1, iters=3)
+        batched = time_fn(lambda: model.multi_modal_projector(model.vision_tower(images[:max_batch_size])), warmup=1, iters=3)
+    capacity = 1 / batch_1
+    print(f"encode: {capacity:.1f} images/s at batch 1, {max_batch_size / batched:.1f} images/s at batch {max_batch_size}")
+
+    rows = []
+    for load_factor in load_factors:
+        arrival_rate = load_factor * capacity
+        for name, batch_size in (("batch 1", 1), (f"micro-batch <= {max_batch_size}", max_batch_size)):
+            throughput, latencies, mean_batch_size = asyncio.run(serve(model, images, arrival_rate, batch_size, max_wait_ms))
+            latencies = sorted(latencies)
+            rows.append([f"{arrival_rate:.1f}", name, f"{throughput:.1f}", f"{statistics.median(latencies) * 1000:.0f}",
+                         f"{latencies[int(0.95 * (len(latencies) - 1))] * 1000:.0f}", f"{mean_batch_size:.1f}"])
+
+    print(f"{num_requests} requests, {num_vision_layers} vision layers, max_wait_ms={max_wait_ms}")
+    print_table(["arrivals/s", "mode", "images/s", "p50 latency (ms)", "p95 latency (ms)", "mean batch"], rows)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
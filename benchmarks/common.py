@@ -0,0 +1,95 @@
+import time
+
+import torch
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def time_fn(fn, device="cpu", warmup=2, iters=10):
+    """Mean wall time of fn() in seconds."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    print(" | ".join(str(x).ljust(w) for x, w in zip(header, widths)))
+    print("-+-".join("-" * w for w in widths))
+    for row in rows:
+        print(" | ".join(str(x).ljust(w) for x, w in zip(row, widths)))
+
+
+def _proc_status_mb(key):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key):
+                return int(line.split()[1]) / 1024
+    raise KeyError(key)
+
+
+def peak_memory_mb(fn, device="cpu"):
+    """Run fn() and return its peak memory above the memory in use before the call, in MiB."""
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - before) / 2**20
+    # On CPU use the resident set size. Writing 5 to clear_refs resets the high water mark (Linux >= 4.0)
+    before = _proc_status_mb("VmRSS:")
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    fn()
+    return _proc_status_mb("VmHWM:") - before
+
+
+def build_config(num_text_layers=None, num_vision_layers=None, **text_config):
+    """The default (3B) PaliGemma configuration, optionally with fewer layers."""
+    from modeling_gemma import GemmaConfig, PaliGemmaConfig
+    from modeling_siglip import SiglipVisionConfig
+
+    vision_config = SiglipVisionConfig()
+    if num_vision_layers is not None:
+        vision_config.num_hidden_layers = num_vision_layers
+    text_config = GemmaConfig(**text_config)
+    if num_text_layers is not None:
+        text_config.num_hidden_layers = num_text_layers
+    return PaliGemmaConfig(vision_config=vision_config, text_config=text_config, vocab_size=text_config.vocab_size)
+
+
+def build_model(num_text_layers=None, num_vision_layers=None, dtype=torch.float32, device="cpu", **text_config):
+    """
+    Randomly initialized PaliGemma with the default (3B) configuration, optionally with fewer layers.
+    Speed and memory don't depend on the weight values, so benchmarks don't need the checkpoint.
+    """
+    from modeling_gemma import PaliGemmaForConditionalGeneration
+
+    config = build_config(num_text_layers, num_vision_layers, **text_config)
+    model = PaliGemmaForConditionalGeneration(config).to(device=device, dtype=dtype)
+    model.tie_weights()
+    return model
+
+
+def dummy_batch(config, batch_size, text_len, device="cpu"):
+    """Image tokens followed by `text_len` random text tokens, labels on the text part."""
+    num_image_tokens = config.num_image_tokens
+    input_ids = torch.randint(2, 1000, (batch_size, num_image_tokens + text_len), device=device)
+    input_ids[:, :num_image_tokens] = config.image_token_index
+    labels = input_ids.masked_fill(input_ids == config.image_token_index, -100)
+    image_size = config.vision_config.image_size
+    return {
+        "input_ids": input_ids,
+        "pixel_values": torch.randn(batch_size, 3, image_size, image_size, device=device),
+        "attention_mask": torch.ones_like(input_ids),
+        "labels": labels,
+    }
@@ -0,0 +1,130 @@
+import time
+from typing import List, Optional
+
+import torch
+from torch.utils.data import Sampler
+from transformers import Trainer, TrainerCallback
+
+from utils import build_prompt_strings
+
+
+def compute_lengths(dataset, processor, question_column="question", answer_column="multiple_choice_answer",
+                    chunk_size=10000) -> List[int]:
+    """Tokenized length (image tokens included) of every "answer <question>" + answer training example."""
+    # Only touch the text columns so no image gets decoded
+    dataset = dataset.select_columns([question_column, answer_column])
+    lengths = []
+    for start in range(0, len(dataset), chunk_size):
+        chunk = dataset[start:start + chunk_size]
+        texts = ["answer " + question for question in chunk[question_column]]
+        input_strings, suffix = build_prompt_strings(processor, texts, suffix=chunk[answer_column])
+        input_ids = processor.tokenizer(input_strings, text_pair=suffix)["input_ids"]
+        lengths.extend(len(ids) for ids in input_ids)
+    return lengths
+
+
+def padding_efficiency(lengths: List[int], indices: List[int], batch_size: int) -> float:
+    """Fraction of the tokens in `padding="longest"` batches that are real tokens."""
+    real_tokens, padded_tokens = 0, 0
+    for start in range(0, len(indices), batch_size):
+        batch_lengths = [lengths[i] for i in indices[start:start + batch_size]]
+        real_tokens += sum(batch_lengths)
+        padded_tokens += max(batch_lengths) * len(batch_lengths)
+    return real_tokens / padded_tokens if padded_tokens > 0 else 1.0
+
+
+class BucketSampler(Sampler):
+    """
+    Yields indices so that every consecutive `batch_size` chunk holds examples of similar length.
+
+    Each epoch the dataset is shuffled and cut into buckets of `batch_size * bucket_size_multiplier`
+    examples. Every bucket is sorted by length and split into batches, and finally the batches of all
+    buckets are shuffled, so the batch order stays random while padding inside a batch is small.
+    """
+
+    def __init__(self, lengths: List[int], batch_size: int, bucket_size_multiplier: int = 50, seed: int = 0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def batches(self) -> List[List[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        # Keep the one possibly incomplete batch last so it doesn't shift the batch boundaries of the others
+        last = batches.pop() if len(batches[-1]) < self.batch_size else None
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if last is not None:
+            batches.append(last)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        # Advance the epoch ourselves in case nobody calls set_epoch, a later set_epoch still takes precedence
+        self.epoch += 1
+        for batch in batches:
+            yield from batch
+
+
+class BucketingTrainer(Trainer):
+    """Trainer that groups the training examples by length when `train_lengths` is given."""
+
+    def __init__(self, *args, train_lengths: Optional[List[int]] = None, bucket_size_multiplier: int = 50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_lengths = train_lengths
+        self.bucket_size_multiplier = bucket_size_multiplier
+
+    def _get_train_sampler(self):
+        if self.train_lengths is None:
+            return super()._get_train_sampler()
+        return BucketSampler(
+            self.train_lengths,
+            batch_size=self.args.per_device_train_batch_size,
+            bucket_size_multiplier=self.bucket_size_multiplier,
+            seed=self.args.seed,
+        )
+
+
+class StepTimeCallback(TrainerCallback):
+    """Measures the wall time of every optimizer step and reports the average."""
+
+    def __init__(self, warmup_steps: int = 5):
+        self.warmup_steps = warmup_steps
+        self.step_times = []
+        self._step_start = None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._step_start is not None and state.global_step > self.warmup_steps:
+            self.step_times.append(time.perf_counter() - self._step_start)
+
+    def mean_step_time(self) -> float:
+        return sum(self.step_times) / len(self.step_times) if self.step_times else float("nan")
+
+    def on_train_end(self, args, state, control, **kwargs):
+        print(f"Mean step time over {len(self.step_times)} steps: {self.mean_step_time():.3f}s")
+
+
+def report_padding_efficiency(lengths: List[int], batch_size: int, bucket_size_multiplier: int = 50, seed: int = 0):
+    random_order = torch.randperm(len(lengths), generator=torch.Generator().manual_seed(seed)).tolist()
+    bucketed_order = list(BucketSampler(lengths, batch_size, bucket_size_multiplier, seed))
+    random_efficiency = padding_efficiency(lengths, random_order, batch_size)
+    bucketed_efficiency = padding_efficiency(lengths, bucketed_order, batch_size)
+    print(f"Padding efficiency at batch size {batch_size}: random {random_efficiency:.1%}, bucketed {bucketed_efficiency:.1%}")
+    return random_efficiency, bucketed_efficiency
@@ -0,0 +1,236 @@
+import copy
+import glob
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import TrainerCallback
+from transformers.trainer import OPTIMIZER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME
+
+# Not part of the pretrained checkpoint, so always saved even if they happen to be frozen
+DIFF_ATTENTION_KEYWORDS = ["lambda_q1", "lambda_k1", "lambda_q2", "lambda_k2", "subln"]
+
+CHECKPOINT_PATTERN = re.compile(r"^trainable-(\d+)\.safetensors$")
+RNG_STATE_NAME = "rng_state.pth"
+
+
+def trainable_state_dict(model, keywords=DIFF_ATTENTION_KEYWORDS) -> Dict[str, torch.Tensor]:
+    # Detached CPU copies, so training can keep updating the parameters while they are written
+    return {
+        name: param.detach().to("cpu", copy=True)
+        for name, param in model.named_parameters()
+        if param.requires_grad or any(keyword in name for keyword in keywords)
+    }
+
+
+def _to_cpu(obj):
+    # Detached CPU copies of the tensors in a (nested) state dict
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def training_state(optimizer, lr_scheduler, state) -> dict:
+    """
+    Snapshot of what Trainer needs to continue where it stopped: the optimizer and LR scheduler state, the
+    TrainerState (global step, epoch, log history) and the RNG states, laid out like Trainer's own checkpoints.
+    """
+    rng_state = {"python": random.getstate(), "numpy": np.random.get_state(), "cpu": torch.random.get_rng_state()}
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.random.get_rng_state()
+    return {
+        OPTIMIZER_NAME: _to_cpu(optimizer.state_dict()),
+        SCHEDULER_NAME: lr_scheduler.state_dict(),
+        TRAINER_STATE_NAME: copy.deepcopy(state),
+        RNG_STATE_NAME: rng_state,
+    }
+
+
+def training_state_dir(checkpoint_path: str) -> str:
+    # trainable-<step>.safetensors -> trainable-<step>/
+    return checkpoint_path[:-len(".safetensors")]
+
+
+def list_checkpoints(checkpoint_dir: str):
+    # [(step, path)] sorted by step
+    checkpoints = []
+    for path in glob.glob(os.path.join(checkpoint_dir, "trainable-*.safetensors")):
+        match = CHECKPOINT_PATTERN.match(os.path.basename(path))
+        if match:
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes trainable-only checkpoints as safetensors files from a background thread, each with a training
+    state directory next to it (trainable-<step>/, see training_state) when one is given.
+
+    Only the snapshot (a CPU copy of the trainable tensors) happens on the caller's thread. Files are
+    written under a temporary name and renamed once complete, so a crash never leaves a truncated
+    checkpoint behind, and only the newest `max_to_keep` checkpoints are kept.
+    """
+
+    def __init__(self, checkpoint_dir: str, max_to_keep: int = 3, max_pending: int = 2):
+        self.checkpoint_dir = checkpoint_dir
+        self.max_to_keep = max_to_keep
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # Bounded, so a slow disk blocks training instead of piling up snapshots in memory
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def save(self, model, step: int, state: Optional[dict] = None):
+        self._raise_error()
+        self._queue.put((step, trainable_state_dict(model), state))
+
+    def wait(self):
+        # Block until every queued checkpoint is on disk
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self._error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, step: int, tensors: Dict[str, torch.Tensor], state: Optional[dict] = None):
+        path = os.path.join(self.checkpoint_dir, f"trainable-{step:08d}.safetensors")
+        if state is not None:
+            # Before the tensors, a checkpoint is only listed once both are complete
+            state_dir = training_state_dir(path)
+            tmp_dir = os.path.join(self.checkpoint_dir, f".trainable-{step:08d}.tmp")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            for name, value in state.items():
+                if name == TRAINER_STATE_NAME:
+                    value.save_to_json(os.path.join(tmp_dir, name))
+                else:
+                    torch.save(value, os.path.join(tmp_dir, name))
+            shutil.rmtree(state_dir, ignore_errors=True)
+            os.replace(tmp_dir, state_dir)
+        tmp_path = os.path.join(self.checkpoint_dir, f".trainable-{step:08d}.safetensors.tmp")
+        save_file(tensors, tmp_path, metadata={"step": str(step)})
+        os.replace(tmp_path, path)
+        print(f"Saved {len(tensors)} trainable tensors at step {step} to {path}")
+
+        for _, old_path in list_checkpoints(self.checkpoint_dir)[:-self.max_to_keep]:
+            os.remove(old_path)
+            shutil.rmtree(training_state_dir(old_path), ignore_errors=True)
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    # Replaces Trainer's own (full model) checkpoints, use with save_strategy="no" and a TrainableCheckpointMixin
+    # trainer to resume
+    def __init__(self, checkpoint_dir: str, save_steps: int = 500, max_to_keep: int = 3):
+        self.save_steps = save_steps
+        self.writer = AsyncCheckpointWriter(checkpoint_dir, max_to_keep=max_to_keep)
+
+    def _save(self, state, **kwargs):
+        self.writer.save(kwargs["model"], state.global_step, training_state(kwargs["optimizer"], kwargs["lr_scheduler"], state))
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step % self.save_steps == 0:
+            self._save(state, **kwargs)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if state.global_step % self.save_steps != 0:
+            self._save(state, **kwargs)
+        self.writer.close()
+
+
+def load_trainable_checkpoint(model, path: str) -> Optional[int]:
+    """
+    Load a checkpoint written by AsyncCheckpointWriter into `model` and return its step. `path` is either
+    a checkpoint file or a checkpoint directory, in which case the newest checkpoint is used. Returns None
+    if the directory holds no checkpoint yet.
+    """
+    if os.path.isdir(path):
+        checkpoints = list_checkpoints(path)
+        if not checkpoints:
+            print(f"No checkpoint found in {path}")
+            return None
+        path = checkpoints[-1][1]
+
+    with safe_open(path, framework="pt", device="cpu") as f:
+        step = int(f.metadata()["step"])
+        tensors = {key: f.get_tensor(key) for key in f.keys()}
+
+    missing_keys, unexpected_keys = model.load_state_dict(tensors, strict=False)
+    if unexpected_keys:
+        raise ValueError(f"Checkpoint {path} doesn't match the model, unexpected keys: {unexpected_keys[:5]}")
+    print(f"Resumed {len(tensors)} trainable tensors from step {step} ({path})")
+    return step
+
+
+def latest_training_state(checkpoint_dir: str) -> Optional[str]:
+    """
+    Training state directory of the newest checkpoint in `checkpoint_dir`, for
+    trainer.train(resume_from_checkpoint=...) with a TrainableCheckpointMixin trainer. None if there is none yet.
+    A Trainer checkpoint directory (checkpoint-<step>/ of save_strategy="steps") is returned as is.
+    """
+    if os.path.isfile(os.path.join(checkpoint_dir, TRAINER_STATE_NAME)):
+        return checkpoint_dir
+    for _, path in reversed(list_checkpoints(checkpoint_dir)):
+        if os.path.isfile(os.path.join(training_state_dir(path), TRAINER_STATE_NAME)):
+            return training_state_dir(path)
+    print(f"No checkpoint to resume from in {checkpoint_dir}")
+    return None
+
+
+class TrainableCheckpointMixin:
+    """
+    Trainer mixin (put it before the Trainer class) that resumes from an AsyncCheckpointCallback checkpoint:
+    with resume_from_checkpoint=latest_training_state(checkpoint_dir) the trainable tensors are loaded from the
+    checkpoint, and Trainer restores the optimizer, the LR schedule, the RNG states and the global step (skipping
+    the batches already trained on) from the training state directory.
+    """
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        path = os.path.normpath(resume_from_checkpoint) + ".safetensors"
+        if not os.path.isfile(path):
+            # A Trainer checkpoint, see latest_training_state
+            return super()._load_from_checkpoint(resume_from_checkpoint, model)
+        load_trainable_checkpoint(self.model if model is None else model, path)
+
+    def _load_rng_state(self, checkpoint):
+        # Trainer's own torch.load can't read the numpy state with weights_only, the default of newer torch
+        rng_file = os.path.join(checkpoint, RNG_STATE_NAME)
+        if not os.path.isfile(rng_file):
+            return
+        rng_state = torch.load(rng_file, weights_only=False)
+        random.setstate(rng_state["python"])
+        np.random.set_state(rng_state["numpy"])
+        torch.random.set_rng_state(rng_state["cpu"])
+        if "cuda" in rng_state and torch.cuda.is_available():
+            torch.cuda.random.set_rng_state(rng_state["cuda"])
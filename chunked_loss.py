@@ -0,0 +1,77 @@
+from typing import Optional
+
+import torch
+
+# Positions per chunk, the largest temporary is [Chunk_Size, Vocab_Size] float32 (1 GiB for 1024 x 257216)
+LOSS_CHUNK_SIZE = 1024
+
+
+class LinearCrossEntropyFunction(torch.autograd.Function):
+    """
+    Mean cross-entropy of (hidden_states @ weight^T) against targets, a chunk of rows at a time. Only the
+    inputs and every row's log-sum-exp are saved, the logits of each chunk are recomputed in backward, so the
+    [Num_Rows, Vocab_Size] logits never exist as a whole. Logits are computed in the weight's dtype and then
+    upcast to float32 (float64 stays float64), like GemmaForCausalLM.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, targets, chunk_size):
+        num_rows = hidden_states.shape[0]
+        dtype = torch.promote_types(weight.dtype, torch.float32)
+        lse = torch.empty(num_rows, dtype=dtype, device=hidden_states.device)
+        target_logits = torch.empty_like(lse)
+        for start in range(0, num_rows, chunk_size):
+            end = min(start + chunk_size, num_rows)
+            # [Chunk_Size, Vocab_Size]
+            logits = (hidden_states[start:end] @ weight.t()).to(dtype)
+            lse[start:end] = torch.logsumexp(logits, dim=-1)
+            target_logits[start:end] = logits.gather(-1, targets[start:end, None]).squeeze(-1)
+
+        ctx.save_for_backward(hidden_states, weight, targets, lse)
+        ctx.chunk_size = chunk_size
+        # Mean over the rows like CrossEntropyLoss, nan if there are none
+        return (lse - target_logits).sum() / num_rows
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden_states, weight, targets, lse = ctx.saved_tensors
+        num_rows = hidden_states.shape[0]
+        scale = grad_output.to(lse.dtype) / num_rows
+        grad_hidden = torch.empty_like(hidden_states) if ctx.needs_input_grad[0] else None
+        # The lm_head is tied to the (frozen) embeddings when finetuning with LoRA, then this is skipped
+        grad_weight = torch.zeros_like(weight, dtype=lse.dtype) if ctx.needs_input_grad[1] else None
+        for start in range(0, num_rows, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, num_rows)
+            hidden_chunk = hidden_states[start:end]
+            # d loss / d logits = (softmax(logits) - one_hot(target)) / Num_Rows
+            grad_logits = (hidden_chunk @ weight.t()).to(lse.dtype).sub_(lse[start:end, None]).exp_()
+            grad_logits[torch.arange(end - start, device=grad_logits.device), targets[start:end]] -= 1
+            grad_logits.mul_(scale)
+            if grad_hidden is not None:
+                grad_hidden[start:end] = (grad_logits.to(weight.dtype) @ weight).to(hidden_states.dtype)
+            if grad_weight is not None:
+                grad_weight.addmm_(grad_logits.t(), hidden_chunk.to(lse.dtype))
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden, grad_weight, None, None
+
+
+def chunked_causal_lm_loss(
+    hidden_states: torch.Tensor,
+    weight: torch.Tensor,
+    labels: torch.Tensor,
+    ignore_index: int = -100,
+    chunk_size: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Next-token cross-entropy of the lm_head `weight` on `hidden_states` [Batch_Size, Seq_Len, Hidden_Size],
+    the same value as CrossEntropyLoss on the shifted full logits. Only the positions with a label other
+    than `ignore_index` are projected, in chunks of `chunk_size`, and the logits are recomputed in backward.
+    """
+    # Position i predicts label i + 1
+    shift_labels = labels[:, 1:]
+    supervised = shift_labels != ignore_index
+    # [Num_Supervised, Hidden_Size] and [Num_Supervised]
+    selected_hidden = hidden_states[:, :-1][supervised]
+    targets = shift_labels[supervised]
+    return LinearCrossEntropyFunction.apply(selected_hidden, weight, targets, chunk_size or LOSS_CHUNK_SIZE)
@@ -0,0 +1,151 @@
+from typing import Optional
+
+import torch
+
+# Query positions per block, the largest temporary is [Batch_Size, Num_Heads, Block_Size, KV_Len]
+ATTENTION_BLOCK_SIZE = 128
+
+
+def _block_maps(q, k, mask, lse, scale, groups, start, end):
+    """
+    Softmax maps of the queries start:end. q: [Batch_Size, Num_Heads, Groups * Q_Len, Head_Dim] (the query heads
+    sharing a KV head folded into the sequence, see GemmaAttention), k: [Batch_Size, Num_Heads, KV_Len, Head_Dim],
+    mask: additive [Batch_Size, 1, Q_Len, KV_Len]. Returns the maps [Batch_Size, Num_Heads, Groups, Block, KV_Len]
+    and their log-sum-exp [Batch_Size, Num_Heads, Groups, Block], recomputing the maps from `lse` if it is given.
+    """
+    batch_size, num_heads, rows, head_dim = q.shape
+    compute_dtype = torch.promote_types(q.dtype, torch.float32)
+    # [Batch_Size, Num_Heads, Groups * Block, Head_Dim]
+    q_block = q.view(batch_size, num_heads, groups, rows // groups, head_dim)[:, :, :, start:end]
+    q_block = q_block.reshape(batch_size, num_heads, -1, head_dim)
+    scores = torch.nan_to_num(torch.matmul(q_block, k.transpose(2, 3)) * scale)
+    scores = scores.view(batch_size, num_heads, groups, end - start, -1).to(compute_dtype)
+    if mask is not None:
+        # [Batch_Size, 1, Block, KV_Len] -> [Batch_Size, 1, 1, Block, KV_Len]
+        scores = scores + mask[:, :, start:end].unsqueeze(2)
+    if lse is None:
+        lse = torch.logsumexp(scores, dim=-1)
+    return scores.sub_(lse.unsqueeze(-1)).exp_(), lse
+
+
+def _forward_blocks(q1, k1, q2, k2, v, mask, lambda_full, scale, groups, block_size):
+    # The differential attention output and the log-sum-exp of both maps, a block of queries at a time
+    batch_size, num_heads, rows, _ = q1.shape
+    q_len = rows // groups
+    lambda_5d = lambda_full.view(-1, 1, 1, 1, 1) if lambda_full.dim() > 0 else lambda_full
+    two_maps = q2 is not None
+
+    output = v.new_empty(batch_size, num_heads, rows, v.shape[-1])
+    output_5d = output.view(batch_size, num_heads, groups, q_len, -1)
+    compute_dtype = torch.promote_types(q1.dtype, torch.float32)
+    lse1 = torch.empty(batch_size, num_heads, groups, q_len, dtype=compute_dtype, device=q1.device)
+    lse2 = torch.empty_like(lse1) if two_maps else None
+    for start in range(0, q_len, block_size):
+        end = min(start + block_size, q_len)
+        p1, lse1[..., start:end] = _block_maps(q1, k1, mask, None, scale, groups, start, end)
+        p1 = p1.type_as(q1)
+        if two_maps:
+            p2, lse2[..., start:end] = _block_maps(q2, k2, mask, None, scale, groups, start, end)
+            p2 = p2.type_as(q1)
+        else:
+            p2 = p1
+        attn_weights = (p1 - lambda_5d * p2).view(batch_size, num_heads, -1, p1.shape[-1])
+        output_5d[:, :, :, start:end] = torch.matmul(attn_weights, v).view(batch_size, num_heads, groups, end - start, -1)
+    return output, lse1, lse2
+
+
+class DifferentialAttentionFunction(torch.autograd.Function):
+    """
+    softmax(q1 k1^T * scale + mask) - lambda * softmax(q2 k2^T * scale + mask), times v, computed a block of
+    queries at a time. Only q, k, v, the mask and the log-sum-exp of every row are saved: the maps are
+    recomputed block by block in backward instead of autograd keeping the scores, both softmax maps and
+    their difference ([Batch_Size, Num_Heads, Q_Len, KV_Len] each) for every layer.
+
+    Without q2/k2 the single map is used twice, i.e. (1 - lambda) * softmax(q1 k1^T * scale + mask), like
+    GemmaAttention. `lambda_full` is a scalar or [Batch_Size, 1, 1, 1] and gets its gradient, so it flows on
+    into lambda_q1/k1/q2/k2.
+    """
+
+    @staticmethod
+    def forward(ctx, q1, k1, q2, k2, v, mask, lambda_full, scale, groups, block_size):
+        output, lse1, lse2 = _forward_blocks(q1, k1, q2, k2, v, mask, lambda_full, scale, groups, block_size)
+        ctx.save_for_backward(q1, k1, q2, k2, v, mask, lambda_full, lse1, lse2)
+        ctx.scale, ctx.groups, ctx.block_size = scale, groups, block_size
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        q1, k1, q2, k2, v, mask, lambda_full, lse1, lse2 = ctx.saved_tensors
+        scale, groups, block_size = ctx.scale, ctx.groups, ctx.block_size
+        two_maps = q2 is not None
+        batch_size, num_heads, rows, head_dim = q1.shape
+        q_len = rows // groups
+        dtype = lse1.dtype
+        lambda_5d = lambda_full.to(dtype).view(-1, 1, 1, 1, 1) if lambda_full.dim() > 0 else lambda_full.to(dtype)
+
+        q1f, k1f, vf = q1.to(dtype), k1.to(dtype), v.to(dtype)
+        q2f, k2f = (q2.to(dtype), k2.to(dtype)) if two_maps else (None, None)
+        grad_output_5d = grad_output.to(dtype).view(batch_size, num_heads, groups, q_len, -1)
+        grad_q1, grad_k1, grad_v = torch.zeros_like(q1f), torch.zeros_like(k1f), torch.zeros_like(vf)
+        grad_q2, grad_k2 = (torch.zeros_like(q2f), torch.zeros_like(k2f)) if two_maps else (None, None)
+        grad_lambda = torch.zeros(lambda_5d.shape, dtype=dtype, device=q1.device)
+
+        def accumulate(p, grad_p, q, k, grad_q, grad_k, start, end):
+            # Softmax backward: dS = P * (dP - rowsum(dP * P)), then S = q k^T * scale
+            grad_scores = p * (grad_p - (grad_p * p).sum(-1, keepdim=True))
+            grad_scores = grad_scores.view(batch_size, num_heads, -1, grad_scores.shape[-1]) * scale
+            q_block = q.view(batch_size, num_heads, groups, q_len, head_dim)[:, :, :, start:end].reshape(batch_size, num_heads, -1, head_dim)
+            grad_q_block = torch.matmul(grad_scores, k).view(batch_size, num_heads, groups, end - start, head_dim)
+            grad_q.view(batch_size, num_heads, groups, q_len, head_dim)[:, :, :, start:end] = grad_q_block
+            grad_k += torch.matmul(grad_scores.transpose(2, 3), q_block)
+
+        for start in range(0, q_len, block_size):
+            end = min(start + block_size, q_len)
+            p1, _ = _block_maps(q1f, k1f, mask, lse1[..., start:end], scale, groups, start, end)
+            p2 = _block_maps(q2f, k2f, mask, lse2[..., start:end], scale, groups, start, end)[0] if two_maps else p1
+
+            # [Batch_Size, Num_Heads, Groups * Block, Head_Dim]
+            grad_output_block = grad_output_5d[:, :, :, start:end].reshape(batch_size, num_heads, -1, grad_output_5d.shape[-1])
+            attn_weights = (p1 - lambda_5d * p2).view(batch_size, num_heads, -1, p1.shape[-1])
+            grad_v += torch.matmul(attn_weights.transpose(2, 3), grad_output_block)
+            # [Batch_Size, Num_Heads, Groups, Block, KV_Len]
+            grad_attn = torch.matmul(grad_output_block, vf.transpose(2, 3)).view_as(p1)
+            grad_lambda -= (grad_attn * p2).sum(dim=(1, 2, 3, 4), keepdim=True).sum_to_size(lambda_5d.shape)
+
+            if two_maps:
+                accumulate(p1, grad_attn, q1f, k1f, grad_q1, grad_k1, start, end)
+                accumulate(p2, -lambda_5d * grad_attn, q2f, k2f, grad_q2, grad_k2, start, end)
+            else:
+                accumulate(p1, grad_attn * (1 - lambda_5d), q1f, k1f, grad_q1, grad_k1, start, end)
+
+        grad_q1, grad_k1, grad_v = grad_q1.type_as(q1), grad_k1.type_as(k1), grad_v.type_as(v)
+        if two_maps:
+            grad_q2, grad_k2 = grad_q2.type_as(q2), grad_k2.type_as(k2)
+        grad_lambda = grad_lambda.reshape(lambda_full.shape).type_as(lambda_full)
+        return grad_q1, grad_k1, grad_q2, grad_k2, grad_v, None, grad_lambda, None, None, None
+
+
+def differential_attention(
+    q1: torch.Tensor,
+    k1: torch.Tensor,
+    v: torch.Tensor,
+    attention_mask: Optional[torch.Tensor],
+    lambda_full: torch.Tensor,
+    scale: float,
+    q2: Optional[torch.Tensor] = None,
+    k2: Optional[torch.Tensor] = None,
+    groups: int = 1,
+    block_size: int = ATTENTION_BLOCK_SIZE,
+) -> torch.Tensor:
+    """
+    Differential attention output [Batch_Size, Num_Heads, Groups * Q_Len, V_Dim] that saves only q, k, v and the
+    log-sum-exp for backward, see DifferentialAttentionFunction. `groups` query heads share each KV head and
+    are folded into the sequence dimension of q.
+    """
+    if not torch.is_tensor(lambda_full):
+        lambda_full = torch.tensor(lambda_full, dtype=q1.dtype, device=q1.device)
+    # torch.compiler.is_exporting is missing before torch 2.4 (requirements.txt pins 2.3.0)
+    if torch.jit.is_tracing() or getattr(torch.compiler, "is_exporting", lambda: False)():
+        # Exported graphs can't hold a Python autograd.Function, the forward is plain tensor ops (see export.py)
+        return _forward_blocks(q1, k1, q2, k2, v, attention_mask, lambda_full, scale, groups, block_size)[0]
+    return DifferentialAttentionFunction.apply(q1, k1, q2, k2, v, attention_mask, lambda_full, scale, groups, block_size)
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import random
+import string
+
+from PIL import Image
+
+# One single-token answer label per grid cell, so grids up to 5x5
+CELL_LABELS = list(string.ascii_uppercase)
+
+
+def cell_labels(grid_size):
+    num_cells = grid_size * grid_size
+    if num_cells > len(CELL_LABELS):
+        raise ValueError(f"Grid size {grid_size} has more cells than answer labels ({len(CELL_LABELS)})")
+    return CELL_LABELS[:num_cells]
+
+
+def build_question(caption, grid_size):
+    # Same wording as the Top/Bottom prompts in main.py, with one letter per cell
+    labels = cell_labels(grid_size)
+    return (f"Where is the caption. The images are labeled {labels[0]} to {labels[-1]} from left to right, top to bottom. "
+            f"The answers are: {', '.join(labels[:-1])} or {labels[-1]}. Caption: {caption}")
+
+
+def stitch_grid(images, grid_size, cell_size=224):
+    # Row-major grid_size x grid_size grid, every image resized to one cell
+    canvas = Image.new("RGB", (grid_size * cell_size, grid_size * cell_size))
+    for i, image in enumerate(images):
+        row, col = divmod(i, grid_size)
+        cell = image.convert("RGB").resize((cell_size, cell_size), Image.Resampling.BICUBIC)
+        canvas.paste(cell, (col * cell_size, row * cell_size))
+    return canvas
+
+
+def haystack_key(spec):
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def generate_haystacks(pool, cache_dir, grid_size, needle_position, num_samples=10, seed=0, cell_size=224,
+                       image_column="image", caption_column="caption", pool_name=None):
+    """
+    Build (or load from `cache_dir`) `num_samples` haystacks of `grid_size` x `grid_size` distinct images
+    from `pool`, with the needle, the image the question's caption belongs to, at cell `needle_position`.
+
+    Every haystack is saved as a PNG next to a JSON record, both named after a hash of everything that
+    determines the haystack, so re-running a sweep only generates the haystacks that are missing.
+    Returns the records: {"key", "path", "caption", "question", "answer", "grid_size", "needle_position", ...}.
+    """
+    num_cells = grid_size * grid_size
+    if not 0 <= needle_position < num_cells:
+        raise ValueError(f"Needle position {needle_position} is outside a {grid_size}x{grid_size} grid")
+    if num_cells > len(pool):
+        raise ValueError(f"A {grid_size}x{grid_size} grid needs {num_cells} images but the pool has {len(pool)}")
+
+    haystack_dir = os.path.join(cache_dir, "haystacks")
+    os.makedirs(haystack_dir, exist_ok=True)
+
+    records = []
+    for sample in range(num_samples):
+        spec = {
+            "pool": pool_name, "pool_size": len(pool), "grid_size": grid_size, "needle_position": needle_position,
+            "sample": sample, "seed": seed, "cell_size": cell_size,
+        }
+        key = haystack_key(spec)
+        path = os.path.join(haystack_dir, f"{key}.png")
+        record_path = os.path.join(haystack_dir, f"{key}.json")
+
+        if os.path.isfile(path) and os.path.isfile(record_path):
+            with open(record_path, "r") as f:
+                records.append(json.load(f))
+            continue
+
+        # Seeded by the spec, so the same haystack is rebuilt if the cache is deleted
+        rng = random.Random(key)
+        indices = rng.sample(range(len(pool)), num_cells)
+        needle_index = indices[needle_position]
+        caption = pool[needle_index][caption_column]
+        # Datasets like Flickr30k/COCO have several captions per image
+        if isinstance(caption, (list, tuple)):
+            caption = rng.choice(caption)
+
+        images = [pool[i][image_column] for i in indices]
+        # Write under a temporary name first, the record is only published once the image exists
+        tmp_path = os.path.join(haystack_dir, f".{key}.png.tmp")
+        stitch_grid(images, grid_size, cell_size).save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+
+        record = dict(
+            spec, key=key, path=path, pool_indices=indices, caption=caption,
+            question=build_question(caption, grid_size), answer=cell_labels(grid_size)[needle_position],
+        )
+        with open(record_path, "w") as f:
+            json.dump(record, f, indent=4)
+        records.append(record)
+    return records
+
+
+class HaystackImages:
+    """Minimal dataset view over haystack records, in the `dataset[start:end]["image"]` form build_feature_store reads."""
+
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        records = self.records[index] if isinstance(index, slice) else [self.records[index]]
+        return {"image": [Image.open(record["path"]) for record in records]}
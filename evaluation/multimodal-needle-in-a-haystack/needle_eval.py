@@ -0,0 +1,227 @@
+import csv
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+
+import torch
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from feature_store import build_feature_store, encoder_fingerprint, open_feature_store
+from lora_merge import load_merged_model
+from utils import tokenize_prompts
+from haystack import HaystackImages, cell_labels, generate_haystacks
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+
+def supports_image_features(model):
+    # Our PaliGemmaForConditionalGeneration takes precomputed `image_features`, the HF one doesn't
+    base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    return "image_features" in inspect.signature(base_model.forward).parameters
+
+
+def answer_token_ids(tokenizer, labels):
+    token_ids = []
+    for label in labels:
+        ids = tokenizer(label, add_special_tokens=False)["input_ids"]
+        if len(ids) != 1:
+            raise ValueError(f"Answer label {label!r} is not a single token: {ids}")
+        token_ids.append(ids[0])
+    return token_ids
+
+
+def haystack_feature_store(model, processor, records, cache_dir, batch_size=8):
+    """
+    Projected image features of every haystack in `records`, cached under the encoder's fingerprint.
+    Variants that share the vision tower and projector (e.g. differential vs vanilla fine-tunes with a
+    frozen encoder) therefore share one store.
+    """
+    sweep_key = hashlib.sha1("".join(record["key"] for record in records).encode()).hexdigest()[:16]
+    store_dir = os.path.join(cache_dir, "features", encoder_fingerprint(model, processor)[:16], sweep_key)
+    store = open_feature_store(store_dir, model, processor)
+    if store is not None:
+        print(f"Using cached haystack features from {store_dir}")
+        return store, 0.0
+
+    start = time.perf_counter()
+    store = build_feature_store(model, processor, HaystackImages(records), store_dir, batch_size=batch_size)
+    return store, time.perf_counter() - start
+
+
+@torch.no_grad()
+def score_batch(model, processor, records, label_ids, image_features=None):
+    """
+    Forced choice between the cell labels: the prediction is the label with the highest next-token
+    logit after the prompt, so one prefill per haystack is enough and nothing has to be generated.
+    """
+    param = next(model.parameters())
+    questions = [record["question"] for record in records]
+    if image_features is not None:
+        inputs = tokenize_prompts(processor, questions)
+        inputs["image_features"] = image_features
+    else:
+        images = [Image.open(record["path"]).convert("RGB") for record in records]
+        inputs = dict(processor(text=questions, images=images, return_tensors="pt", padding="longest"))
+        inputs["pixel_values"] = inputs["pixel_values"].to(param.dtype)
+    inputs = {name: tensor.to(param.device) for name, tensor in inputs.items()}
+
+    logits = model(**inputs).logits
+    # Index of the last non-padding token of every row, works for left and right padding
+    last = inputs["attention_mask"].cumsum(-1).argmax(-1)
+    # [Batch_Size, Num_Cells]
+    answer_logits = logits[torch.arange(len(records), device=logits.device), last][:, label_ids]
+    return answer_logits.argmax(-1).tolist()
+
+
+def evaluate_haystacks(model, processor, records, cache_dir, batch_size=8, use_features=True):
+    """Predict the needle cell of every haystack. Returns the per-haystack results and timings."""
+    model.eval()
+    use_features = use_features and supports_image_features(model)
+    encode_seconds = 0.0
+    store = None
+    if use_features:
+        store, encode_seconds = haystack_feature_store(model, processor, records, cache_dir, batch_size)
+    else:
+        print("Model doesn't take precomputed image features, encoding the cached haystack images every run")
+
+    results = [None] * len(records)
+    start = time.perf_counter()
+    # Batch haystacks of the same grid size together, they share the answer labels
+    for grid_size in sorted({record["grid_size"] for record in records}):
+        labels = cell_labels(grid_size)
+        label_ids = answer_token_ids(processor.tokenizer, labels)
+        group = [i for i, record in enumerate(records) if record["grid_size"] == grid_size]
+        for begin in range(0, len(group), batch_size):
+            batch = group[begin:begin + batch_size]
+            image_features = store[batch] if store is not None else None
+            predictions = score_batch(model, processor, [records[i] for i in batch], label_ids, image_features)
+            for i, prediction in zip(batch, predictions):
+                results[i] = dict(records[i], prediction=labels[prediction], correct=labels[prediction] == records[i]["answer"])
+    score_seconds = time.perf_counter() - start
+
+    timings = {
+        "encode_seconds": encode_seconds,
+        "score_seconds": score_seconds,
+        "haystacks_per_sec": len(records) / score_seconds,
+        "features_cached": store is not None,
+    }
+    return results, timings
+
+
+def accuracy_heatmap(results, grid_sizes):
+    # {grid_size: [accuracy of needle position 0, 1, ...]}
+    heatmap = {}
+    for grid_size in grid_sizes:
+        row = []
+        for position in range(grid_size * grid_size):
+            hits = [r["correct"] for r in results if r["grid_size"] == grid_size and r["needle_position"] == position]
+            row.append(sum(hits) / len(hits) if hits else float("nan"))
+        heatmap[grid_size] = row
+    return heatmap
+
+
+def save_heatmap(heatmap, output_dir, title):
+    # Rows are grid sizes, columns needle positions (row-major cell index), cells a grid doesn't have are empty
+    num_columns = max(len(row) for row in heatmap.values())
+    with open(os.path.join(output_dir, "heatmap.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["grid_size"] + [f"position_{i}" for i in range(num_columns)])
+        for grid_size, row in heatmap.items():
+            writer.writerow([grid_size] + [f"{acc:.4f}" for acc in row] + [""] * (num_columns - len(row)))
+
+    print(f"{title}: accuracy (%) per grid size (rows) and needle position (columns)")
+    for grid_size, row in heatmap.items():
+        print(f"{grid_size}x{grid_size} | " + " ".join(f"{acc * 100:5.1f}" for acc in row))
+
+    if plt is None:
+        return
+    data = [row + [float("nan")] * (num_columns - len(row)) for row in heatmap.values()]
+    fig, ax = plt.subplots(figsize=(max(6, num_columns * 0.5), 3))
+    image = ax.imshow(data, vmin=0, vmax=1, cmap="RdYlGn", aspect="auto")
+    ax.set_yticks(range(len(heatmap)), [f"{g}x{g}" for g in heatmap])
+    ax.set_xlabel("Needle position")
+    ax.set_ylabel("Grid size")
+    ax.set_title(title)
+    fig.colorbar(image, ax=ax, label="Accuracy")
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_dir, "heatmap.png"))
+    plt.close(fig)
+
+
+def run_sweep(variants, pool, cache_dir, output_dir, grid_sizes=(2, 3, 4), num_samples=10, seed=0,
+              batch_size=8, pool_name=None, caption_column="caption"):
+    """
+    Evaluate every model variant on the same haystacks. `variants` maps a name to a function returning
+    (model, processor); models are loaded one at a time. Haystacks and their features live in `cache_dir`
+    and are reused by later sweeps, reports and heatmaps are written to `output_dir/<variant>`.
+    """
+    records = []
+    for grid_size in grid_sizes:
+        for position in range(grid_size * grid_size):
+            records.extend(generate_haystacks(
+                pool, cache_dir, grid_size, position, num_samples=num_samples, seed=seed,
+                caption_column=caption_column, pool_name=pool_name,
+            ))
+    print(f"{len(records)} haystacks over grid sizes {list(grid_sizes)}")
+
+    reports = {}
+    for name, load_variant in variants.items():
+        model, processor = load_variant()
+        results, timings = evaluate_haystacks(model, processor, records, cache_dir, batch_size=batch_size)
+        del model
+
+        variant_dir = os.path.join(output_dir, name)
+        os.makedirs(variant_dir, exist_ok=True)
+        with open(os.path.join(variant_dir, "predictions.jsonl"), "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+        heatmap = accuracy_heatmap(results, grid_sizes)
+        save_heatmap(heatmap, variant_dir, name)
+        report = dict(
+            timings, accuracy=sum(r["correct"] for r in results) / len(results), num_haystacks=len(results),
+            heatmap={str(grid_size): row for grid_size, row in heatmap.items()},
+        )
+        with open(os.path.join(variant_dir, "report.json"), "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"{name}: accuracy {report['accuracy'] * 100:.2f}%, {report['haystacks_per_sec']:.2f} haystacks/sec "
+              f"(+{report['encode_seconds']:.1f}s encoding)")
+        reports[name] = report
+    return reports
+
+
+if __name__ == "__main__":
+    from datasets import load_dataset
+
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+    from vqav2 import load_finetuned_model
+
+    base_model_name = "/home/jerryli/CS228-Project/paligemma-3b-pt-224"
+    diff_adapter_path = "/home/jerryli/CS228-Project/paligemma_vqav2/2024-12-07_19-08-31/checkpoints/checkpoint-23500"
+    diff_new_weights_path = "/home/jerryli/CS228-Project/paligemma_vqav2/2024-12-07_19-08-31/new_params/new_params_step_23500/diff_attention_params.pth"
+    vanilla_adapter_path = "/home/jerryli/CS228-Project/paligemma_vqav2/no_diff_attn/checkpoint-400"
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # Captioned images the haystacks are stitched from
+    pool_name = "nlphuji/flickr30k"
+    pool = load_dataset(pool_name, split="test[:1000]")
+
+    variants = {
+        # Our model with the adapter merged, it takes precomputed image features so the haystack features are cached
+        "differential": lambda: load_merged_model(base_model_name, diff_adapter_path, diff_new_weights_path, device=device),
+        "vanilla": lambda: load_finetuned_model(base_model_name, vanilla_adapter_path),
+    }
+    run_sweep(
+        variants, pool, cache_dir="niah_cache", output_dir="niah_results", grid_sizes=(2, 3, 4),
+        num_samples=10, pool_name=pool_name,
+    )
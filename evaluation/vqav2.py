@@ -5,14 +5,18 @@ from PIL import Image
 import requests
 import os
 import re
+import sys
 import torch
 import torch.nn as nn
+import glob
+import json
+import time
 from datasets import load_dataset
 
-def resize_images(img, target_size=(224, 224)):
-    resized_img = img.resize(target_size, Image.Resampling.LANCZOS)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-    return resized_img 
+from image_preprocessing import BatchImagePreprocessor
+from utils import tokenize_prompts
 
 def load_finetuned_model(base_model_name, adapter_path, new_weights_path=None):
     # Load the processor/tokenizer
@@ -83,9 +87,123 @@ def extract_answer_from_generated_text(question, generated_text):
     return generated_text.strip()  # Fallback to the full generated text if no question is found
 
 
-def vqav2_evaluate(model, processor, test_dataset):
+def vqav2_score(annotator_answers, predicted_answer):
+    # VQAv2 scoring formula: an answer is fully correct if at least 3 of the 10 annotators gave it
+    match_count = sum([1 for answer in annotator_answers if answer['answer'].lower() == predicted_answer.lower()])
+    return min(match_count / 3, 1.0)
+
+
+def is_valid_image(image):
+    # Ensure image is a single PIL-like image with 2 or 3 dimensions
+    if not hasattr(image, "size") and not hasattr(image, "mode"):
+        print(f"Skipping example due to invalid image type: {type(image)}")
+        return False
+    if hasattr(image, "size") and len(image.size) != 2 and len(image.size) != 3:
+        print(f"Skipping image with unexpected dimensions: {image.size}")
+        return False
+    return True
+
+
+def read_results(output_dir):
+    """Load every result written so far, keyed by example index."""
+    results = {}
+    for shard_file in sorted(glob.glob(os.path.join(output_dir, "results-*.jsonl"))):
+        with open(shard_file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by an interrupted run, that example gets evaluated again
+                    continue
+                results[record["index"]] = record
+    return results
+
+
+def write_results(output_dir, records, shard_size):
+    # Example i goes to shard i // shard_size, appended and flushed right away so an interrupted run loses nothing
+    shards = {}
+    for record in records:
+        shards.setdefault(record["index"] // shard_size, []).append(record)
+    for shard, shard_records in shards.items():
+        with open(os.path.join(output_dir, f"results-{shard:05d}.jsonl"), "a") as f:
+            for record in shard_records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+
+
+def summarize_results(results):
+    scored = [record["score"] for record in results.values() if not record.get("skipped")]
+    skipped = sum(1 for record in results.values() if record.get("skipped"))
+    accuracy = sum(scored) / len(scored) if scored else 0.0
+    return {"accuracy": accuracy, "num_scored": len(scored), "num_skipped": skipped}
+
+
+@torch.no_grad()
+def generate_answers(model, processor, examples, max_new_tokens=50, preprocessor=None):
+    if preprocessor is None:
+        # A one-off preprocessor, its decode thread pool is shut down again right after
+        with BatchImagePreprocessor.from_processor(processor, max_batch_size=len(examples)) as preprocessor:
+            return generate_answers(model, processor, examples, max_new_tokens, preprocessor)
+    questions = [example["question"] for example in examples]
+
+    # Left padding, so every prompt ends right where generation starts
+    padding_side = processor.tokenizer.padding_side
+    processor.tokenizer.padding_side = "left"
+    try:
+        inputs = tokenize_prompts(processor, questions)
+    finally:
+        processor.tokenizer.padding_side = padding_side
+    # The whole batch is resized and normalized at once, the same pixel_values as the processor
+    inputs["pixel_values"] = preprocessor([example["image"] for example in examples])
+    inputs = {name: tensor.to(model.device) for name, tensor in inputs.items()}
+
+    # Finished sequences are padded until the whole batch is done or max_new_tokens is reached
+    output = model.generate(**inputs, max_new_tokens=max_new_tokens, pad_token_id=processor.tokenizer.pad_token_id)
+    generated_texts = processor.batch_decode(output, skip_special_tokens=True)
+
+    return [
+        extract_answer_from_generated_text(question, generated_text.strip())
+        for question, generated_text in zip(questions, generated_texts)
+    ]
+
+
+def evaluate_batch(model, processor, test_dataset, indices, max_new_tokens=50, preprocessor=None):
+    examples = [test_dataset[i] for i in indices]
+    records, valid = [], []
+    for index, example in zip(indices, examples):
+        if is_valid_image(example["image"]):
+            valid.append((index, example))
+        else:
+            records.append({"index": index, "skipped": True, "error": "invalid image"})
+
+    try:
+        predictions = generate_answers(model, processor, [example for _, example in valid], max_new_tokens, preprocessor) if valid else []
+    except Exception as e:
+        if len(valid) == 1:
+            print(f"Skipping example due to processing error: {e}")
+            return records + [{"index": valid[0][0], "skipped": True, "error": str(e)}]
+        # Retry one by one so a single bad example doesn't take the whole batch down
+        for index, _ in valid:
+            records.extend(evaluate_batch(model, processor, test_dataset, [index], max_new_tokens, preprocessor))
+        return records
+
+    for (index, example), predicted_answer in zip(valid, predictions):
+        records.append({
+            "index": index,
+            "question": example["question"],
+            "prediction": predicted_answer,
+            "score": vqav2_score(example["answers"], predicted_answer),
+        })
+    return records
+
+
+def vqav2_evaluate(model, processor, test_dataset, batch_size=16, output_dir=None, shard_size=1000, max_new_tokens=50):
     """
     Evaluate the model on the VQAv2 dataset using the VQAv2 scoring system.
+
+    Examples are generated in batches and, if `output_dir` is given, every result is appended to
+    sharded JSONL files there. Running again with the same `output_dir` resumes after the last
+    finished example.
     
     Args:
         model: The fine-tuned VQA model.
@@ -94,63 +212,43 @@ def vqav2_evaluate(model, processor, test_dataset):
             - "image" (PIL Image)
             - "question" (str)
             - "answers" (list of 10 annotator answers)
+        batch_size (int): Number of examples generated together.
+        output_dir (str): Directory for the sharded results, enables resuming.
+        shard_size (int): Number of examples per results file.
+        max_new_tokens (int): Generation limit per example.
             
     Returns:
         float: The overall VQAv2 accuracy score for the test set.
     """
-    device = model.device
-    total_score = 0
-    total_questions = 0
-    skipped_images = 0
-    
-    for example in test_dataset:
-        question = example["question"]
-        annotator_answers = example["answers"]  # List of 10 annotator answers
-        image = example["image"]
-
-        # Check if the image is valid
-        try:
-            # Ensure image is a single image (not a batch) and has 3 dimensions (H, W, C)
-            if not hasattr(image, "size") and not hasattr(image, "mode"):
-                print(f"Skipping example due to invalid image type: {type(image)}")
-                skipped_images += 1
-                continue
-
-            # Skip image if it doesn't have the correct dimensions (e.g., it should be a PIL image or similar)
-            if hasattr(image, "size") and len(image.size) != 2 and len(image.size) != 3:
-                print(f"Skipping image with unexpected dimensions: {image.size}")
-                skipped_images += 1
-                continue
-
-            # Resize image
-            raw_image = resize_images(image)
-
-            # Prepare inputs for the model
-            inputs = processor(text=question, images=raw_image, return_tensors="pt").to(device)
-
-            # Generate output
-            with torch.no_grad():
-                output = model.generate(**inputs, max_new_tokens=50)  # Increase token limit to handle larger outputs
-
-            # Decode generated text
-            generated_text = processor.decode(output[0], skip_special_tokens=True).strip()
-
-            # Extract the answer using the new logic
-            predicted_answer = extract_answer_from_generated_text(question, generated_text)
-
-            # Calculate VQAv2 score for this question
-            match_count = sum([1 for answer in annotator_answers if answer['answer'].lower() == predicted_answer.lower()])
-            score = min(match_count / 3, 1.0)  # VQAv2 scoring formula
-            total_score += score
-            total_questions += 1
-
-        except Exception as e:
-            print(f"Skipping example due to processing error: {e}")
-            skipped_images += 1
+    results = {}
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        results = read_results(output_dir)
+        if results:
+            print(f"Resuming with {len(results)} of {len(test_dataset)} examples already evaluated")
+
+    pending = [i for i in range(len(test_dataset)) if i not in results]
+    preprocessor = BatchImagePreprocessor.from_processor(processor, max_batch_size=batch_size)
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(pending), batch_size):
+        records = evaluate_batch(model, processor, test_dataset, pending[batch_start:batch_start + batch_size], max_new_tokens,
+                                 preprocessor)
+        if output_dir is not None:
+            write_results(output_dir, records, shard_size)
+        results.update((record["index"], record) for record in records)
+
+        done = batch_start + len(records)
+        elapsed = time.perf_counter() - start_time
+        print(f"{done}/{len(pending)} examples, {done / elapsed:.2f} examples/sec")
+
+    preprocessor.close()
+    elapsed = time.perf_counter() - start_time
+    if pending:
+        print(f"Evaluated {len(pending)} examples in {elapsed:.1f}s ({len(pending) / elapsed:.2f} examples/sec)")
 
-    accuracy = total_score / total_questions if total_questions > 0 else 0.0
-    print(f"Skipped {skipped_images} images due to dimension issues or errors.")
-    return accuracy
+    summary = summarize_results(results)
+    print(f"Skipped {summary['num_skipped']} images due to dimension issues or errors.")
+    return summary["accuracy"]
 
 
 if __name__ == "__main__":
@@ -168,9 +266,10 @@ if __name__ == "__main__":
     # Load the VQAv2 dataset
     dataset = load_dataset('HuggingFaceM4/VQAv2', split="train[:100%]")
     dataset = dataset.remove_columns(["question_type", "image_id", "question_id"])
-    split_ds = dataset.train_test_split(test_size=0.10)
+    # Fixed seed, so a resumed run evaluates the same split
+    split_ds = dataset.train_test_split(test_size=0.10, seed=42)
     test_ds = split_ds["test"]
 
     # Evaluate the model
-    accuracy = vqav2_evaluate(model, processor, test_ds)
+    accuracy = vqav2_evaluate(model, processor, test_ds, batch_size=16, output_dir="vqav2_eval_results")
     print(f"VQAv2 10% Test Set Accuracy: {accuracy * 100:.2f}%")
\ No newline at end of file
@@ -0,0 +1,172 @@
+import json
+import os
+import time
+
+import torch
+import torch.multiprocessing as mp
+from datasets import load_dataset
+from transformers import AutoProcessor
+
+from vqav2 import load_finetuned_model, read_results, summarize_results, vqav2_evaluate
+
+
+def export_shared_weights(model, weights_path):
+    """
+    Save every parameter and buffer (non-persistent ones included) of a plain, un-wrapped model
+    into one file that the workers memory-map instead of each loading a private copy.
+    """
+    tensors = {name: param.detach() for name, param in model.named_parameters(remove_duplicate=False)}
+    tensors.update({name: buffer for name, buffer in model.named_buffers(remove_duplicate=False)})
+    torch.save(tensors, weights_path)
+
+
+def load_shared_model(model_cls, config, weights_path):
+    # Build the model without allocating or initializing weights...
+    with torch.device("meta"):
+        model = model_cls(config)
+
+    # ... and point every parameter/buffer at the read-only mapped file. All workers share the same page cache
+    tensors = torch.load(weights_path, mmap=True, weights_only=True, map_location="cpu")
+    for name, tensor in tensors.items():
+        module_name, _, tensor_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[tensor_name] = tensor
+    return model.eval()
+
+
+def split_cores(num_workers, cores=None):
+    # Contiguous core ranges, which keeps each worker on one socket as long as the cores divide evenly
+    cores = sorted(os.sched_getaffinity(0)) if cores is None else cores
+    if num_workers > len(cores):
+        raise ValueError(f"Cannot pin {num_workers} workers to {len(cores)} cores")
+    per_worker = len(cores) // num_workers
+    return [cores[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)]
+
+
+def _worker(rank, num_workers, cores, model_cls, config, weights_path, base_model_name, test_dataset,
+            output_dir, batch_size):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    model = load_shared_model(model_cls, config, weights_path)
+    processor = AutoProcessor.from_pretrained(base_model_name)
+
+    # Deterministic contiguous shard, so example i of the shard is example offset + i of the dataset
+    shard = test_dataset.shard(num_shards=num_workers, index=rank, contiguous=True)
+    worker_dir = os.path.join(output_dir, f"worker-{rank:03d}")
+
+    # A resumed run only evaluates the examples the previous runs didn't finish
+    num_done = len(read_results(worker_dir))
+    start = time.perf_counter()
+    vqav2_evaluate(model, processor, shard, batch_size=batch_size, output_dir=worker_dir)
+    eval_seconds = time.perf_counter() - start
+    with open(os.path.join(worker_dir, "stats.json"), "w") as f:
+        json.dump({"rank": rank, "num_examples": len(shard), "num_evaluated": len(read_results(worker_dir)) - num_done,
+                   "eval_seconds": eval_seconds, "cores": cores}, f)
+
+
+def merge_worker_results(output_dir, num_workers, num_examples):
+    results, workers = {}, []
+    offset = 0
+    for rank in range(num_workers):
+        worker_dir = os.path.join(output_dir, f"worker-{rank:03d}")
+        # Same sizes as Dataset.shard(contiguous=True)
+        shard_size = num_examples // num_workers + (1 if rank < num_examples % num_workers else 0)
+        for index, record in read_results(worker_dir).items():
+            results[offset + index] = dict(record, index=offset + index)
+        with open(os.path.join(worker_dir, "stats.json"), "r") as f:
+            workers.append(json.load(f))
+        offset += shard_size
+
+    report = summarize_results(results)
+    # Workers run concurrently, so the slowest one determines the wall time
+    eval_seconds = max(worker["eval_seconds"] for worker in workers)
+    report.update({
+        "num_workers": num_workers,
+        "eval_seconds": eval_seconds,
+        # Only this run's examples, eval_seconds doesn't cover the ones evaluated before a resume
+        "examples_per_sec": sum(worker["num_evaluated"] for worker in workers) / eval_seconds,
+        "workers": workers,
+    })
+    with open(os.path.join(output_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def vqav2_evaluate_parallel(model_cls, config, weights_path, base_model_name, test_dataset, output_dir,
+                            num_workers=2, batch_size=16, cores=None):
+    """
+    Evaluate `test_dataset` with `num_workers` processes, each pinned to its own set of cores and
+    sharing the weights in `weights_path` (see export_shared_weights). Results from all workers are
+    merged into `output_dir/report.json`. Like vqav2_evaluate, re-running resumes every worker.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    ctx = mp.get_context("spawn")
+    processes = []
+    for rank, worker_cores in enumerate(split_cores(num_workers, cores)):
+        process = ctx.Process(
+            target=_worker,
+            args=(rank, num_workers, worker_cores, model_cls, config, weights_path, base_model_name,
+                  test_dataset, output_dir, batch_size),
+        )
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Evaluation worker exited with code {process.exitcode}")
+
+    report = merge_worker_results(output_dir, num_workers, len(test_dataset))
+    print(f"VQAv2 accuracy {report['accuracy'] * 100:.2f}% with {num_workers} workers, "
+          f"{report['examples_per_sec']:.2f} examples/sec")
+    return report
+
+
+def scaling_efficiency(model_cls, config, weights_path, base_model_name, test_dataset, output_dir,
+                       max_workers=None, batch_size=16):
+    # Throughput with 1, 2, 4, ... workers on the same cores. Efficiency = throughput / (workers * throughput with 1)
+    max_workers = len(os.sched_getaffinity(0)) if max_workers is None else max_workers
+    worker_counts = sorted({min(2 ** i, max_workers) for i in range(max_workers.bit_length() + 1)})
+
+    rows = []
+    for num_workers in worker_counts:
+        # A fresh directory per run, otherwise the run would just resume the previous one
+        report = vqav2_evaluate_parallel(
+            model_cls, config, weights_path, base_model_name, test_dataset,
+            os.path.join(output_dir, f"scaling-{num_workers}"), num_workers=num_workers, batch_size=batch_size,
+        )
+        rows.append((num_workers, report["examples_per_sec"]))
+
+    print("workers | examples/sec | speedup | efficiency")
+    for num_workers, throughput in rows:
+        speedup = throughput / rows[0][1]
+        print(f"{num_workers:7d} | {throughput:12.2f} | {speedup:7.2f} | {speedup / num_workers:10.1%}")
+    return rows
+
+
+if __name__ == "__main__":
+    base_model_name = "/home/jerryli/CS228-Project/paligemma-3b-pt-224"
+    adapter_path = "/home/jerryli/CS228-Project/paligemma_vqav2/2024-12-06_12-00-27/checkpoints/checkpoint-12000"
+    new_weights_path = "/home/jerryli/CS228-Project/paligemma_vqav2/2024-12-06_12-00-27/new_params/new_params_step_12000/diff_attention_params.pth"
+    output_dir = "vqav2_eval_results_parallel"
+    num_workers = 2  # e.g. one per socket
+
+    # Merge the adapter once and write the weights the workers map
+    os.makedirs(output_dir, exist_ok=True)
+    weights_path = os.path.join(output_dir, "shared_weights.pt")
+    model, _ = load_finetuned_model(base_model_name, adapter_path, new_weights_path=new_weights_path)
+    model = model.merge_and_unload().to("cpu")
+    model_cls, config = type(model), model.config
+    export_shared_weights(model, weights_path)
+    del model
+
+    # Same split as evaluation/vqav2.py
+    dataset = load_dataset('HuggingFaceM4/VQAv2', split="train[:100%]")
+    dataset = dataset.remove_columns(["question_type", "image_id", "question_id"])
+    test_ds = dataset.train_test_split(test_size=0.10, seed=42)["test"]
+
+    vqav2_evaluate_parallel(model_cls, config, weights_path, base_model_name, test_ds, output_dir, num_workers=num_workers)
+    # scaling_efficiency(model_cls, config, weights_path, base_model_name, test_ds.select(range(512)), output_dir)
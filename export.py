@@ -0,0 +1,135 @@
+import os
+from typing import List, Optional
+
+import torch
+from torch import nn
+
+from modeling_gemma import KVCache
+
+# File names of the graphs in an export directory
+VISION_GRAPH = "vision.pt"
+PREFILL_GRAPH = "prefill.pt"
+DECODE_GRAPH = "decode.pt"
+
+
+class VisionGraph(nn.Module):
+    """pixel_values [Batch_Size, Channels, Height, Width] -> image features [Batch_Size, Num_Patches, Hidden_Size]"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.vision_tower = model.vision_tower
+        self.multi_modal_projector = model.multi_modal_projector
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.multi_modal_projector(self.vision_tower(pixel_values))
+
+
+class PrefillGraph(nn.Module):
+    """
+    input_ids, attention_mask [Batch_Size, Seq_Len] and the image features -> logits of the next token
+    [Batch_Size, Vocab_Size] and the KV cache of the prompt, key_cache and value_cache
+    [Num_Layers, Batch_Size, Num_Heads_KV, Seq_Len, Head_Dim].
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, image_features: torch.Tensor):
+        kv_cache = KVCache()
+        hidden_states = _language_model_step(self.model, input_ids, attention_mask, kv_cache, image_features)
+        # Next token after the last non-padding token, works for left and right padding
+        last = attention_mask.cumsum(-1).argmax(-1)
+        hidden_states = hidden_states[torch.arange(input_ids.shape[0], device=input_ids.device), last]
+        logits = self.model.language_model.lm_head(hidden_states).float()
+        return logits, torch.stack(kv_cache.key_cache), torch.stack(kv_cache.value_cache)
+
+
+class DecodeGraph(nn.Module):
+    """
+    One decode step: input_ids [Batch_Size, 1], attention_mask [Batch_Size, KV_Len + 1] and the KV cache of the
+    previous positions -> logits of the next token [Batch_Size, Vocab_Size] and the KV cache with this position.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, key_cache: torch.Tensor, value_cache: torch.Tensor):
+        kv_cache = KVCache()
+        kv_cache.key_cache, kv_cache.value_cache = list(key_cache.unbind(0)), list(value_cache.unbind(0))
+        hidden_states = _language_model_step(self.model, input_ids, attention_mask, kv_cache)
+        logits = self.model.language_model.lm_head(hidden_states[:, -1]).float()
+        return logits, torch.stack(kv_cache.key_cache), torch.stack(kv_cache.value_cache)
+
+
+def _language_model_step(model, input_ids, attention_mask, kv_cache, image_features=None):
+    # PaliGemmaForConditionalGeneration.forward up to the final norm: only the positions that predict a token need
+    # the lm_head, the graphs apply it to those
+    inputs_embeds = model.language_model.get_input_embeddings()(input_ids)
+    if image_features is not None:
+        image_features = image_features.to(inputs_embeds.dtype)
+    inputs_embeds, causal_mask, position_ids, sliding_mask = model._merge_input_ids_with_image_features(
+        image_features, inputs_embeds, input_ids, attention_mask, kv_cache
+    )
+    return model.language_model(
+        attention_mask=causal_mask, position_ids=position_ids, inputs_embeds=inputs_embeds, kv_cache=kv_cache,
+        sliding_attention_mask=sliding_mask, compute_logits=False,
+    ).hidden_states
+
+
+@torch.no_grad()
+def export_torchscript(model, input_ids: torch.Tensor, attention_mask: torch.Tensor, pixel_values: torch.Tensor,
+                       output_dir: Optional[str] = None):
+    """
+    Trace the vision encoder, the prefill and a decode step of our PaliGemmaForConditionalGeneration into TorchScript
+    graphs, using the example batch. They run without Python (e.g. torch::jit::load in C++). The differential
+    attention, the RMSNorms and the recomputed-attention path trace to plain tensor ops. Batch size, prompt length
+    and KV length stay dynamic, but loops over the sequence (recompute_attention blocks, mlp_chunk_size chunks)
+    are unrolled for the example's lengths, so export without them. Saves VISION_GRAPH, PREFILL_GRAPH and
+    DECODE_GRAPH to `output_dir` if given. Returns the three graphs.
+    """
+    if getattr(model.config.text_config, "sliding_window", None) is not None:
+        # A RollingKVCache changes the length of the explicit cache depending on the position
+        raise ValueError("Models with sliding_window can't be exported, their cache doesn't have a fixed layout")
+    model = model.eval()
+    vision = torch.jit.trace(VisionGraph(model), (pixel_values,), check_trace=False)
+    image_features = vision(pixel_values)
+    prefill = torch.jit.trace(PrefillGraph(model), (input_ids, attention_mask, image_features), check_trace=False)
+    logits, key_cache, value_cache = prefill(input_ids, attention_mask, image_features)
+    next_tokens = logits.argmax(-1, keepdim=True)
+    decode_mask = torch.cat([attention_mask, torch.ones_like(attention_mask[:, :1])], dim=-1)
+    decode = torch.jit.trace(DecodeGraph(model), (next_tokens, decode_mask, key_cache, value_cache), check_trace=False)
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        vision.save(os.path.join(output_dir, VISION_GRAPH))
+        prefill.save(os.path.join(output_dir, PREFILL_GRAPH))
+        decode.save(os.path.join(output_dir, DECODE_GRAPH))
+    return vision, prefill, decode
+
+
+def load_torchscript(output_dir: str, map_location="cpu"):
+    return tuple(
+        torch.jit.load(os.path.join(output_dir, name), map_location=map_location)
+        for name in (VISION_GRAPH, PREFILL_GRAPH, DECODE_GRAPH)
+    )
+
+
+@torch.no_grad()
+def generate_exported(vision, prefill, decode, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                      pixel_values: torch.Tensor, max_new_tokens: int = 50) -> List[List[int]]:
+    """
+    Greedy decoding with the exported graphs (or the eager VisionGraph/PrefillGraph/DecodeGraph), the loop a
+    runtime without Python implements. Every sequence gets `max_new_tokens` tokens, truncate after the eos token.
+    """
+    image_features = vision(pixel_values)
+    logits, key_cache, value_cache = prefill(input_ids, attention_mask, image_features)
+    next_tokens = logits.argmax(-1)
+    generated = [next_tokens]
+    for _ in range(max_new_tokens - 1):
+        attention_mask = torch.cat([attention_mask, torch.ones_like(attention_mask[:, :1])], dim=-1)
+        logits, key_cache, value_cache = decode(next_tokens.unsqueeze(-1), attention_mask, key_cache, value_cache)
+        next_tokens = logits.argmax(-1)
+        generated.append(next_tokens)
+    return torch.stack(generated, dim=-1).tolist()
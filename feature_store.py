@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional
+
+import numpy as np
+import torch
+
+FEATURES_FILE = "features.npy"
+META_FILE = "meta.json"
+
+# numpy has no bfloat16, so the store is either half or full precision
+STORE_DTYPES = {
+    torch.float16: np.float16,
+    torch.float32: np.float32,
+}
+
+
+def encoder_fingerprint(model, processor=None) -> str:
+    """
+    Hash of everything that determines the stored features: the vision tower and
+    projector weights and, if given, the image processor settings.
+    """
+    h = hashlib.sha256()
+    for prefix, module in (("vision_tower", model.vision_tower), ("multi_modal_projector", model.multi_modal_projector)):
+        for name, tensor in sorted(module.state_dict().items()):
+            tensor = tensor.detach().cpu().contiguous()
+            h.update(f"{prefix}.{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+            # View as raw bytes so bfloat16 weights can be hashed too
+            h.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    if processor is not None:
+        h.update(processor.image_processor.to_json_string().encode())
+    return h.hexdigest()
+
+
+@torch.no_grad()
+def encode_images(model, pixel_values: torch.Tensor) -> torch.Tensor:
+    # [Batch_Size, Channels, Height, Width] -> [Batch_Size, Num_Patches, Projection_Dim]
+    vision_outputs = model.vision_tower(pixel_values)
+    # The HF SiglipVisionModel returns a ModelOutput, ours returns the hidden states directly
+    if not torch.is_tensor(vision_outputs):
+        vision_outputs = vision_outputs.last_hidden_state
+    return model.multi_modal_projector(vision_outputs)
+
+
+class FeatureStore:
+    """Read-only, memory-mapped view over precomputed projected image features."""
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        # [Num_Examples, Num_Patches, Projection_Dim]
+        self.features = np.load(os.path.join(store_dir, FEATURES_FILE), mmap_mode="r")
+
+    @property
+    def fingerprint(self) -> str:
+        return self.meta["fingerprint"]
+
+    def __len__(self) -> int:
+        return self.features.shape[0]
+
+    def __getitem__(self, indices) -> torch.Tensor:
+        # Fancy indexing on a memmap copies only the requested rows
+        return torch.from_numpy(np.ascontiguousarray(self.features[indices]))
+
+
+@torch.no_grad()
+def build_feature_store(model, processor, dataset, store_dir: str, batch_size: int = 32,
+                        dtype: torch.dtype = torch.float16, image_column: str = "image") -> FeatureStore:
+    """
+    Run the frozen vision tower and projector once over `dataset` and write the
+    projected features (row i belongs to dataset[i]) to `store_dir`.
+    """
+    if dtype not in STORE_DTYPES:
+        raise ValueError(f"Unsupported feature store dtype {dtype}, expected one of {list(STORE_DTYPES)}")
+
+    was_training = model.training
+    model.eval()
+    param = next(model.vision_tower.parameters())
+    os.makedirs(store_dir, exist_ok=True)
+
+    # Write under a temporary name and only publish the store once the metadata exists,
+    # so an interrupted build is never mistaken for a valid store
+    tmp_path = os.path.join(store_dir, FEATURES_FILE + ".tmp")
+    features = None
+    for start in range(0, len(dataset), batch_size):
+        images = [image.convert("RGB") for image in dataset[start:start + batch_size][image_column]]
+        pixel_values = processor.image_processor(images, return_tensors="pt")["pixel_values"]
+        image_features = encode_images(model, pixel_values.to(device=param.device, dtype=param.dtype))
+
+        if features is None:
+            _, num_patches, projection_dim = image_features.shape
+            features = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=STORE_DTYPES[dtype], shape=(len(dataset), num_patches, projection_dim)
+            )
+        features[start:start + len(images)] = image_features.to(dtype).cpu().numpy()
+
+        if (start // batch_size) % 100 == 0:
+            print(f"Encoded {start + len(images)}/{len(dataset)} images")
+
+    features.flush()
+    del features
+    os.replace(tmp_path, os.path.join(store_dir, FEATURES_FILE))
+
+    meta = {
+        "fingerprint": encoder_fingerprint(model, processor),
+        "num_examples": len(dataset),
+        "dataset_fingerprint": getattr(dataset, "_fingerprint", None),
+        "dtype": str(dtype),
+    }
+    with open(os.path.join(store_dir, META_FILE), "w") as f:
+        json.dump(meta, f, indent=4)
+
+    model.train(was_training)
+    print(f"Feature store with {len(dataset)} examples saved to {store_dir}")
+    return FeatureStore(store_dir)
+
+
+def open_feature_store(store_dir: str, model, processor=None, dataset=None) -> Optional[FeatureStore]:
+    """
+    Open an existing feature store. Returns None (and deletes the stale store) if it is
+    missing, incomplete or was built from different encoder weights or data.
+    """
+    if not os.path.isfile(os.path.join(store_dir, META_FILE)) or \
+            not os.path.isfile(os.path.join(store_dir, FEATURES_FILE)):
+        return None
+
+    store = FeatureStore(store_dir)
+    reason = None
+    if store.fingerprint != encoder_fingerprint(model, processor):
+        reason = "vision encoder weights changed"
+    elif dataset is not None and store.meta["num_examples"] != len(dataset):
+        reason = f"expected {len(dataset)} examples but found {store.meta['num_examples']}"
+    elif dataset is not None and store.meta["dataset_fingerprint"] != getattr(dataset, "_fingerprint", None):
+        reason = "dataset changed"
+
+    if reason is not None:
+        print(f"Invalidating feature store at {store_dir}: {reason}")
+        del store
+        shutil.rmtree(store_dir)
+        return None
+    return store
+
+
+def load_or_build_feature_store(model, processor, dataset, store_dir: str, batch_size: int = 32,
+                                dtype: torch.dtype = torch.float16) -> FeatureStore:
+    store = open_feature_store(store_dir, model, processor, dataset)
+    if store is None:
+        store = build_feature_store(model, processor, dataset, store_dir, batch_size=batch_size, dtype=dtype)
+    return store
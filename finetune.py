@@ -10,41 +10,79 @@ from transformers import (
     GenerationConfig,
     AutoTokenizer,
 )
+from transformers.models.paligemma.modeling_paligemma import PaliGemmaCausalLMOutputWithPast
 from peft import get_peft_model, LoraConfig
-from datasets import load_dataset
+from datasets import load_dataset, concatenate_datasets
 from pathlib import Path
 from safetensors.torch import load_file
 import os
 from datetime import datetime
 from huggingface_hub import login
-from transformers import TrainerCallback
 from peft import PeftModel
 import numpy as np 
 import random
+from feature_store import load_or_build_feature_store
+from bucket_sampler import BucketingTrainer, StepTimeCallback, compute_lengths, report_padding_efficiency
+from checkpoint_writer import DIFF_ATTENTION_KEYWORDS, AsyncCheckpointCallback, TrainableCheckpointMixin, latest_training_state
+from utils import tokenize_prompts
 
 device = "cuda"
 
 os.environ["HF_DATASETS_OFFLINE"] = "1"
 
-# Call back for saving the parameters
-class SaveLoRACallback(TrainerCallback):
-    def on_step_end(self, args, state, control, **kwargs):
-        model = kwargs["model"]
-        # Save new parameters every 10 steps
-        if state.global_step % 500 == 0:
-            save_dir = os.path.join(args.output_dir, f"new_params_step_{state.global_step}")
-            os.makedirs(save_dir, exist_ok=True)
-
-            # Filter for new parameters
-            new_params = {
-                name: param
-                for name, param in model.state_dict().items()
-                if any(keyword in name for keyword in ["lambda_q1", "lambda_k1", "lambda_q2", "lambda_k2", "subln"])
-            }
-
-            # Save only new parameters
-            torch.save(new_params, os.path.join(save_dir, "diff_attention_params.pth"))
-            print(f"Saved new parameters at step {state.global_step} to {save_dir}")
+LORA_TARGET_MODULES = [
+    "q_proj",
+    "o_proj",
+    "k_proj",
+    "v_proj",
+    "gate_proj",
+    "up_proj",
+    "down_proj"
+]
+# Same projections, but only inside the language model so the vision tower stays untouched
+LANGUAGE_MODEL_LORA_TARGET_MODULES = r".*language_model.*\.(q_proj|o_proj|k_proj|v_proj|gate_proj|up_proj|down_proj)"
+
+class PaliGemmaWithImageFeatures(PaliGemmaForConditionalGeneration):
+    """
+    HF PaliGemmaForConditionalGeneration whose forward also takes precomputed `image_features` (multi_modal_projector
+    outputs [Batch_Size, Num_Patches, Hidden_Size], e.g. from a feature store) instead of pixel_values. They are merged
+    into the text embeddings the same way, so training on them doesn't run the vision tower.
+    """
+
+    def forward(self, input_ids=None, pixel_values=None, attention_mask=None, image_features=None, token_type_ids=None,
+                labels=None, inputs_embeds=None, position_ids=None, cache_position=None, **kwargs):
+        if image_features is None:
+            return super().forward(
+                input_ids=input_ids, pixel_values=pixel_values, attention_mask=attention_mask, token_type_ids=token_type_ids,
+                labels=labels, inputs_embeds=inputs_embeds, position_ids=position_ids, cache_position=cache_position, **kwargs
+            )
+
+        # What the HF forward does with pixel_values, minus the vision tower and the projector
+        inputs_embeds = self.get_input_embeddings()(input_ids)
+        cache_position = torch.arange(input_ids.shape[1], device=inputs_embeds.device)
+        inputs_embeds, causal_mask, labels, position_ids = self._merge_input_ids_with_image_features(
+            image_features.to(inputs_embeds.dtype), inputs_embeds, input_ids, attention_mask, labels, token_type_ids, cache_position
+        )
+        kwargs["return_dict"] = True
+        outputs = super().forward(
+            attention_mask=causal_mask, position_ids=position_ids, inputs_embeds=inputs_embeds, cache_position=cache_position, **kwargs
+        )
+
+        loss = None
+        if labels is not None:
+            # Same loss as the HF forward, the 2D attention mask drops the padding
+            shift_mask = attention_mask[..., 1:] != 0
+            shift_logits = outputs.logits[..., :-1, :][shift_mask]
+            shift_labels = labels[..., 1:][shift_mask].to(shift_logits.device)
+            loss = nn.functional.cross_entropy(shift_logits.view(-1, self.config.vocab_size), shift_labels.view(-1))
+        return PaliGemmaCausalLMOutputWithPast(
+            loss=loss, logits=outputs.logits, past_key_values=outputs.past_key_values,
+            hidden_states=outputs.hidden_states, attentions=outputs.attentions,
+        )
+
+class FinetuneTrainer(TrainableCheckpointMixin, BucketingTrainer):
+    # Length bucketing + resuming from the trainable-only checkpoints of AsyncCheckpointCallback
+    pass
 
 def initialize_new_layers(model):
     for name, module in model.named_modules():
@@ -53,9 +91,9 @@ def initialize_new_layers(model):
             if module.bias is not None:
                 nn.init.zeros_(module.bias)
 
-def setup(local_weights_path, config):
+def setup(local_weights_path, config, lora_target_modules=LORA_TARGET_MODULES, model_class=PaliGemmaForConditionalGeneration):
     # Initialize model without BitsAndBytesConfig for now
-    model = PaliGemmaForConditionalGeneration.from_pretrained(
+    model = model_class.from_pretrained(
         local_weights_path,
         local_files_only=True,
         ignore_mismatched_sizes=True,
@@ -140,15 +178,7 @@ def setup(local_weights_path, config):
     lora_config = LoraConfig(
         r=32,  # Rank of the adaptation matrices
         lora_alpha=64,  # Scaling factor
-        target_modules=[
-            "q_proj",
-            "o_proj",
-            "k_proj",
-            "v_proj",
-            "gate_proj",
-            "up_proj",
-            "down_proj"
-        ], 
+        target_modules=lora_target_modules,
         lora_dropout=0.1,
         bias="none",
         task_type="CAUSAL_LM"  # Adjust based on your task
@@ -159,6 +189,10 @@ def setup(local_weights_path, config):
         print(f"{name} requires_grad: {param.requires_grad}")
 
     model = get_peft_model(model, lora_config)
+    # get_peft_model freezes everything but the adapters, so unfreeze the differential attention params again
+    for name, param in model.named_parameters():
+        if any(keyword in name for keyword in DIFF_ATTENTION_KEYWORDS):
+            param.requires_grad = True
     for name, param in model.named_parameters():
         if "lora" in name:
             print(f"LoRA parameter: {name}, requires_grad: {param.requires_grad}")
@@ -171,10 +205,11 @@ def load_docvqa():
     ds = load_dataset("lmms-lab/DocVQA", "InfographicVQA", split="test")
     print(ds)
 
-def load_vqav2():
+def load_vqav2(seed=None):
     dataset = load_dataset('HuggingFaceM4/VQAv2', split="train[:100%]")
     dataset = dataset.remove_columns(["question_type", "answers", "answer_type", "image_id", "question_id"])
-    split_ds = dataset.train_test_split(test_size=0.15)
+    # A fixed seed keeps the split (and any feature store built from it) stable across runs
+    split_ds = dataset.train_test_split(test_size=0.15, seed=seed)
     return split_ds["train"], split_ds["test"]
 
 def vqav2_collate_fn(batch): # dictionary of images and text
@@ -189,6 +224,30 @@ def vqav2_collate_fn(batch): # dictionary of images and text
     tokens = {k: v.to(device) for k, v in tokens.items()}
     return tokens
 
+def make_feature_collate_fn(store):
+    # Collate for datasets prepared by add_feature_store: the image features come from the memory-mapped
+    # store instead of running the frozen vision tower on every step
+    def feature_collate_fn(batch):
+        texts = ["answer " + sequence["question"] for sequence in batch]
+        labels = [sequence['multiple_choice_answer'] for sequence in batch]
+        tokens = tokenize_prompts(processor, texts, suffix=labels, padding="longest")
+        tokens["image_features"] = store[[sequence["feature_index"] for sequence in batch]]
+
+        tokens = {k: v.to(device) for k, v in tokens.items()}
+        return tokens
+    return feature_collate_fn
+
+def add_feature_store(model, train_ds, eval_ds, store_dir, dtype=torch.float16):
+    # Encode the train and eval images once into a single store; rows of train_ds come first
+    store = load_or_build_feature_store(model, processor, concatenate_datasets([train_ds, eval_ds]), store_dir, dtype=dtype)
+
+    # Drop the images so the dataloader doesn't decode them anymore
+    train_ds = train_ds.remove_columns("image").add_column("feature_index", list(range(len(train_ds))))
+    eval_ds = eval_ds.remove_columns("image").add_column(
+        "feature_index", list(range(len(train_ds), len(train_ds) + len(eval_ds)))
+    )
+    return train_ds, eval_ds, make_feature_collate_fn(store)
+
 def load_tokenizer(model_path):
     # Load the tokenizer
     tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side="right")
@@ -208,7 +267,15 @@ def load_rng_state(checkpoint_path):
     else:
         print(f"No RNG state found at {rng_state_path}")
 
-def resume_finetuning(base_model_path, adapter_dir, new_weights_path, train_ds, eval_ds, processor, training_args, resume_checkpoint_path=None):
+def bucketing_trainer_kwargs(train_ds, processor, training_args, bucket_by_length):
+    # Extra BucketingTrainer arguments: the tokenized lengths to group by, and a step timer to see the effect
+    if not bucket_by_length:
+        return {"train_lengths": None, "callbacks": []}
+    train_lengths = compute_lengths(train_ds, processor)
+    report_padding_efficiency(train_lengths, training_args.per_device_train_batch_size, seed=training_args.seed)
+    return {"train_lengths": train_lengths, "callbacks": [StepTimeCallback()]}
+
+def resume_finetuning(base_model_path, adapter_dir, new_weights_path, train_ds, eval_ds, processor, training_args, resume_checkpoint_path=None, bucket_by_length=False):
     # 1. Load the base model
     base_model = PaliGemmaForConditionalGeneration.from_pretrained(
         base_model_path,
@@ -267,14 +334,24 @@ def resume_finetuning(base_model_path, adapter_dir, new_weights_path, train_ds,
         tokens = {k: v.to(model.device) for k, v in tokens.items()}
         return tokens
     
-    trainer = Trainer(
+    # 4. Continue from the newest checkpoint in resume_checkpoint_path (AsyncCheckpointCallback's trainable-only
+    # checkpoints, or a Trainer checkpoint-<step> directory) with its optimizer, LR schedule and step
+    checkpoint_dir = os.path.join(training_args.output_dir, "trainable_checkpoints")
+    resume_from_checkpoint = latest_training_state(resume_checkpoint_path) if resume_checkpoint_path is not None else None
+
+    bucketing_kwargs = bucketing_trainer_kwargs(train_ds, processor, training_args, bucket_by_length)
+    trainer = FinetuneTrainer(
         model=model,
         train_dataset=train_ds,
         eval_dataset=eval_ds,
         data_collator=resume_collate_fn,
-        args=training_args
+        callbacks=[
+            AsyncCheckpointCallback(checkpoint_dir, save_steps=training_args.save_steps)
+        ] + bucketing_kwargs["callbacks"],
+        args=training_args,
+        train_lengths=bucketing_kwargs["train_lengths"],
     )
-    trainer.train()
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
 
     # 5. Save the re-finetuned model
     save_dir = os.path.join(training_args.output_dir, "resumed_finetuned")
@@ -282,9 +359,23 @@ def resume_finetuning(base_model_path, adapter_dir, new_weights_path, train_ds,
     model.save_pretrained(save_dir)
     print("Resumed finetuned model saved to:", save_dir)
 
-def finetune_lora(local_weights_path, model_config, train_ds, eval_ds, collate_fn, training_args):
+def finetune_lora(local_weights_path, model_config, train_ds, eval_ds, collate_fn, training_args, feature_store_dir=None, bucket_by_length=False, resume_checkpoint_dir=None):
     # Initialize the model and freeze/unfreeze weights
-    model = setup(local_weights_path, model_config)
+    if feature_store_dir is None:
+        model = setup(local_weights_path, model_config)
+    else:
+        # Precomputed features are only valid while the vision tower and projector never change,
+        # so keep LoRA out of the vision tower and freeze its differential attention params as well
+        model = setup(local_weights_path, model_config, lora_target_modules=LANGUAGE_MODEL_LORA_TARGET_MODULES,
+                      model_class=PaliGemmaWithImageFeatures)
+        for param in model.vision_tower.parameters():
+            param.requires_grad = False
+        train_ds, eval_ds, collate_fn = add_feature_store(model, train_ds, eval_ds, feature_store_dir)
+
+    # Continue from the newest trainable-only checkpoint (LoRA, lambdas, subln) written by AsyncCheckpointCallback,
+    # with the optimizer, the LR schedule and the step where it stopped
+    checkpoint_dir = os.path.join(training_args.output_dir, "trainable_checkpoints")
+    resume_from_checkpoint = latest_training_state(resume_checkpoint_dir) if resume_checkpoint_dir is not None else None
 
     # Create timestamped folder
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -292,19 +383,23 @@ def finetune_lora(local_weights_path, model_config, train_ds, eval_ds, collate_f
     os.makedirs(base_folder, exist_ok=True)
 
     # Initialize the trainer
-    trainer = Trainer(
+    bucketing_kwargs = bucketing_trainer_kwargs(train_ds, processor, training_args, bucket_by_length)
+    trainer = FinetuneTrainer(
         model=model,
         train_dataset=train_ds,
         eval_dataset=eval_ds, 
         data_collator=collate_fn,
-        callbacks=[SaveLoRACallback()],
+        callbacks=[
+            AsyncCheckpointCallback(checkpoint_dir, save_steps=training_args.save_steps)
+        ] + bucketing_kwargs["callbacks"],
         args=training_args,
+        train_lengths=bucketing_kwargs["train_lengths"],
         # compute_metrics=compute_metrics  
     )
     
     # Train
     print("Begin Finetuning")
-    trainer.train()
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
 
     # Save weights
     weights_folder = os.path.join(base_folder, "finetuned_weights")
@@ -330,10 +425,7 @@ def finetune_lora(local_weights_path, model_config, train_ds, eval_ds, collate_f
         "rank": 32,
         "lora_alpha": 64,
         "lora_dropout": 0.1,
-        "target_modules": [
-            "q_proj", "o_proj", "k_proj", "v_proj",
-            "gate_proj", "up_proj", "down_proj"
-        ],
+        "target_modules": LORA_TARGET_MODULES if feature_store_dir is None else LANGUAGE_MODEL_LORA_TARGET_MODULES,
         "bias": "none",
         "task_type": "CAUSAL_LM"
     }
@@ -364,7 +456,7 @@ if __name__ == "__main__":
         evaluation_strategy="steps", 
         eval_steps=1000, 
         optim="adamw_hf",  
-        save_strategy="steps",
+        save_strategy="no",  # Trainable-only checkpoints are written by AsyncCheckpointCallback instead
         save_steps=500,  # Adjusted for demonstration
         push_to_hub=False,
         # save_total_limit=1,
@@ -375,19 +467,22 @@ if __name__ == "__main__":
         dataloader_pin_memory=False
     )
 
+    # Set to a directory to train against precomputed vision features instead of running the vision tower
+    feature_store_dir = None  # os.path.join(root, "vqav2_features")
+
     # Load the config
     with open(model_config_path, "r") as f:
         model_config = json.load(f)
 
     # Load the dataset
-    train_ds, eval_ds = load_vqav2()
+    train_ds, eval_ds = load_vqav2(seed=42 if feature_store_dir is not None else None)
 
     # Load tokenizer and processor
     tokenizer = load_tokenizer(local_weights_path)
     processor = PaliGemmaProcessor.from_pretrained(root)
 
     # Call finetune_lora
-    finetune_lora(local_weights_path, model_config, train_ds, eval_ds, vqav2_collate_fn, training_args)
+    finetune_lora(local_weights_path, model_config, train_ds, eval_ds, vqav2_collate_fn, training_args, feature_store_dir=feature_store_dir, bucket_by_length=True)
     
     # base_model_path = "/home/jerryli/CS228-Project/paligemma-3b-pt-224" # "google/paligemma-3b-pt-224"  # actual model name
     # adapter_path = "/home/jerryli/CS228-Project/paligemma_vqav2/2024-12-06_12-00-27/checkpoints/checkpoint-12000"  
@@ -400,7 +495,8 @@ if __name__ == "__main__":
     #     eval_ds=eval_ds,
     #     processor=processor,
     #     training_args=training_args,
-    #     resume_checkpoint_path=adapter_path
+    #     resume_checkpoint_path=adapter_path,
+    #     bucket_by_length=True
     # )
     
 
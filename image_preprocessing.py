@@ -0,0 +1,183 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+# SiglipImageProcessor defaults used by PaliGemma
+IMAGE_SIZE = 224
+IMAGE_MEAN = [0.5, 0.5, 0.5]
+IMAGE_STD = [0.5, 0.5, 0.5]
+
+# Fixed-point precision of PIL's 8-bit resampling coefficients
+PRECISION_BITS = 32 - 8 - 2
+# Output positions per resample matmul, each block only reads the window of inputs its taps cover
+RESAMPLE_BLOCK_SIZE = 16
+
+
+def _bicubic(x: np.ndarray) -> np.ndarray:
+    # PIL's bicubic filter (a = -0.5, support 2)
+    a = -0.5
+    x = np.abs(x)
+    return np.where(x < 1, ((a + 2) * x - (a + 3)) * x * x + 1, np.where(x < 2, (((x - 5) * x + 8) * x - 4) * a, 0.0))
+
+
+@lru_cache(maxsize=64)
+def resample_blocks(in_size: int, out_size: int) -> List[Tuple[int, torch.Tensor]]:
+    """
+    One PIL BICUBIC resize pass along an axis, with the same taps and the same fixed-point coefficients as PIL's
+    ImagingResample, for upscaling and (antialiased) downscaling. The [Out_Size, In_Size] matrix is banded, so it
+    is split into blocks of RESAMPLE_BLOCK_SIZE outputs: (first input, float32 [Block_Size, Window] matrix) each.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 2.0 * filterscale
+    taps = []
+    for i in range(out_size):
+        center = (i + 0.5) * scale
+        # int() truncates like PIL's C casts
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        weights = _bicubic((np.arange(xmin, xmax) - center + 0.5) * (1.0 / filterscale))
+        total = weights.sum()
+        if total != 0:
+            weights = weights / total
+        weights = np.trunc(weights * (1 << PRECISION_BITS) + np.where(weights < 0, -0.5, 0.5))
+        taps.append((xmin, weights))
+
+    blocks = []
+    for start in range(0, out_size, RESAMPLE_BLOCK_SIZE):
+        block = taps[start:start + RESAMPLE_BLOCK_SIZE]
+        first = min(xmin for xmin, _ in block)
+        last = max(xmin + len(weights) for xmin, weights in block)
+        matrix = np.zeros((len(block), last - first))
+        for row, (xmin, weights) in enumerate(block):
+            matrix[row, xmin - first:xmin - first + len(weights)] = weights
+        # Scaled back from fixed point, so rounding the float32 sum gives PIL's (sum + 2^21) >> 22
+        blocks.append((first, torch.from_numpy(matrix / (1 << PRECISION_BITS)).float()))
+    return blocks
+
+
+def _resample(x: torch.Tensor, size: int, dim: int) -> torch.Tensor:
+    # One pass over `dim` (-1 width, -2 height) of float32 uint8 values x [N, Channels, Height, Width], rounded and
+    # clipped to uint8 the way PIL does after every pass
+    shape = list(x.shape)
+    shape[dim] = size
+    output = x.new_empty(shape)
+    for i, (first, matrix) in enumerate(resample_blocks(x.shape[dim], size)):
+        window = x.narrow(dim, first, matrix.shape[1])
+        block = output.narrow(dim, i * RESAMPLE_BLOCK_SIZE, matrix.shape[0])
+        if dim == -1:
+            torch.matmul(window, matrix.t(), out=block)
+        else:
+            torch.matmul(matrix, window, out=block)
+    return output.add_(0.5).floor_().clamp_(0, 255)
+
+
+def resize_bicubic(images: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    """
+    [N, In_Height, In_Width, Channels] uint8 -> [N, Channels, Height, Width] float32 uint8 values, PIL's
+    Image.resize(BICUBIC) of every image: a horizontal then a vertical pass, each rounded to uint8. Sums in
+    float32 instead of PIL's int32 can round differently on exact ties, so values differ by at most one.
+    """
+    images = images.permute(0, 3, 1, 2).to(torch.float32, memory_format=torch.contiguous_format)
+    if images.shape[-1] != width:
+        images = _resample(images, width, -1)
+    if images.shape[-2] != height:
+        images = _resample(images, height, -2)
+    return images
+
+
+def decode_image(image) -> np.ndarray:
+    # PIL image, path or encoded bytes -> [Height, Width, 3] uint8
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(image))
+    elif isinstance(image, str):
+        image = Image.open(image)
+    return np.asarray(image.convert("RGB"))
+
+
+class BatchImagePreprocessor:
+    """
+    Turns a batch of images into `pixel_values` ([Batch_Size, Channels, Height, Width], what
+    SiglipVisionEmbeddings expects) with whole-batch tensor ops instead of one PIL resize per image.
+
+    Decoding runs in a thread pool. Images of the same size are resized together with resize_bicubic, which
+    gives PIL's BICUBIC uint8 values (up- and downscaling, within one step), then rescaled and normalized in
+    place in a reusable output buffer, which is pinned when CUDA is available.
+    The returned tensor is a view into that buffer and is overwritten by the next call, pass `copy=True`
+    to keep it around. For the same reason an instance serves one caller at a time: give each thread its own.
+    """
+
+    def __init__(self, image_size: int = IMAGE_SIZE, image_mean: Sequence[float] = IMAGE_MEAN,
+                 image_std: Sequence[float] = IMAGE_STD, rescale_factor: float = 1 / 255,
+                 num_threads: int = 4, max_batch_size: int = 32, dtype: torch.dtype = torch.float32,
+                 pin_memory: Optional[bool] = None):
+        self.image_size = image_size
+        self.rescale_factor = rescale_factor
+        # Folded into one multiply-add: (x * rescale - mean) / std = x * scale + shift
+        mean = torch.tensor(image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+        std = torch.tensor(image_std, dtype=torch.float32).view(1, 3, 1, 1)
+        self.scale = (rescale_factor / std).to(dtype)
+        self.shift = (-mean / std).to(dtype)
+        self.dtype = dtype
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="image-decode")
+        self.buffer = self._allocate(max_batch_size)
+
+    @classmethod
+    def from_processor(cls, processor, **kwargs):
+        # Same settings as a (PaliGemma)Processor's SiglipImageProcessor
+        image_processor = getattr(processor, "image_processor", processor)
+        settings = {
+            "image_size": image_processor.size["height"],
+            "image_mean": image_processor.image_mean,
+            "image_std": image_processor.image_std,
+            "rescale_factor": image_processor.rescale_factor,
+        }
+        # Explicit arguments win, e.g. another image_size for a lower resolution
+        settings.update(kwargs)
+        return cls(**settings)
+
+    def _allocate(self, batch_size: int) -> torch.Tensor:
+        return torch.empty(batch_size, 3, self.image_size, self.image_size, dtype=self.dtype, pin_memory=self.pin_memory)
+
+    def decode(self, images) -> List[np.ndarray]:
+        return list(self.pool.map(decode_image, images))
+
+    @torch.no_grad()
+    def __call__(self, images, copy: bool = False) -> torch.Tensor:
+        arrays = self.decode(images)
+        if len(arrays) > self.buffer.shape[0]:
+            self.buffer = self._allocate(len(arrays))
+        pixel_values = self.buffer[:len(arrays)]
+
+        # Group by input size so every group is one resize_bicubic call
+        groups = {}
+        for i, array in enumerate(arrays):
+            groups.setdefault(array.shape[:2], []).append(i)
+        for (height, width), indices in groups.items():
+            batch = torch.from_numpy(np.stack([arrays[i] for i in indices]))  # [N, Height, Width, 3] uint8
+            if (height, width) != (self.image_size, self.image_size):
+                batch = resize_bicubic(batch, self.image_size, self.image_size)
+            else:
+                batch = batch.permute(0, 3, 1, 2)
+            if len(indices) == len(arrays):
+                pixel_values.copy_(batch)
+            else:
+                pixel_values[torch.tensor(indices)] = batch.to(self.dtype)
+
+        pixel_values.mul_(self.scale).add_(self.shift)
+        return pixel_values.clone() if copy else pixel_values
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,186 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+import torch
+
+from modeling_gemma import make_kv_cache
+
+
+@torch.no_grad()
+def generate_steps(
+    model,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    pixel_values: Optional[torch.Tensor] = None,
+    image_features: Optional[torch.Tensor] = None,
+    max_new_tokens: int = 50,
+    eos_token_id: Optional[int] = None,
+    select_rows: Optional[Callable[[torch.Tensor], None]] = None,
+) -> Iterator[Tuple[List[int], List[int]]]:
+    """
+    The KV-cached greedy decoding loop of `generate`, one step at a time. Yields the original batch indices of
+    the sequences still being generated and their new token, as soon as the step is done. Closing the generator
+    (break, close(), cancellation) frees the KV cache right away.
+    """
+    kv_cache = make_kv_cache(model.config.text_config)
+    outputs = None
+    try:
+        outputs = model(
+            input_ids=input_ids, attention_mask=attention_mask, pixel_values=pixel_values,
+            image_features=image_features, kv_cache=kv_cache,
+        )
+        # Next token after the last non-padding token, works for left and right padding
+        last = attention_mask.cumsum(-1).argmax(-1)
+        next_tokens = outputs.logits[torch.arange(input_ids.shape[0], device=last.device), last].argmax(-1)
+
+        # Original batch index of every row still being generated
+        active = torch.arange(input_ids.shape[0], device=input_ids.device)
+        for step in range(max_new_tokens):
+            yield active.tolist(), next_tokens.tolist()
+
+            if step == max_new_tokens - 1:
+                break
+            finished = next_tokens == eos_token_id if eos_token_id is not None else torch.zeros_like(next_tokens, dtype=torch.bool)
+            if finished.all():
+                break
+            if finished.any():
+                rows = (~finished).nonzero().squeeze(-1)
+                active, next_tokens, attention_mask = active[rows], next_tokens[rows], attention_mask[rows]
+                kv_cache.select(rows)
+                if select_rows is not None:
+                    select_rows(rows)
+
+            attention_mask = torch.cat([attention_mask, torch.ones_like(attention_mask[:, :1])], dim=-1)
+            outputs = model(input_ids=next_tokens.unsqueeze(-1), attention_mask=attention_mask, kv_cache=kv_cache)
+            next_tokens = outputs.logits[:, -1].argmax(-1)
+    finally:
+        # The outputs hold the cache tensors too (past_key_values)
+        outputs = None
+        kv_cache.clear()
+
+
+@torch.no_grad()
+def generate(
+    model,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    pixel_values: Optional[torch.Tensor] = None,
+    image_features: Optional[torch.Tensor] = None,
+    max_new_tokens: int = 50,
+    eos_token_id: Optional[int] = None,
+    select_rows: Optional[Callable[[torch.Tensor], None]] = None,
+) -> List[List[int]]:
+    """
+    Greedy decoding with a KV cache for a padded batch on our PaliGemmaForConditionalGeneration.
+
+    A sequence stops at `eos_token_id` or after `max_new_tokens` and is then dropped from the batch and
+    the cache, so the remaining ones don't pay for it. `select_rows(rows)` is called with the indices of
+    the rows that are kept, for callers that hold per-row state of their own (e.g. adapter ids).
+    Returns the generated token ids of every sequence, without the prompt.
+    """
+    generated = [[] for _ in range(input_ids.shape[0])]
+    for indices, tokens in generate_steps(model, input_ids, attention_mask, pixel_values, image_features,
+                                          max_new_tokens, eos_token_id, select_rows):
+        for index, token in zip(indices, tokens):
+            generated[index].append(token)
+    return generated
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a stream of token ids into text deltas. Only a window of the last tokens is decoded each time
+    (decoding it with the token before it keeps the leading spaces of SentencePiece tokens right), and
+    nothing is emitted while the text ends in an incomplete UTF-8 sequence (byte-fallback tokens).
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens: List[int] = []
+        # tokens[prefix_offset:read_offset] were already emitted and are decoded again for context
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, tokens: List[int]) -> str:
+        return self.tokenizer.decode(tokens, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token: int) -> str:
+        self.tokens.append(token)
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        text = self._decode(self.tokens[self.prefix_offset:])
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.tokens)
+        return text[len(prefix_text):]
+
+    def flush(self) -> str:
+        # Whatever is left, even an incomplete character
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        text = self._decode(self.tokens[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        return text[len(prefix_text):]
+
+
+def stream_generate(
+    model,
+    tokenizer,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    pixel_values: Optional[torch.Tensor] = None,
+    image_features: Optional[torch.Tensor] = None,
+    max_new_tokens: int = 50,
+    eos_token_id: Optional[int] = None,
+    skip_special_tokens: bool = True,
+) -> Iterator[str]:
+    """
+    `generate` for a single sequence (batch size 1) that yields the new text after every decode step instead
+    of all the tokens at the end. Joined, the pieces are the decoded generation. Stop iterating (break, or
+    close() when holding on to the generator) to cancel: the KV cache is freed right away.
+    """
+    if input_ids.shape[0] != 1:
+        raise ValueError(f"stream_generate streams a single sequence, got a batch of {input_ids.shape[0]}")
+    detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens)
+    steps = generate_steps(model, input_ids, attention_mask, pixel_values, image_features, max_new_tokens, eos_token_id)
+    try:
+        for _, (token,) in steps:
+            text = detokenizer.push(token)
+            if text:
+                yield text
+        text = detokenizer.flush()
+        if text:
+            yield text
+    finally:
+        steps.close()
+
+
+async def astream_generate(
+    model,
+    tokenizer,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    pixel_values: Optional[torch.Tensor] = None,
+    image_features: Optional[torch.Tensor] = None,
+    max_new_tokens: int = 50,
+    eos_token_id: Optional[int] = None,
+    skip_special_tokens: bool = True,
+) -> AsyncIterator[str]:
+    """
+    asyncio version of `stream_generate`. The decode steps run on a worker thread, so the event loop keeps
+    serving other clients meanwhile. Cancelling the consuming task (or aclose()) frees the KV cache as soon as
+    the step in progress finishes.
+    """
+    stream = stream_generate(model, tokenizer, input_ids, attention_mask, pixel_values, image_features,
+                             max_new_tokens, eos_token_id, skip_special_tokens)
+    # One thread per stream, so the steps and the final close() run in order on it
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            text = await asyncio.wrap_future(executor.submit(next, stream, None))
+            if text is None:
+                break
+            yield text
+    finally:
+        # A cancelled step keeps running on the thread, close() runs right after it
+        executor.submit(stream.close)
+        executor.shutdown(wait=False)
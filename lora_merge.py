@@ -0,0 +1,130 @@
+import json
+import math
+import os
+import re
+from typing import Dict, Optional
+
+import torch
+from safetensors.torch import load_file
+
+from checkpoint_writer import DIFF_ATTENTION_KEYWORDS
+
+# "base_model.model.<module>.lora_A.weight" as saved by PeftModel.save_pretrained, or with the adapter name
+# ("...lora_A.default.weight") as in the model's own state dict / trainable checkpoints
+LORA_KEY_PATTERN = re.compile(r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+PEFT_PREFIX = "base_model.model."
+
+
+def strip_peft_prefix(name: str) -> str:
+    return name[len(PEFT_PREFIX):] if name.startswith(PEFT_PREFIX) else name
+
+
+def read_adapter(adapter_path: str):
+    """Adapter config and tensors of a PeftModel.save_pretrained directory, without going through PEFT."""
+    with open(os.path.join(adapter_path, "adapter_config.json"), "r") as f:
+        adapter_config = json.load(f)
+    safetensors_path = os.path.join(adapter_path, "adapter_model.safetensors")
+    if os.path.isfile(safetensors_path):
+        tensors = load_file(safetensors_path, device="cpu")
+    else:
+        tensors = torch.load(os.path.join(adapter_path, "adapter_model.bin"), map_location="cpu", weights_only=True)
+    return adapter_config, tensors
+
+
+def lora_scaling(adapter_config, module_name: str) -> float:
+    # Same rules as peft's LoraLayer: per-module overrides from rank_pattern/alpha_pattern, alpha / sqrt(r) for rsLoRA
+    r, alpha = adapter_config["r"], adapter_config["lora_alpha"]
+    for pattern, value in (adapter_config.get("rank_pattern") or {}).items():
+        if re.match(rf".*\.{pattern}$", module_name):
+            r = value
+    for pattern, value in (adapter_config.get("alpha_pattern") or {}).items():
+        if re.match(rf".*\.{pattern}$", module_name):
+            alpha = value
+    return alpha / math.sqrt(r) if adapter_config.get("use_rslora", False) else alpha / r
+
+
+@torch.no_grad()
+def merge_lora_weights(model, tensors: Dict[str, torch.Tensor], adapter_config) -> int:
+    """
+    Fold W += B @ A * scaling into every adapted Linear of `model` (a plain, un-wrapped model) and return
+    the number of merged modules. The product is computed in float32 and cast back to the weight's dtype.
+    """
+    pairs = {}
+    for key, tensor in tensors.items():
+        match = LORA_KEY_PATTERN.match(key)
+        if match:
+            pairs.setdefault(match.group(1), {})[match.group(2)] = tensor
+
+    if adapter_config.get("fan_in_fan_out", False):
+        raise ValueError("Merging fan_in_fan_out (Conv1D) adapters is not supported")
+
+    for module_name, pair in pairs.items():
+        if set(pair) != {"A", "B"}:
+            raise ValueError(f"Incomplete LoRA weights for {module_name}: only lora_{''.join(pair)}")
+        weight = model.get_submodule(module_name).weight
+        # [Out_Features, R] @ [R, In_Features] -> [Out_Features, In_Features]
+        delta = pair["B"].to(device=weight.device, dtype=torch.float32) @ pair["A"].to(device=weight.device, dtype=torch.float32)
+        weight.copy_((weight.float() + delta * lora_scaling(adapter_config, module_name)).to(weight.dtype))
+    return len(pairs)
+
+
+def load_diff_attention_params(model, tensors: Dict[str, torch.Tensor]) -> int:
+    # The lambdas and subln weights, keys saved from a PeftModel still carry the "base_model.model." prefix
+    params = {
+        strip_peft_prefix(key): tensor for key, tensor in tensors.items()
+        if any(keyword in key for keyword in DIFF_ATTENTION_KEYWORDS) and not LORA_KEY_PATTERN.match(key)
+    }
+    _, unexpected_keys = model.load_state_dict(params, strict=False)
+    if unexpected_keys:
+        raise ValueError(f"Differential attention params don't match the model, unexpected keys: {unexpected_keys[:5]}")
+    return len(params)
+
+
+def load_diff_attention_file(path: str) -> Dict[str, torch.Tensor]:
+    # diff_attention_params.pth from older runs or a safetensors checkpoint from AsyncCheckpointWriter
+    if path.endswith(".safetensors"):
+        return load_file(path, device="cpu")
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def merge_adapter(model, adapter_path: Optional[str] = None, new_weights_path: Optional[str] = None,
+                  adapter_config: Optional[dict] = None):
+    """
+    Merge a LoRA adapter directory and/or a differential attention params file into `model` in place.
+
+    `new_weights_path` may also be a trainable checkpoint holding the LoRA weights themselves (see
+    checkpoint_writer.py), those need `adapter_config` ({"r": ..., "lora_alpha": ...}) since they don't
+    come with an adapter_config.json.
+    """
+    if adapter_path is not None:
+        config, tensors = read_adapter(adapter_path)
+        num_merged = merge_lora_weights(model, tensors, config)
+        print(f"Merged {num_merged} LoRA modules from {adapter_path}")
+
+    if new_weights_path is not None:
+        tensors = load_diff_attention_file(new_weights_path)
+        if any(LORA_KEY_PATTERN.match(key) for key in tensors):
+            if adapter_config is None:
+                raise ValueError(f"{new_weights_path} holds LoRA weights, pass adapter_config to merge them")
+            num_merged = merge_lora_weights(model, tensors, adapter_config)
+            print(f"Merged {num_merged} LoRA modules from {new_weights_path}")
+        num_params = load_diff_attention_params(model, tensors)
+        print(f"Loaded {num_params} differential attention params from {new_weights_path}")
+    return model
+
+
+def load_merged_model(base_model_name: str, adapter_path: Optional[str] = None, new_weights_path: Optional[str] = None,
+                      device: str = "cpu", dtype: Optional[torch.dtype] = None):
+    """
+    Drop-in replacement for load_finetuned_model (main.py, evaluation/vqav2.py) that returns our plain
+    PaliGemmaForConditionalGeneration with the adapter already merged, so inference runs without PEFT.
+    """
+    from transformers import AutoProcessor
+    from utils import load_hf_model
+
+    processor = AutoProcessor.from_pretrained(base_model_name)
+    model, _ = load_hf_model(base_model_name, "cpu")
+    # Merge on CPU in the checkpoint's precision, then move
+    merge_adapter(model, adapter_path, new_weights_path)
+    model = model.to(device=device, dtype=dtype) if dtype is not None else model.to(device)
+    return model.eval(), processor
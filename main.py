@@ -8,10 +8,8 @@ import re
 import torch
 import torch.nn as nn
 
-def resize_images(img, target_size=(224, 224)):
-    resized_img = img.resize(target_size, Image.Resampling.LANCZOS)
-
-    return resized_img 
+from image_preprocessing import BatchImagePreprocessor
+from utils import tokenize_prompts
 
 def load_finetuned_model(base_model_name, adapter_path, new_weights_path=None):
     # Load the processor/tokenizer
@@ -58,8 +56,10 @@ def load_finetuned_model(base_model_name, adapter_path, new_weights_path=None):
     return model_with_adapter, processor
 
 def generate_text(model, tokenizer, input_text, max_length=50, num_beams=3, temperature=1.0):
-    # Tokenize the input text and move to the appropriate device
-    inputs = processor(prompt, raw_image.convert("RGB"), return_tensors="pt").to(model.device)
+    # Tokenize the input text, resize and normalize the image, and move both to the appropriate device
+    inputs = tokenize_prompts(processor, [prompt])
+    inputs["pixel_values"] = preprocessor([raw_image])
+    inputs = {name: tensor.to(model.device) for name, tensor in inputs.items()}
 
     # Generate the output
     output = model.generate(**inputs, max_new_tokens=20)
@@ -102,6 +102,8 @@ if __name__ == "__main__":
 
     # Load the model and processor
     model, processor = load_finetuned_model(base_model_name, adapter_path, new_weights_path=new_weights_path)
+    # Same pixel_values as the processor, one image at a time
+    preprocessor = BatchImagePreprocessor.from_processor(processor, max_batch_size=1)
 
     # Check if the number of images matches the number of prompts
     # Custom sorting function to extract the number at the end of each file name
@@ -120,8 +122,8 @@ if __name__ == "__main__":
         # Construct the full path for the image file
         image_path = os.path.join(image_folder, image_file)
 
-        # Process the image
-        raw_image = resize_images(Image.open(image_path))
+        # Load the image, generate_text resizes it
+        raw_image = Image.open(image_path)
 
         # Generate text
         generated_text = generate_text(model, processor, prompt, max_length=20)
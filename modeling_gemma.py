@@ -1,19 +1,28 @@
 import torch
 from torch import nn
-from typing import Optional, Tuple, List
+from typing import TYPE_CHECKING, Optional, Tuple, List
 from torch.nn import CrossEntropyLoss
 import math
 import torch.nn.functional as F
-from modeling_siglip import SiglipVisionConfig, SiglipVisionModel
-from transformers import PreTrainedModel, PretrainedConfig, GenerationConfig, BitsAndBytesConfig
-from transformers.modeling_outputs import CausalLMOutput
+from torch.utils.checkpoint import checkpoint
+from contextlib import contextmanager
+from modeling_siglip import SiglipVisionConfig, SiglipVisionModel, layer_checkpoint_modes
+from transformers import PreTrainedModel, PretrainedConfig, GenerationConfig
+from transformers.modeling_outputs import CausalLMOutput, CausalLMOutputWithPast
 from dataclasses import dataclass, field
 
+if TYPE_CHECKING:
+    # Only needed by callers that quantize, they import it themselves
+    from transformers import BitsAndBytesConfig
+
 try:
     from apex.normalization import FusedRMSNorm as RMSNorm 
 except ModuleNotFoundError:
     print("No fused RMSNorm")
     from rms_norm import RMSNorm
+from rms_norm import rms_norm
+from diff_attention import differential_attention
+from chunked_loss import chunked_causal_lm_loss
 
 class SwiGLU(nn.Module):
     def __init__(self, d_model, expansion_factor=8/3):
@@ -36,11 +45,69 @@ class SwiGLU(nn.Module):
         result = gated_output @ self.W2.weight.T + self.W2.bias
         return result
 
+# nn.init functions that do nothing under no_init_weights
+SKIPPED_INIT_FUNCTIONS = (
+    "uniform_", "normal_", "trunc_normal_", "constant_", "ones_", "zeros_",
+    "xavier_uniform_", "xavier_normal_", "kaiming_uniform_", "kaiming_normal_", "orthogonal_",
+)
+_init_enabled = True
+
+
+@contextmanager
+def no_init_weights():
+    """
+    Build models without initializing their weights, for weights a checkpoint overwrites right after: the nn.init
+    functions do nothing and PaliGemmaForConditionalGeneration skips init_weights(). Parameters hold whatever
+    memory they got until they are loaded (see init_missing_weights), buffers are still computed.
+    Patches torch.nn.init, so don't build models on other threads meanwhile.
+    """
+    global _init_enabled
+    originals = {name: getattr(nn.init, name) for name in SKIPPED_INIT_FUNCTIONS}
+    previous, _init_enabled = _init_enabled, False
+    for name in originals:
+        setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(nn.init, name, function)
+        _init_enabled = previous
+
+
+def init_missing_weights(model: nn.Module, missing_keys: List[str]):
+    """
+    Initialize the parameters a checkpoint didn't have (load_state_dict(strict=False).missing_keys) of a model
+    built under no_init_weights, the way the model would have. The loaded parameters of the same modules are kept.
+    """
+    # Tied weights (the lm_head) are missing under one name but loaded under the other
+    missing_keys = set(missing_keys)
+    state_dict = model.state_dict(keep_vars=True)
+    loaded = {id(tensor) for name, tensor in state_dict.items() if name not in missing_keys}
+    by_module = {}
+    for key in missing_keys:
+        if id(state_dict[key]) in loaded:
+            continue
+        module_name, _, tensor_name = key.rpartition(".")
+        by_module.setdefault(module_name, set()).add(tensor_name)
+    for module_name, tensor_names in by_module.items():
+        module = model.get_submodule(module_name)
+        if not hasattr(module, "reset_parameters"):
+            # e.g. the differential-attention lambdas, which are drawn with Tensor.normal_ and are initialized already
+            continue
+        kept = {name: param.detach().clone() for name, param in module.named_parameters(recurse=False) if name not in tensor_names}
+        with torch.no_grad():
+            module.reset_parameters()
+            for name, tensor in kept.items():
+                getattr(module, name).copy_(tensor)
+
+
 class KVCache():
 
     def __init__(self) -> None:
         self.key_cache: List[torch.Tensor] = []
         self.value_cache: List[torch.Tensor] = []
+        # Length of the image prefix, set during prefill when the model uses sliding-window attention
+        self.num_prefix_tokens = 0
     
     def num_items(self) -> int:
         if len(self.key_cache) == 0:
@@ -68,6 +135,70 @@ class KVCache():
         # ... and then we return all the existing keys + the new ones.
         return self.key_cache[layer_idx], self.value_cache[layer_idx]
 
+    def select(self, rows: torch.Tensor):
+        # Keep only the given batch rows, e.g. to drop finished sequences from a batch
+        self.key_cache = [keys.index_select(0, rows) for keys in self.key_cache]
+        self.value_cache = [values.index_select(0, rows) for values in self.value_cache]
+
+    def clear(self):
+        # Release the cached tensors now, e.g. when a streamed generation is cancelled
+        self.key_cache = []
+        self.value_cache = []
+
+class RollingKVCache(KVCache):
+    """
+    KV-Cache for sliding-window attention. On the sliding layers it only keeps the image prefix (the first
+    `num_prefix_tokens` positions) and the last `window` positions, so its size stays
+    bounded however long the context gets. The other layers keep everything, like KVCache.
+    """
+
+    def __init__(self, window: int, sliding_layers: Optional[List[int]] = None) -> None:
+        super().__init__()
+        self.window = window
+        # None means every layer slides
+        self.sliding_layers = sliding_layers
+        # Number of positions seen so far, the sliding layers hold fewer
+        self.seen_tokens = 0
+
+    @classmethod
+    def from_config(cls, config: "GemmaConfig") -> "RollingKVCache":
+        return cls(config.sliding_window, config.sliding_window_layers)
+
+    def num_items(self) -> int:
+        return self.seen_tokens
+
+    def clear(self):
+        super().clear()
+        self.seen_tokens = 0
+
+    def is_sliding(self, layer_idx: int) -> bool:
+        return self.sliding_layers is None or layer_idx in self.sliding_layers
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if layer_idx == 0:
+            self.seen_tokens += key_states.shape[-2]
+        key_states, value_states = super().update(key_states, value_states, layer_idx)
+
+        max_items = self.num_prefix_tokens + self.window
+        if self.is_sliding(layer_idx) and key_states.shape[-2] > max_items:
+            # Drop the positions that fell out of the window. The current step still attends to all the
+            # returned keys, the mask hides the ones outside its window
+            prefix = self.num_prefix_tokens
+            self.key_cache[layer_idx] = torch.cat([key_states[:, :, :prefix], key_states[:, :, -self.window:]], dim=-2)
+            self.value_cache[layer_idx] = torch.cat([value_states[:, :, :prefix], value_states[:, :, -self.window:]], dim=-2)
+        return key_states, value_states
+
+def make_kv_cache(config: "GemmaConfig") -> KVCache:
+    # A rolling cache for sliding-window models, so the cache doesn't grow with the context
+    if getattr(config, "sliding_window", None) is not None:
+        return RollingKVCache.from_config(config)
+    return KVCache()
+
 '''
 class GemmaConfig(PretrainedConfig):
     model_type = "gemma"
@@ -192,6 +323,15 @@ class GemmaConfig(PretrainedConfig):
         layer_norm_eps=1e-6,
         rms_norm_eps=1e-6,
         attention_dropout = True,
+        gradient_checkpointing=None,
+        gradient_checkpointing_every=1,
+        sliding_window=None,
+        sliding_window_layers=None,
+        fold_query_heads=True,
+        recompute_attention=False,
+        mlp_chunk_size=None,
+        mlp_chunk_recompute=False,
+        loss_chunk_size=None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -209,6 +349,23 @@ class GemmaConfig(PretrainedConfig):
         self.layer_norm_eps = layer_norm_eps
         self.rms_norm_eps = rms_norm_eps
         self.attention_dropout = attention_dropout
+        # Activation checkpointing: None, "layer", "attention" or "mlp", applied to every k-th layer
+        self.gradient_checkpointing = gradient_checkpointing
+        self.gradient_checkpointing_every = gradient_checkpointing_every
+        # Sliding-window attention: tokens only attend to the image prefix and the tokens less than `sliding_window`
+        # positions away, on the layers in `sliding_window_layers` (all layers if None). See RollingKVCache
+        self.sliding_window = sliding_window
+        self.sliding_window_layers = sliding_window_layers
+        # Grouped-query attention without materializing repeat_kv copies of the keys and values
+        self.fold_query_heads = fold_query_heads
+        # Differential attention that recomputes its attention maps in backward, see diff_attention.py
+        self.recompute_attention = recompute_attention
+        # Run GemmaMLP on `mlp_chunk_size` positions at a time. When training, chunks are only used with
+        # `mlp_chunk_recompute`, which checkpoints every chunk
+        self.mlp_chunk_size = mlp_chunk_size
+        self.mlp_chunk_recompute = mlp_chunk_recompute
+        # Training loss from the lm_head in chunks of `loss_chunk_size` supervised positions, see chunked_loss.py
+        self.loss_chunk_size = loss_chunk_size
     
     def to_dict(self):
         """Convert configuration to a dictionary."""
@@ -228,7 +385,16 @@ class GemmaConfig(PretrainedConfig):
             "layer_norm_eps": self.layer_norm_eps,
             "rms_norm_eps": self.rms_norm_eps,
             "pad_token_id": self.pad_token_id,
-            "attention_dropout": self.attention_dropout
+            "attention_dropout": self.attention_dropout,
+            "gradient_checkpointing": self.gradient_checkpointing,
+            "gradient_checkpointing_every": self.gradient_checkpointing_every,
+            "sliding_window": self.sliding_window,
+            "sliding_window_layers": self.sliding_window_layers,
+            "fold_query_heads": self.fold_query_heads,
+            "recompute_attention": self.recompute_attention,
+            "mlp_chunk_size": self.mlp_chunk_size,
+            "mlp_chunk_recompute": self.mlp_chunk_recompute,
+            "loss_chunk_size": self.loss_chunk_size
         })
         return output
 
@@ -251,6 +417,15 @@ class GemmaConfig(PretrainedConfig):
             rms_norm_eps=config_dict.get("rms_norm_eps", 1e-6),
             pad_token_id=config_dict.get("pad_token_id", 0),
             attention_dropout=config_dict.get("attention_dropout", True),
+            gradient_checkpointing=config_dict.get("gradient_checkpointing", None),
+            gradient_checkpointing_every=config_dict.get("gradient_checkpointing_every", 1),
+            sliding_window=config_dict.get("sliding_window", None),
+            sliding_window_layers=config_dict.get("sliding_window_layers", None),
+            fold_query_heads=config_dict.get("fold_query_heads", True),
+            recompute_attention=config_dict.get("recompute_attention", False),
+            mlp_chunk_size=config_dict.get("mlp_chunk_size", None),
+            mlp_chunk_recompute=config_dict.get("mlp_chunk_recompute", False),
+            loss_chunk_size=config_dict.get("loss_chunk_size", None),
             **config_dict
         )
 
@@ -313,11 +488,10 @@ class GemmaRMSNorm(nn.Module):
         return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
 
     def forward(self, x):
-        output = self._norm(x.float())
         # Llama does x.to(float16) * w whilst Gemma is (x * w).to(float16)
         # See https://github.com/huggingface/transformers/pull/29402
-        output = output * (1.0 + self.weight.float())
-        return output.type_as(x)
+        # Same as (self._norm(x.float()) * (1.0 + self.weight.float())).type_as(x), with the rstd recomputed in backward
+        return rms_norm(x, self.weight, self.eps, unit_offset=True)
 
 class GemmaRotaryEmbedding(nn.Module):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
@@ -381,8 +555,11 @@ class GemmaMLP(nn.Module):
         self.gate_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
         self.up_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
         self.down_proj = nn.Linear(self.intermediate_size, self.hidden_size, bias=False)
+        # Positions per chunk, None runs the whole sequence at once
+        self.chunk_size = getattr(config, "mlp_chunk_size", None)
+        self.chunk_recompute = getattr(config, "mlp_chunk_recompute", False)
 
-    def forward(self, x):
+    def _forward(self, x):
         # Equivalent to:
         # y = self.gate_proj(x) # [Batch_Size, Seq_Len, Hidden_Size] -> [Batch_Size, Seq_Len, Intermediate_Size]
         # y = torch.gelu(y, approximate="tanh") # [Batch_Size, Seq_Len, Intermediate_Size]
@@ -391,6 +568,31 @@ class GemmaMLP(nn.Module):
         # z = self.down_proj(z) # [Batch_Size, Seq_Len, Intermediate_Size] -> [Batch_Size, Seq_Len, Hidden_Size]
         return self.down_proj(nn.functional.gelu(self.gate_proj(x), approximate="tanh") * self.up_proj(x))
 
+    def forward(self, x):
+        seq_len = x.shape[1]
+        if self.chunk_size is None or seq_len <= self.chunk_size:
+            return self._forward(x)
+        # The gate and up projections are [Batch_Size, Seq_Len, Intermediate_Size] each, running a slice of the
+        # sequence at a time caps them at [Batch_Size, Chunk_Size, Intermediate_Size]
+        chunks = range(0, seq_len, self.chunk_size)
+        if self.training:
+            if not self.chunk_recompute:
+                # Autograd would keep the intermediate activations of every chunk anyway
+                return self._forward(x)
+            # Only the chunk inputs are saved, each chunk's intermediates are recomputed in backward
+            return torch.cat([
+                checkpoint(self._forward, x[:, start:start + self.chunk_size], use_reentrant=False) for start in chunks
+            ], dim=1)
+
+        output = None
+        for start in chunks:
+            chunk_output = self._forward(x[:, start:start + self.chunk_size])
+            if output is None:
+                # [Batch_Size, Seq_Len, Hidden_Size], with the dtype the projections produce
+                output = chunk_output.new_empty(x.shape[0], seq_len, chunk_output.shape[-1])
+            output[:, start:start + self.chunk_size] = chunk_output
+        return output
+
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     batch, num_key_value_heads, slen, head_dim = hidden_states.shape
     if n_rep == 1:
@@ -417,6 +619,14 @@ class GemmaAttention(nn.Module):
         self.max_position_embeddings = config.max_position_embeddings
         self.rope_theta = config.rope_theta
         self.is_causal = True
+        # Window size if this layer uses sliding-window attention, else None
+        sliding_layers = getattr(config, "sliding_window_layers", None)
+        uses_window = sliding_layers is None or layer_idx in sliding_layers
+        self.sliding_window = getattr(config, "sliding_window", None) if uses_window else None
+        # Attend with the shared KV heads directly instead of repeat_kv copies, see forward
+        self.fold_query_heads = getattr(config, "fold_query_heads", True)
+        # Save only Q, K, V and the log-sum-exp for backward instead of the attention maps
+        self.recompute_attention = getattr(config, "recompute_attention", False)
 
         assert self.hidden_size % self.num_heads == 0, (
             f"hidden_size {self.hidden_size} must be divisible by num_heads {self.num_heads}."
@@ -447,6 +657,16 @@ class GemmaAttention(nn.Module):
 
         # RMSNorm for stability
         self.subln = RMSNorm(self.head_dim, eps=1e-5, elementwise_affine=True)
+        # Per-request lambdas when serving several adapters at once, see multi_lora.py
+        self.adapter_lambdas = None
+
+    def lambda_full(self, like: torch.Tensor) -> torch.Tensor:
+        if self.adapter_lambdas is not None:
+            # [Batch_Size, 1, 1, 1]
+            return self.adapter_lambdas(self).type_as(like)
+        lambda_1 = torch.exp(torch.sum(self.lambda_q1 * self.lambda_k1, dim=-1).float()).type_as(like)
+        lambda_2 = torch.exp(torch.sum(self.lambda_q2 * self.lambda_k2, dim=-1).float()).type_as(like)
+        return lambda_1 - lambda_2 + self.lambda_init
 
     def forward(
         self,
@@ -474,30 +694,54 @@ class GemmaAttention(nn.Module):
         if kv_cache is not None:
             key_states, value_states = kv_cache.update(key_states, value_states, self.layer_idx)
 
-        # Expand key/value states to match query heads
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
-
-        # Compute attention weights
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
-        attn_weights = torch.nan_to_num(attn_weights)
-        if attention_mask is not None:
-            attn_weights += attention_mask
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).type_as(query_states)
-
-        # Differential Attention
-        lambda_1 = torch.exp(torch.sum(self.lambda_q1 * self.lambda_k1, dim=-1).float()).type_as(query_states)
-        lambda_2 = torch.exp(torch.sum(self.lambda_q2 * self.lambda_k2, dim=-1).float()).type_as(query_states)
-        # print(lambda_full)
-        # exit()
-        lambda_full = lambda_1 - lambda_2 + self.lambda_init
-
-        # Reshape and apply lambda adjustment
-        attn_weights = attn_weights.view(bsz, self.num_heads, 1, q_len, -1)
-        attn_weights = attn_weights[:, :, 0] - (lambda_full * attn_weights[:, :, 0])
-
-        # Compute attention outputs
-        attn_output = torch.matmul(attn_weights, value_states)
+        kv_len = key_states.shape[-2]
+        if attention_mask is not None and attention_mask.shape[-1] > kv_len:
+            # A RollingKVCache dropped the middle positions, keep the mask of the image prefix and the recent ones
+            prefix = kv_cache.num_prefix_tokens
+            attention_mask = torch.cat([attention_mask[..., :prefix], attention_mask[..., prefix - kv_len:]], dim=-1)
+
+        if self.fold_query_heads:
+            # MQA/GQA without copies of the KV heads: the query heads sharing a KV head are folded into the sequence
+            # dimension, so each KV head is read once (one matmul per KV head instead of one per query head)
+            # [Batch_Size, Num_Heads_Q, Q_Len, Head_Dim] -> [Batch_Size, Num_Heads_KV, Num_Groups * Q_Len, Head_Dim]
+            query_states = query_states.reshape(bsz, self.num_key_value_heads, self.num_key_value_groups * q_len, self.head_dim)
+        else:
+            # Expand key/value states to match query heads
+            key_states = repeat_kv(key_states, self.num_key_value_groups)
+            value_states = repeat_kv(value_states, self.num_key_value_groups)
+
+        if self.recompute_attention:
+            # Same result, but the attention maps are recomputed blockwise in backward instead of being stored
+            lambda_full = self.lambda_full(query_states)
+            groups = self.num_key_value_groups if self.fold_query_heads else 1
+            attn_output = differential_attention(query_states, key_states, value_states, attention_mask, lambda_full,
+                                                 1 / math.sqrt(self.head_dim), groups=groups)
+            attn_output = attn_output.view(bsz, self.num_heads, q_len, self.head_dim)
+            attn_weights = None
+        else:
+            # Compute attention weights
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+            attn_weights = torch.nan_to_num(attn_weights)
+            # [Batch_Size, Num_Heads_Q, Q_Len, KV_Len], a view of the folded layout
+            attn_weights = attn_weights.view(bsz, self.num_heads, q_len, kv_len)
+            if attention_mask is not None:
+                attn_weights += attention_mask
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).type_as(query_states)
+
+            # Differential Attention
+            lambda_full = self.lambda_full(query_states)
+
+            # Reshape and apply lambda adjustment
+            attn_weights = attn_weights.view(bsz, self.num_heads, 1, q_len, -1)
+            attn_weights = attn_weights[:, :, 0] - (lambda_full * attn_weights[:, :, 0])
+
+            # Compute attention outputs
+            if self.fold_query_heads:
+                # [Batch_Size, Num_Heads_KV, Num_Groups * Q_Len, KV_Len] @ [Batch_Size, Num_Heads_KV, KV_Len, Head_Dim]
+                attn_output = torch.matmul(attn_weights.view(bsz, self.num_key_value_heads, -1, kv_len), value_states)
+                attn_output = attn_output.view(bsz, self.num_heads, q_len, self.head_dim)
+            else:
+                attn_output = torch.matmul(attn_weights, value_states)
         attn_output = self.subln(attn_output)
         attn_output = attn_output * (1 - self.lambda_init)
         attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.num_heads * self.head_dim)
@@ -654,14 +898,16 @@ class GemmaDecoderLayer(nn.Module):
         self.input_layernorm = GemmaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.post_attention_layernorm = GemmaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         # self.swiglu_layer = SwiGLU(config.hidden_size)
+        # Set by GemmaModel.set_gradient_checkpointing
+        self.checkpoint_mode = None
 
-    def forward(
+    def _attention_block(
         self,
         hidden_states: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
         position_ids: Optional[torch.LongTensor] = None,
         kv_cache: Optional[KVCache] = None,
-    ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
+    ) -> torch.Tensor:
         residual = hidden_states
         # [Batch_Size, Seq_Len, Hidden_Size]
         hidden_states = self.input_layernorm(hidden_states)
@@ -675,8 +921,9 @@ class GemmaDecoderLayer(nn.Module):
         )
 
         # [Batch_Size, Seq_Len, Hidden_Size]
-        hidden_states = residual + hidden_states # (equation 4)
+        return residual + hidden_states # (equation 4)
 
+    def _mlp_block(self, hidden_states: torch.Tensor) -> torch.Tensor:
         # [Batch_Size, Seq_Len, Hidden_Size]
         residual = hidden_states # Y^l
         # [Batch_Size, Seq_Len, Hidden_Size]
@@ -695,6 +942,31 @@ class GemmaDecoderLayer(nn.Module):
 
         return hidden_states
 
+    def _forward(self, hidden_states, attention_mask=None, position_ids=None):
+        return self._mlp_block(self._attention_block(hidden_states, attention_mask, position_ids))
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        kv_cache: Optional[KVCache] = None,
+    ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
+        # Recompute the checkpointed part in backward instead of storing its activations (attention maps, MLP).
+        # Recomputation would update the KV-Cache twice, so never checkpoint when one is used
+        checkpoint_mode = self.checkpoint_mode if self.training and torch.is_grad_enabled() and kv_cache is None else None
+        if checkpoint_mode == "layer":
+            return checkpoint(self._forward, hidden_states, attention_mask, position_ids, use_reentrant=False)
+
+        if checkpoint_mode == "attention":
+            hidden_states = checkpoint(self._attention_block, hidden_states, attention_mask, position_ids, use_reentrant=False)
+        else:
+            hidden_states = self._attention_block(hidden_states, attention_mask, position_ids, kv_cache)
+
+        if checkpoint_mode == "mlp":
+            return checkpoint(self._mlp_block, hidden_states, use_reentrant=False)
+        return self._mlp_block(hidden_states)
+
 class GemmaModel(nn.Module):
 
     def __init__(self, config: GemmaConfig):
@@ -708,10 +980,15 @@ class GemmaModel(nn.Module):
             [GemmaDecoderLayer(config, layer_idx) for layer_idx in range(config.num_hidden_layers)]
         )
         self.norm = GemmaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.set_gradient_checkpointing(config.gradient_checkpointing, config.gradient_checkpointing_every)
 
     def get_input_embeddings(self):
         return self.embed_tokens
 
+    def set_gradient_checkpointing(self, mode: Optional[str] = "layer", every: int = 1):
+        for layer, layer_mode in zip(self.layers, layer_checkpoint_modes(len(self.layers), mode, every)):
+            layer.checkpoint_mode = layer_mode
+
     # Ignore copy
     def forward(
         self,
@@ -719,6 +996,7 @@ class GemmaModel(nn.Module):
         position_ids: Optional[torch.LongTensor] = None,
         inputs_embeds: Optional[torch.FloatTensor] = None,
         kv_cache: Optional[KVCache] = None,
+        sliding_attention_mask: Optional[torch.Tensor] = None,
         # **kwargs,
     ) -> torch.FloatTensor:
         # [Batch_Size, Seq_Len, Hidden_Size]
@@ -727,19 +1005,35 @@ class GemmaModel(nn.Module):
         normalizer = torch.tensor(self.config.hidden_size**0.5, dtype=hidden_states.dtype)
         hidden_states = hidden_states * normalizer
 
+        hidden_states = self.forward_layers(hidden_states, attention_mask, position_ids, kv_cache, sliding_attention_mask)
+
+        # [Batch_Size, Seq_Len, Hidden_Size]
+        hidden_states = self.norm(hidden_states)
+
+        # [Batch_Size, Seq_Len, Hidden_Size]
+        return hidden_states
+
+    def forward_layers(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        kv_cache: Optional[KVCache] = None,
+        sliding_attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # Only the decoder layers, without the embedding scale and the final norm (see pipeline_parallel.py)
         for decoder_layer in self.layers:
+            # Sliding-window layers use the window-aware mask
+            layer_mask = attention_mask
+            if decoder_layer.self_attn.sliding_window is not None and sliding_attention_mask is not None:
+                layer_mask = sliding_attention_mask
             # [Batch_Size, Seq_Len, Hidden_Size]
             hidden_states = decoder_layer(
                 hidden_states,
-                attention_mask=attention_mask,
+                attention_mask=layer_mask,
                 position_ids=position_ids,
                 kv_cache=kv_cache,
             )
-
-        # [Batch_Size, Seq_Len, Hidden_Size]
-        hidden_states = self.norm(hidden_states)
-
-        # [Batch_Size, Seq_Len, Hidden_Size]
         return hidden_states
 
 class GemmaForCausalLM(nn.Module):
@@ -762,6 +1056,8 @@ class GemmaForCausalLM(nn.Module):
         position_ids: Optional[torch.LongTensor] = None,
         inputs_embeds: Optional[torch.FloatTensor] = None,
         kv_cache: Optional[KVCache] = None,
+        sliding_attention_mask: Optional[torch.Tensor] = None,
+        compute_logits: bool = True,
         # **kwargs,
     ) -> CausalLMOutput:
 
@@ -771,9 +1067,14 @@ class GemmaForCausalLM(nn.Module):
             position_ids=position_ids,
             inputs_embeds=inputs_embeds,
             kv_cache=kv_cache,
+            sliding_attention_mask=sliding_attention_mask,
             # **kwargs,
         )
 
+        if not compute_logits:
+            # The caller projects the final hidden states itself, see chunked_loss.py
+            return CausalLMOutputWithPast(hidden_states=hidden_states)
+
         # Compute logits
         logits = self.lm_head(hidden_states).float()
 
@@ -788,8 +1089,8 @@ class GemmaForCausalLM(nn.Module):
             past_key_values = list(zip(kv_cache.key_cache, kv_cache.value_cache))
             return_data["past_key_values"] = past_key_values
 
-        # Return as CausalLMOutput with keyword arguments
-        return CausalLMOutput(**return_data)
+        # CausalLMOutput has no past_key_values field
+        return CausalLMOutputWithPast(**return_data)
 
 class PaliGemmaMultiModalProjector(nn.Module):
     def __init__(self, config: PaliGemmaConfig):
@@ -802,7 +1103,9 @@ class PaliGemmaMultiModalProjector(nn.Module):
         return hidden_states
 
 class PaliGemmaForConditionalGeneration(PreTrainedModel):
-    def __init__(self, config: PaliGemmaConfig, bnb_config: Optional[BitsAndBytesConfig] = None):
+    supports_gradient_checkpointing = True
+
+    def __init__(self, config: PaliGemmaConfig, bnb_config: Optional["BitsAndBytesConfig"] = None):
         super().__init__(config)
         self.config = config
         self.bnb_config = bnb_config  # Store the bnb_config
@@ -824,19 +1127,34 @@ class PaliGemmaForConditionalGeneration(PreTrainedModel):
         
         self.loss_f = torch.nn.CrossEntropyLoss(ignore_index=-100)  # -100 is the ignore token
 
-        self.init_weights()
+        if _init_enabled:
+            self.init_weights()
+        else:
+            # Under no_init_weights, a checkpoint overwrites the weights anyway
+            self.tie_weights()
 
     def tie_weights(self):
         return self.language_model.tie_weights()
 
+    def set_gradient_checkpointing(self, mode: Optional[str] = "layer", every: int = 1, vision: bool = True):
+        # mode: None, "layer" (whole layers), "attention" or "mlp" (only that sub-block), on every `every`-th layer
+        self.language_model.model.set_gradient_checkpointing(mode, every)
+        if vision:
+            self.vision_tower.vision_model.encoder.set_gradient_checkpointing(mode, every)
+
+    def gradient_checkpointing_enable(self, gradient_checkpointing_kwargs=None):
+        # Called by Trainer when TrainingArguments.gradient_checkpointing is set
+        self.set_gradient_checkpointing("layer")
+
+    def gradient_checkpointing_disable(self):
+        self.set_gradient_checkpointing(None)
+
     def _merge_input_ids_with_image_features(
         self, image_features: torch.Tensor, inputs_embeds: torch.Tensor, input_ids: torch.Tensor, attention_mask: torch.Tensor, kv_cache: Optional[KVCache] = None
     ):
-        _, _, embed_dim = image_features.shape
+        embed_dim = inputs_embeds.shape[-1]
         batch_size, sequence_length = input_ids.shape
         dtype, device = inputs_embeds.dtype, inputs_embeds.device
-        # Shape: [Batch_Size, Seq_Len, Hidden_Size]
-        scaled_image_features = image_features / (self.config.hidden_size**0.5)
     
         # Combine the embeddings of the image tokens, the text tokens and mask out all the padding tokens.
         final_embedding = torch.zeros(batch_size, sequence_length, embed_dim, dtype=inputs_embeds.dtype, device=inputs_embeds.device)
@@ -855,19 +1173,38 @@ class PaliGemmaForConditionalGeneration(PreTrainedModel):
         # Add the text embeddings
         final_embedding = torch.where(text_mask_expanded, inputs_embeds, final_embedding)
         # Insert image embeddings. We can't use torch.where because the sequence length of scaled_image_features is not equal to the sequence length of the final embedding
-        final_embedding = final_embedding.masked_scatter(image_mask_expanded, scaled_image_features)
+        # Decode steps have no image tokens and pass no image features
+        if image_features is not None:
+            # The number of image tokens follows the resolution, it just has to match the number of image features
+            num_image_tokens = int(image_mask.sum())
+            if num_image_tokens * embed_dim != image_features.numel():
+                raise ValueError(
+                    f"The prompts have {num_image_tokens} image tokens but there are {image_features.numel() // embed_dim} image features"
+                )
+            # Shape: [Batch_Size, Seq_Len, Hidden_Size]
+            scaled_image_features = image_features / (self.config.hidden_size**0.5)
+            final_embedding = final_embedding.masked_scatter(image_mask_expanded, scaled_image_features)
         # Zero out padding tokens
         final_embedding = torch.where(pad_mask_expanded, torch.zeros_like(final_embedding), final_embedding)
 
+        causal_mask, position_ids, sliding_mask = self._attention_masks(
+            input_ids, attention_mask, sequence_length, dtype, device, kv_cache
+        )
+        return final_embedding, causal_mask, position_ids, sliding_mask
+
+    def _attention_masks(
+        self, input_ids: Optional[torch.Tensor], attention_mask: torch.Tensor, q_len: int, dtype: torch.dtype,
+        device: torch.device, kv_cache: Optional[KVCache] = None
+    ):
+        # Only needs the input ids to find the image prefix during prefill, decode steps can pass None
+        batch_size = attention_mask.shape[0]
+
         #### CREATE THE ATTENTION MASK ####
 
-        dtype, device = inputs_embeds.dtype, inputs_embeds.device
         min_dtype = torch.finfo(dtype).min
-        q_len = inputs_embeds.shape[1]
     
         if kv_cache is None or kv_cache.num_items() == 0:
             # Do not mask any token, because we're in the prefill phase
-            # This only works when we have no padding
             causal_mask = torch.full(
                 (batch_size, q_len, q_len), fill_value=0, dtype=dtype, device=device
             )
@@ -876,26 +1213,50 @@ class PaliGemmaForConditionalGeneration(PreTrainedModel):
             assert q_len == 1
             kv_len = kv_cache.num_items() + q_len
             # Also in this case we don't need to mask anything, since each query should be able to attend all previous tokens. 
-            # This only works when we have no padding
             causal_mask = torch.full(
                 (batch_size, q_len, kv_len), fill_value=0, dtype=dtype, device=device
             )
 
+        # Padded batches: no token may attend to a padding token
+        if attention_mask is not None and attention_mask.shape[-1] == causal_mask.shape[-1]:
+            causal_mask = causal_mask.masked_fill(attention_mask[:, None, :] == 0, min_dtype)
+
         # Add the head dimension
         # [Batch_Size, Q_Len, KV_Len] -> [Batch_Size, Num_Heads_Q, Q_Len, KV_Len]
         causal_mask = causal_mask.unsqueeze(1)
 
+        # Sliding-window layers: on top of that, a token only sees the image prefix and the positions less than
+        # `sliding_window` away. The keys a RollingKVCache dropped are exactly the ones outside the window
+        sliding_mask = None
+        sliding_window = getattr(self.config.text_config, "sliding_window", None)
+        if sliding_window is not None:
+            if kv_cache is None or kv_cache.num_items() == 0:
+                # The image prefix ends after the last image token of any row
+                image_columns = (input_ids == self.config.image_token_index).any(0).nonzero()
+                num_prefix_tokens = int(image_columns[-1]) + 1 if len(image_columns) > 0 else 0
+                if kv_cache is not None:
+                    kv_cache.num_prefix_tokens = num_prefix_tokens
+            else:
+                num_prefix_tokens = kv_cache.num_prefix_tokens
+            kv_len = causal_mask.shape[-1]
+            # [Q_Len, 1] and [KV_Len] positions in the sequence
+            query_positions = torch.arange(kv_len - q_len, kv_len, device=device)[:, None]
+            key_positions = torch.arange(kv_len, device=device)
+            outside_window = ((query_positions - key_positions).abs() >= sliding_window) & (key_positions >= num_prefix_tokens)
+            sliding_mask = causal_mask.masked_fill(outside_window, min_dtype)
+
         if kv_cache is not None and kv_cache.num_items() > 0:
             # The position of the query is just the last position
             position_ids = attention_mask.cumsum(-1)[:, -1]
             if position_ids.dim() == 1:
-                position_ids = position_ids.unsqueeze(0)
+                # [Batch_Size] -> [Batch_Size, 1]
+                position_ids = position_ids.unsqueeze(-1)
         else:
             # Create a position_ids based on the size of the attention_mask
             # For masked tokens, use the number 1 as position.
             position_ids = (attention_mask.cumsum(-1)).masked_fill_((attention_mask == 0), 1).to(device)
 
-        return final_embedding, causal_mask, position_ids
+        return causal_mask, position_ids, sliding_mask
 
     def forward(
         self,
@@ -904,6 +1265,7 @@ class PaliGemmaForConditionalGeneration(PreTrainedModel):
         attention_mask: Optional[torch.Tensor] = None,
         kv_cache: Optional[KVCache] = None,
         labels: Optional[torch.Tensor] = None,
+        image_features: Optional[torch.FloatTensor] = None,
         **kwargs  # Accept additional keyword arguments
     ) -> CausalLMOutput:
 
@@ -918,43 +1280,60 @@ class PaliGemmaForConditionalGeneration(PreTrainedModel):
         if self.bnb_config and self.bnb_config.bnb_4bit_compute_dtype:
             inputs_embeds = inputs_embeds.to(dtype=self.bnb_config.bnb_4bit_compute_dtype)
 
-        # 2. Process vision tower for image features
-        # Convert pixel_values to match precision if bnb_config is provided
-        if self.bnb_config and self.bnb_config.bnb_4bit_compute_dtype:
-            pixel_values = pixel_values.to(dtype=self.bnb_config.bnb_4bit_compute_dtype)
-        
-        selected_image_feature = self.vision_tower(pixel_values)
-        image_features = self.multi_modal_projector(selected_image_feature)
+        # 2. Process vision tower for image features, unless the projected features were precomputed (see feature_store.py)
+        if image_features is None and pixel_values is not None:
+            # Convert pixel_values to match precision if bnb_config is provided
+            if self.bnb_config and self.bnb_config.bnb_4bit_compute_dtype:
+                pixel_values = pixel_values.to(dtype=self.bnb_config.bnb_4bit_compute_dtype)
+
+            selected_image_feature = self.vision_tower(pixel_values)
+            image_features = self.multi_modal_projector(selected_image_feature)
+        elif image_features is not None:
+            # [Batch_Size, Num_Patches, Projection_Dim], possibly stored in float16, or a list of
+            # [Num_Patches_i, Projection_Dim] (one per row) when the images have different resolutions
+            if isinstance(image_features, (list, tuple)):
+                image_features = torch.cat(list(image_features))
+            image_features = image_features.to(dtype=inputs_embeds.dtype)
 
         # 3. Merge text and image embeddings
-        inputs_embeds, attention_mask, position_ids = self._merge_input_ids_with_image_features(
+        inputs_embeds, attention_mask, position_ids, sliding_attention_mask = self._merge_input_ids_with_image_features(
             image_features, inputs_embeds, input_ids, attention_mask, kv_cache
         )
 
+        # With loss_chunk_size the loss is computed from the hidden states and no [Batch_Size, Seq_Len, Vocab_Size]
+        # logits are ever materialized, the output then has no logits
+        loss_chunk_size = getattr(self.config.text_config, "loss_chunk_size", None)
+        chunked_loss = labels is not None and loss_chunk_size is not None
+
         # 4. Forward pass through the language model
         outputs = self.language_model(
             attention_mask=attention_mask,
             position_ids=position_ids,
             inputs_embeds=inputs_embeds,
             kv_cache=kv_cache,
+            sliding_attention_mask=sliding_attention_mask,
+            compute_logits=not chunked_loss,
             # **kwargs,
         )
 
         # 5. Compute loss if labels are provided
         loss = None
-        if labels is not None:
+        if chunked_loss:
+            loss = chunked_causal_lm_loss(outputs.hidden_states, self.language_model.lm_head.weight, labels,
+                                          ignore_index=self.loss_f.ignore_index, chunk_size=loss_chunk_size)
+        elif labels is not None:
             # Shift logits and labels for causal language modeling
             shift_logits = outputs.logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous()
             loss = self.loss_f(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
     
         # 6. Adjust output precision if bnb_config is provided
-        if self.bnb_config and self.bnb_config.bnb_4bit_compute_dtype:
+        if self.bnb_config and self.bnb_config.bnb_4bit_compute_dtype and outputs.logits is not None:
             outputs.logits = outputs.logits.to(dtype=self.bnb_config.bnb_4bit_compute_dtype)
 
         return CausalLMOutput(
             loss=loss,
             logits=outputs.logits,
-            hidden_states=outputs.hidden_states,
+            hidden_states=None if chunked_loss else outputs.hidden_states,
             attentions=outputs.attentions,
         )
\ No newline at end of file
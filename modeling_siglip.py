@@ -3,12 +3,14 @@ from transformers import PretrainedConfig
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math 
 try:
     from apex.normalization import FusedRMSNorm as RMSNorm 
 except ModuleNotFoundError:
     print("No fused RMSNorm")
     from rms_norm import RMSNorm
+from diff_attention import differential_attention
 
 
 class SwiGLU(nn.Module):
@@ -84,6 +86,9 @@ class SiglipVisionConfig(PretrainedConfig):
         image_size=224,
         attention_dropout=0.0,
         num_channels = 3,
+        gradient_checkpointing=None,
+        gradient_checkpointing_every=1,
+        recompute_attention=False,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -101,6 +106,11 @@ class SiglipVisionConfig(PretrainedConfig):
         self.image_size = image_size
         self.attention_dropout =attention_dropout
         self.num_channels = num_channels
+        # Activation checkpointing: None, "layer", "attention" or "mlp", applied to every k-th layer
+        self.gradient_checkpointing = gradient_checkpointing
+        self.gradient_checkpointing_every = gradient_checkpointing_every
+        # Differential attention that recomputes its attention maps in backward, see diff_attention.py
+        self.recompute_attention = recompute_attention
     
     def to_dict(self):
         """Convert configuration to a dictionary."""
@@ -119,7 +129,10 @@ class SiglipVisionConfig(PretrainedConfig):
             "layer_norm_eps": self.layer_norm_eps,
             "image_size": self.image_size,
             "attention_dropout": self.attention_dropout,
-            "num_channels": self.num_channels
+            "num_channels": self.num_channels,
+            "gradient_checkpointing": self.gradient_checkpointing,
+            "gradient_checkpointing_every": self.gradient_checkpointing_every,
+            "recompute_attention": self.recompute_attention
         })
         return output
 
@@ -141,9 +154,22 @@ class SiglipVisionConfig(PretrainedConfig):
             image_size = config_dict.get("image_size", 224),
             attention_dropout = config_dict.get("attention_dropout", True),
             num_channels = config_dict.get("num_channels", 3),
+            gradient_checkpointing = config_dict.get("gradient_checkpointing", None),
+            gradient_checkpointing_every = config_dict.get("gradient_checkpointing_every", 1),
+            recompute_attention = config_dict.get("recompute_attention", False),
             **config_dict
         )
 
+CHECKPOINT_MODES = (None, "layer", "attention", "mlp")
+
+def layer_checkpoint_modes(num_layers: int, mode: Optional[str], every: int = 1):
+    # Checkpointing mode of each layer: `mode` on every `every`-th layer and None on the others
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f"Unknown gradient checkpointing mode {mode!r}, expected one of {CHECKPOINT_MODES}")
+    if every < 1:
+        raise ValueError(f"gradient_checkpointing_every must be >= 1, got {every}")
+    return [mode if layer_idx % every == 0 else None for layer_idx in range(num_layers)]
+
 class SiglipVisionEmbeddings(nn.Module):
     def __init__(self, config: SiglipVisionConfig):
         super().__init__()
@@ -168,6 +194,41 @@ class SiglipVisionEmbeddings(nn.Module):
             torch.arange(self.num_positions).expand((1, -1)),
             persistent=False,
         )
+        # Interpolated position embeddings for other patch grids, {(Num_Patches_H, Num_Patches_W, dtype, device): table}
+        self._position_embedding_cache = {}
+        self._position_embedding_version = None
+
+    def interpolate_position_embedding(self, num_patches_h: int, num_patches_w: int) -> torch.Tensor:
+        """
+        Position embeddings for a `num_patches_h` x `num_patches_w` patch grid, bicubically interpolated
+        from the pretrained (image_size // patch_size)^2 grid. Tables are cached per grid shape and
+        rebuilt whenever the embedding weights change.
+        """
+        weight = self.position_embedding.weight
+        side = self.image_size // self.patch_size
+        if (num_patches_h, num_patches_w) == (side, side):
+            # [1, Num_Patches, Embed_Dim]
+            return self.position_embedding(self.position_ids)
+
+        # Training the embeddings needs the graph, so only cache when no gradient flows into them
+        use_cache = not (torch.is_grad_enabled() and weight.requires_grad)
+        # In-place updates bump _version, swapping in another tensor (e.g. load_artifact) changes data_ptr
+        version = (weight.data_ptr(), weight._version)
+        if self._position_embedding_version != version:
+            self._position_embedding_cache.clear()
+            self._position_embedding_version = version
+        key = (num_patches_h, num_patches_w, weight.dtype, weight.device)
+        if use_cache and key in self._position_embedding_cache:
+            return self._position_embedding_cache[key]
+
+        # [Num_Positions, Embed_Dim] -> [1, Embed_Dim, Side, Side]
+        grid = weight.float().reshape(1, side, side, self.embed_dim).permute(0, 3, 1, 2)
+        grid = F.interpolate(grid, size=(num_patches_h, num_patches_w), mode="bicubic", align_corners=False)
+        # [1, Embed_Dim, Num_Patches_H, Num_Patches_W] -> [1, Num_Patches_H * Num_Patches_W, Embed_Dim]
+        table = grid.flatten(2).transpose(1, 2).to(weight.dtype)
+        if use_cache:
+            self._position_embedding_cache[key] = table
+        return table
 
     def forward(self, pixel_values: torch.FloatTensor) -> torch.Tensor:
         _, _, height, width = pixel_values.shape # [Batch_Size, Channels, Height, Width]
@@ -181,7 +242,8 @@ class SiglipVisionEmbeddings(nn.Module):
         # [Batch_Size, Embed_Dim, Num_Patches] -> [Batch_Size, Num_Patches, Embed_Dim]
         embeddings = embeddings.transpose(1, 2)
         # Add position embeddings to each patch. Each positional encoding is a vector of size [Embed_Dim]
-        embeddings = embeddings + self.position_embedding(self.position_ids)
+        # Other resolutions than image_size get the pretrained grid interpolated to their patch grid
+        embeddings = embeddings + self.interpolate_position_embedding(patch_embeds.shape[2], patch_embeds.shape[3])
         # [Batch_Size, Num_Patches, Embed_Dim]
         return embeddings
 
@@ -214,6 +276,18 @@ class SiglipAttention(nn.Module):
         self.lambda_q2 = nn.Parameter(torch.zeros(self.head_dim // 2, dtype=torch.float32).normal_(mean=0, std=0.1))
         self.lambda_k2 = nn.Parameter(torch.zeros(self.head_dim // 2, dtype=torch.float32).normal_(mean=0, std=0.1))
         self.subln = RMSNorm(2 * self.head_dim // 2, eps=1e-5, elementwise_affine=True)
+        # Per-request lambdas when serving several adapters at once, see multi_lora.py
+        self.adapter_lambdas = None
+        # Save only Q, K, V and the log-sum-exp for backward instead of the attention maps
+        self.recompute_attention = getattr(config, "recompute_attention", False)
+
+    def lambda_full(self, like: torch.Tensor) -> torch.Tensor:
+        if self.adapter_lambdas is not None:
+            # [Batch_Size, 1, 1, 1]
+            return self.adapter_lambdas(self).type_as(like)
+        lambda_1 = torch.exp(torch.sum(self.lambda_q1 * self.lambda_k1, dim=-1).float()).type_as(like)
+        lambda_2 = torch.exp(torch.sum(self.lambda_q2 * self.lambda_k2, dim=-1).float()).type_as(like)
+        return lambda_1 - lambda_2 + self.lambda_init
 
     def forward(
         self,
@@ -235,36 +309,46 @@ class SiglipAttention(nn.Module):
         key_states = key_states.view(batch_size, seq_len, 2 * self.num_heads, self.head_dim // 2).transpose(1, 2)
         value_states = value_states.view(batch_size, seq_len, self.num_heads, self.head_dim).transpose(1, 2)
 
-        """
-        Compute attention weights
-        """
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
-        attn_weights = torch.nan_to_num(attn_weights)
-
-        if attention_mask is not None:
-            if attention_mask.size() != (batch_size, 1, seq_len, key_states.shape[-2]):
-                raise ValueError(
-                    f"Attention mask should have size {(batch_size, 1, seq_len, key_states.shape[-2])}, but got"
-                    f" {attention_mask.size()}"
-                )
-            attn_weights += attention_mask
+        if attention_mask is not None and attention_mask.size() != (batch_size, 1, seq_len, key_states.shape[-2]):
+            raise ValueError(
+                f"Attention mask should have size {(batch_size, 1, seq_len, key_states.shape[-2])}, but got"
+                f" {attention_mask.size()}"
+            )
+
+        if self.recompute_attention:
+            # Same result, but the attention maps are recomputed blockwise in backward instead of being stored.
+            # Heads 2h and 2h + 1 give the two maps of head h
+            lambda_full = self.lambda_full(query_states)
+            attn_output = differential_attention(
+                query_states[:, 0::2], key_states[:, 0::2], value_states, attention_mask, lambda_full,
+                1 / math.sqrt(self.head_dim), q2=query_states[:, 1::2], k2=key_states[:, 1::2],
+            )
+            attn_weights = None
+        else:
+            """
+            Compute attention weights
+            """
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+            attn_weights = torch.nan_to_num(attn_weights)
+
+            if attention_mask is not None:
+                attn_weights += attention_mask
+
+            attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).type_as(attn_weights)
+
+            """
+            Apply Differential Attention
+            """
+            lambda_full = self.lambda_full(query_states)
+
+            attn_weights = attn_weights.view(batch_size, self.num_heads, 2, seq_len, seq_len)
+            attn_weights = attn_weights[:, :, 0] - lambda_full * attn_weights[:, :, 1]
+
+            """
+            Compute weighted value states
+            """
+            attn_output = torch.matmul(attn_weights, value_states)
 
-        attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).type_as(attn_weights)
-
-        """
-        Apply Differential Attention
-        """
-        lambda_1 = torch.exp(torch.sum(self.lambda_q1 * self.lambda_k1, dim=-1).float()).type_as(query_states)
-        lambda_2 = torch.exp(torch.sum(self.lambda_q2 * self.lambda_k2, dim=-1).float()).type_as(query_states)
-        lambda_full = lambda_1 - lambda_2 + self.lambda_init
-
-        attn_weights = attn_weights.view(batch_size, self.num_heads, 2, seq_len, seq_len)
-        attn_weights = attn_weights[:, :, 0] - lambda_full * attn_weights[:, :, 1]
-
-        """
-        Compute weighted value states
-        """
-        attn_output = torch.matmul(attn_weights, value_states)
         attn_output = self.subln(attn_output)  # Normalize attention output
         attn_output = attn_output * (1 - self.lambda_init)
         attn_output = attn_output.transpose(1, 2).reshape(batch_size, seq_len, self.num_heads * self.head_dim)
@@ -419,12 +503,10 @@ class SiglipEncoderLayer(nn.Module):
         self.swiglu_layer = SwiGLU(config.hidden_size)
         # self.layer_norm2 = nn.LayerNorm(self.embed_dim, eps=config.layer_norm_eps)
         self.rms_norm2 = RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        # Set by SiglipEncoder.set_gradient_checkpointing
+        self.checkpoint_mode = None
 
-    # Ignore copy
-    def forward(
-        self,
-        hidden_states: torch.Tensor,
-    ) -> torch.Tensor:
+    def _attention_block(self, hidden_states: torch.Tensor) -> torch.Tensor:
         # residual: [Batch_Size, Num_Patches, Embed_Dim]
         residual = hidden_states
         # [Batch_Size, Num_Patches, Embed_Dim] -> [Batch_Size, Num_Patches, Embed_Dim]
@@ -433,8 +515,9 @@ class SiglipEncoderLayer(nn.Module):
         hidden_states, _ = self.self_attn(hidden_states=hidden_states)
 
         # [Batch_Size, Num_Patches, Embed_Dim]
-        hidden_states = residual + hidden_states    # (equation 4)
+        return residual + hidden_states    # (equation 4)
 
+    def _mlp_block(self, hidden_states: torch.Tensor) -> torch.Tensor:
         # residual: [Batch_Size, Num_Patches, Embed_Dim] 
         residual = hidden_states
         # [Batch_Size, Num_Patches, Embed_Dim] -> [Batch_Size, Num_Patches, Embed_Dim]
@@ -452,6 +535,28 @@ class SiglipEncoderLayer(nn.Module):
         
         return hidden_states
 
+    def _forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self._mlp_block(self._attention_block(hidden_states))
+
+    # Ignore copy
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+    ) -> torch.Tensor:
+        # Recompute the checkpointed part in backward instead of storing its activations (attention maps, MLP)
+        checkpoint_mode = self.checkpoint_mode if self.training and torch.is_grad_enabled() else None
+        if checkpoint_mode == "layer":
+            return checkpoint(self._forward, hidden_states, use_reentrant=False)
+
+        if checkpoint_mode == "attention":
+            hidden_states = checkpoint(self._attention_block, hidden_states, use_reentrant=False)
+        else:
+            hidden_states = self._attention_block(hidden_states)
+
+        if checkpoint_mode == "mlp":
+            return checkpoint(self._mlp_block, hidden_states, use_reentrant=False)
+        return self._mlp_block(hidden_states)
+
 
 class SiglipEncoder(nn.Module):
     def __init__(self, config: SiglipVisionConfig):
@@ -460,6 +565,11 @@ class SiglipEncoder(nn.Module):
         self.layers = nn.ModuleList(
             [SiglipEncoderLayer(config, layer_idx=l) for l in range(config.num_hidden_layers)]
         )
+        self.set_gradient_checkpointing(config.gradient_checkpointing, config.gradient_checkpointing_every)
+
+    def set_gradient_checkpointing(self, mode: Optional[str] = "layer", every: int = 1):
+        for layer, layer_mode in zip(self.layers, layer_checkpoint_modes(len(self.layers), mode, every)):
+            layer.checkpoint_mode = layer_mode
 
     # Ignore copy
     def forward(
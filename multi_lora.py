@@ -0,0 +1,278 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import torch
+import torch.nn as nn
+
+from checkpoint_writer import DIFF_ATTENTION_KEYWORDS
+from image_preprocessing import BatchImagePreprocessor
+from inference import generate
+from lora_merge import LORA_KEY_PATTERN, load_diff_attention_file, lora_scaling, read_adapter, strip_peft_prefix
+from rms_norm import rms_norm
+from utils import tokenize_prompts
+
+# Same projections as finetune.LORA_TARGET_MODULES, plus SigLIP's attention output projection
+TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "out_proj", "gate_proj", "up_proj", "down_proj"]
+LAMBDA_NAMES = ["lambda_q1", "lambda_k1", "lambda_q2", "lambda_k2"]
+
+# Slot 0 always holds the base model: no LoRA delta and the base lambdas/subln
+BASE_SLOT = 0
+
+
+class AdapterContext:
+    """Adapter slot of every row of the batch being run, shared by all the multi-adapter modules."""
+
+    def __init__(self):
+        # [Batch_Size] or None, in which case the base model runs unchanged
+        self.slot_ids: Optional[torch.Tensor] = None
+
+
+class MultiLoraLinear(nn.Module):
+    """Linear layer with the LoRA weights of several adapters, every row of the batch uses its own."""
+
+    def __init__(self, base: nn.Linear, context: AdapterContext, num_slots: int, max_rank: int):
+        super().__init__()
+        self.base = base
+        self.context = context
+        weight = base.weight
+        # Zero in every unused slot, so a row using them just gets the base output
+        self.register_buffer("lora_A", torch.zeros(num_slots, max_rank, base.in_features, dtype=weight.dtype, device=weight.device), persistent=False)
+        self.register_buffer("lora_B", torch.zeros(num_slots, base.out_features, max_rank, dtype=weight.dtype, device=weight.device), persistent=False)
+        self.register_buffer("scaling", torch.zeros(num_slots, dtype=weight.dtype, device=weight.device), persistent=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        output = self.base(x)
+        slot_ids = self.context.slot_ids
+        if slot_ids is None:
+            return output
+        # Gathered per-row low-rank matmuls: [Batch_Size, Seq_Len, In] @ [Batch_Size, In, R] @ [Batch_Size, R, Out]
+        lora_A = self.lora_A[slot_ids].transpose(1, 2)
+        lora_B = self.lora_B[slot_ids].transpose(1, 2)
+        delta = torch.bmm(torch.bmm(x.to(lora_A.dtype), lora_A), lora_B)
+        return output + (delta * self.scaling[slot_ids].view(-1, 1, 1)).to(output.dtype)
+
+
+class MultiAdapterRMSNorm(nn.Module):
+    """`subln` with one weight per adapter slot. Any RMSNorm with `weight` and `eps` (ours or apex's FusedRMSNorm)."""
+
+    def __init__(self, base: nn.Module, context: AdapterContext, num_slots: int):
+        super().__init__()
+        self.base = base
+        self.context = context
+        self.eps = base.eps
+        self.register_buffer("weight", base.weight.detach().expand(num_slots, -1).clone(), persistent=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        slot_ids = self.context.slot_ids
+        if slot_ids is None:
+            return self.base(x)
+        output = rms_norm(x, eps=self.eps)
+        # [Batch_Size, Dim] -> [Batch_Size, 1, ..., 1, Dim]
+        weight = self.weight[slot_ids].view(-1, *([1] * (x.dim() - 2)), x.shape[-1])
+        return output * weight
+
+
+class MultiAdapterLambdas(nn.Module):
+    """Differential attention lambdas with one set per adapter slot, see GemmaAttention.lambda_full."""
+
+    def __init__(self, attention: nn.Module, context: AdapterContext, num_slots: int):
+        super().__init__()
+        self.context = context
+        for name in LAMBDA_NAMES:
+            param = getattr(attention, name)
+            self.register_buffer(name, param.detach().expand(num_slots, -1).clone(), persistent=False)
+
+    def forward(self, attention: nn.Module) -> torch.Tensor:
+        slot_ids = self.context.slot_ids
+        if slot_ids is None:
+            lambdas = [getattr(attention, name) for name in LAMBDA_NAMES]
+        else:
+            lambdas = [getattr(self, name)[slot_ids] for name in LAMBDA_NAMES]
+        lambda_q1, lambda_k1, lambda_q2, lambda_k2 = lambdas
+        lambda_1 = torch.exp(torch.sum(lambda_q1 * lambda_k1, dim=-1).float())
+        lambda_2 = torch.exp(torch.sum(lambda_q2 * lambda_k2, dim=-1).float())
+        lambda_full = lambda_1 - lambda_2 + attention.lambda_init
+        # [Batch_Size] -> [Batch_Size, 1, 1, 1], broadcasting over heads, queries and keys
+        return lambda_full.view(-1, 1, 1, 1) if slot_ids is not None else lambda_full
+
+
+class AdapterRegistry:
+    """
+    One base model serving many LoRA adapters (plus their own lambdas and `subln` weights) at once.
+
+    Every adapted Linear keeps the stacked LoRA weights of up to `max_adapters` adapters, each batch row
+    picks its adapter's slot. Adapters are registered by path and only read from disk when a request
+    needs them. When all slots are in use the least recently used adapter is evicted.
+    """
+
+    def __init__(self, model, max_adapters: int = 4, max_rank: int = 32, target_modules: Sequence[str] = TARGET_MODULES):
+        self.model = model
+        self.max_rank = max_rank
+        self.context = AdapterContext()
+        num_slots = max_adapters + 1
+
+        # Swap the modules in place, their base weights stay shared with `model`
+        self.lora_modules: Dict[str, MultiLoraLinear] = {}
+        self.norm_modules: Dict[str, MultiAdapterRMSNorm] = {}
+        self.lambda_modules: Dict[str, MultiAdapterLambdas] = {}
+        for name, module in list(model.named_modules()):
+            for child_name, child in list(module.named_children()):
+                full_name = f"{name}.{child_name}" if name else child_name
+                if isinstance(child, nn.Linear) and child_name in target_modules:
+                    self.lora_modules[full_name] = MultiLoraLinear(child, self.context, num_slots, max_rank)
+                    setattr(module, child_name, self.lora_modules[full_name])
+                elif child_name == "subln":
+                    # Whatever the norm class, with apex installed it is a FusedRMSNorm
+                    self.norm_modules[full_name] = MultiAdapterRMSNorm(child, self.context, num_slots)
+                    setattr(module, child_name, self.norm_modules[full_name])
+            if hasattr(module, "adapter_lambdas") and hasattr(module, "lambda_q1"):
+                self.lambda_modules[name] = module.adapter_lambdas = MultiAdapterLambdas(module, self.context, num_slots)
+
+        self._paths: Dict[str, tuple] = {}
+        # name -> slot, least recently used first
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._free_slots = list(range(1, num_slots))
+
+    def register(self, name: str, adapter_path: Optional[str] = None, new_weights_path: Optional[str] = None):
+        if name in self._slots:
+            self._evict(name)
+        self._paths[name] = (adapter_path, new_weights_path)
+
+    def loaded_adapters(self) -> List[str]:
+        return list(self._slots)
+
+    def slot_ids(self, names: Sequence[Optional[str]]) -> torch.Tensor:
+        """Slot of every row's adapter (None for the base model), loading adapters that aren't resident."""
+        needed = list(OrderedDict.fromkeys(name for name in names if name is not None))
+        if len(needed) > len(self._slots) + len(self._free_slots):
+            raise ValueError(f"A batch can use at most {len(self._slots) + len(self._free_slots)} adapters, got {len(needed)}")
+        for name in needed:
+            if name in self._slots:
+                self._slots.move_to_end(name)
+            else:
+                self._load(name, needed)
+        slots = [BASE_SLOT if name is None else self._slots[name] for name in names]
+        device = next(self.model.parameters()).device
+        return torch.tensor(slots, dtype=torch.long, device=device)
+
+    def _load(self, name: str, keep: Sequence[str]):
+        if name not in self._paths:
+            raise KeyError(f"Unknown adapter {name!r}, register it first")
+        if not self._free_slots:
+            # Least recently used adapter that the current batch doesn't need
+            victim = next(loaded for loaded in self._slots if loaded not in keep)
+            self._evict(victim)
+        slot = self._free_slots.pop(0)
+        self._reset_slot(slot)
+
+        adapter_path, new_weights_path = self._paths[name]
+        if adapter_path is not None:
+            adapter_config, tensors = read_adapter(adapter_path)
+            self._load_lora(slot, tensors, adapter_config)
+        if new_weights_path is not None:
+            self._load_diff_attention(slot, load_diff_attention_file(new_weights_path))
+        self._slots[name] = slot
+        print(f"Loaded adapter {name} into slot {slot}")
+
+    def _evict(self, name: str):
+        slot = self._slots.pop(name)
+        self._reset_slot(slot)
+        self._free_slots.append(slot)
+        print(f"Evicted adapter {name} from slot {slot}")
+
+    @torch.no_grad()
+    def _reset_slot(self, slot: int):
+        # Back to the base model: no LoRA delta, base lambdas and subln weights
+        for module in self.lora_modules.values():
+            module.lora_A[slot].zero_()
+            module.lora_B[slot].zero_()
+            module.scaling[slot] = 0
+        for module in self.norm_modules.values():
+            module.weight[slot].copy_(module.weight[BASE_SLOT])
+        for module in self.lambda_modules.values():
+            for lambda_name in LAMBDA_NAMES:
+                getattr(module, lambda_name)[slot].copy_(getattr(module, lambda_name)[BASE_SLOT])
+
+    @torch.no_grad()
+    def _load_lora(self, slot: int, tensors, adapter_config):
+        pairs = {}
+        for key, tensor in tensors.items():
+            match = LORA_KEY_PATTERN.match(key)
+            if match:
+                pairs.setdefault(match.group(1), {})[match.group(2)] = tensor
+        for module_name, pair in pairs.items():
+            if module_name not in self.lora_modules:
+                raise ValueError(f"Adapter targets {module_name}, which isn't one of the served target modules")
+            module = self.lora_modules[module_name]
+            rank = pair["A"].shape[0]
+            if rank > self.max_rank:
+                raise ValueError(f"Adapter rank {rank} of {module_name} exceeds max_rank {self.max_rank}")
+            # Ranks below max_rank are zero padded, which doesn't change the product
+            module.lora_A[slot, :rank].copy_(pair["A"])
+            module.lora_B[slot, :, :rank].copy_(pair["B"])
+            module.scaling[slot] = lora_scaling(adapter_config, module_name)
+
+    @torch.no_grad()
+    def _load_diff_attention(self, slot: int, tensors):
+        for key, tensor in tensors.items():
+            if LORA_KEY_PATTERN.match(key) or not any(keyword in key for keyword in DIFF_ATTENTION_KEYWORDS):
+                continue
+            module_name, _, param_name = strip_peft_prefix(key).rpartition(".")
+            if param_name in LAMBDA_NAMES and module_name in self.lambda_modules:
+                getattr(self.lambda_modules[module_name], param_name)[slot].copy_(tensor)
+            elif param_name == "weight" and module_name in self.norm_modules:
+                self.norm_modules[module_name].weight[slot].copy_(tensor)
+            else:
+                raise ValueError(f"Differential attention param {key} doesn't match the model")
+
+
+class MultiAdapterServer:
+    """Batched generation for requests that each name their own adapter (or None for the base model)."""
+
+    def __init__(self, model, processor, max_adapters: int = 4, max_rank: int = 32):
+        self.model = model.eval()
+        self.processor = processor
+        self.registry = AdapterRegistry(model, max_adapters=max_adapters, max_rank=max_rank)
+        self.preprocessor = BatchImagePreprocessor.from_processor(processor)
+
+    def register_adapter(self, name: str, adapter_path: Optional[str] = None, new_weights_path: Optional[str] = None):
+        self.registry.register(name, adapter_path, new_weights_path)
+
+    @torch.no_grad()
+    def generate(self, requests: List[dict], max_new_tokens: int = 50, max_batch_size: int = 16) -> List[str]:
+        """
+        `requests` are {"adapter": name or None, "prompt": str, "image": PIL.Image, path or bytes}. Requests are grouped by
+        adapter before batching, which keeps the number of adapters per batch (and the evictions) low.
+        Returns the generated text of every request, in order.
+        """
+        param = next(self.model.parameters())
+        order = sorted(range(len(requests)), key=lambda i: str(requests[i].get("adapter")))
+        answers = [None] * len(requests)
+        for start in range(0, len(order), max_batch_size):
+            batch = [requests[i] for i in order[start:start + max_batch_size]]
+            inputs = tokenize_prompts(self.processor, [request["prompt"] for request in batch])
+            # Images may also be paths or encoded bytes, they are decoded in the preprocessor's thread pool
+            pixel_values = self.preprocessor([request["image"] for request in batch])
+
+            self.registry.context.slot_ids = self.registry.slot_ids([request.get("adapter") for request in batch])
+
+            def select_rows(rows):
+                self.registry.context.slot_ids = self.registry.context.slot_ids[rows]
+
+            try:
+                generated = generate(
+                    self.model,
+                    inputs["input_ids"].to(param.device),
+                    inputs["attention_mask"].to(param.device),
+                    pixel_values=pixel_values.to(device=param.device, dtype=param.dtype),
+                    max_new_tokens=max_new_tokens,
+                    eos_token_id=self.processor.tokenizer.eos_token_id,
+                    select_rows=select_rows,
+                )
+            finally:
+                self.registry.context.slot_ids = None
+
+            texts = self.processor.tokenizer.batch_decode(generated, skip_special_tokens=True)
+            for i, text in zip(order[start:start + max_batch_size], texts):
+                answers[i] = text.strip()
+        return answers
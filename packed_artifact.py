@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+from typing import Dict, Optional, Tuple
+
+import torch
+from safetensors.torch import save_file
+
+from modeling_gemma import PaliGemmaConfig, PaliGemmaForConditionalGeneration
+
+ARTIFACT_FORMAT = "paligemma-diff-packed"
+ARTIFACT_VERSION = "1"
+# Processor files are stored as uint8 tensors under this prefix
+FILE_PREFIX = "__file__/"
+PROCESSOR_FILES = [
+    "tokenizer.json", "tokenizer.model", "tokenizer_config.json", "special_tokens_map.json",
+    "added_tokens.json", "preprocessor_config.json", "processor_config.json",
+]
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+def tensors_checksum(tensors: Dict[str, torch.Tensor]) -> str:
+    # Independent of the file layout, so it can be recomputed from the loaded tensors
+    h = hashlib.sha256()
+    for name in sorted(tensors):
+        tensor = tensors[name].detach().cpu().contiguous()
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        h.update(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+    return h.hexdigest()
+
+
+def pack_model(model, config: dict, processor_dir: Optional[str], output_path: str):
+    """
+    Write `model` (with any adapter already merged), its config and the processor files of `processor_dir`
+    into one safetensors file. Every parameter and buffer is stored, non-persistent buffers included, so the
+    loader never has to run the model's initialization. Tied weights are stored once.
+    """
+    tensors, aliases, seen = {}, {}, {}
+    named_tensors = list(model.named_parameters(remove_duplicate=False)) + list(model.named_buffers(remove_duplicate=False))
+    for name, tensor in named_tensors:
+        tensor = tensor.detach()
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        tensors[name] = tensor.to("cpu").contiguous()
+
+    if processor_dir is not None:
+        for file_name in PROCESSOR_FILES:
+            path = os.path.join(processor_dir, file_name)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    tensors[FILE_PREFIX + file_name] = torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+
+    metadata = {
+        "format": ARTIFACT_FORMAT,
+        "version": ARTIFACT_VERSION,
+        "config": json.dumps(config),
+        "aliases": json.dumps(aliases),
+        "sha256": tensors_checksum(tensors),
+    }
+    # Same temporary name + rename as the checkpoint writer, a partially written artifact is never picked up
+    tmp_path = output_path + ".tmp"
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, output_path)
+    print(f"Packed {len(tensors)} tensors into {output_path} ({os.path.getsize(output_path) / 2**30:.2f} GiB)")
+
+
+def export_artifact(base_model_name: str, output_path: str, adapter_path: Optional[str] = None,
+                    new_weights_path: Optional[str] = None, dtype: Optional[str] = None):
+    """Merge the adapter and differential attention params into the base model and pack everything into `output_path`."""
+    from lora_merge import load_merged_model
+
+    model, _ = load_merged_model(base_model_name, adapter_path, new_weights_path, device="cpu",
+                                 dtype=getattr(torch, dtype) if dtype is not None else None)
+    with open(os.path.join(base_model_name, "config.json"), "r") as f:
+        config = json.load(f)
+    pack_model(model, config, base_model_name, output_path)
+
+
+def read_header(path: str):
+    # safetensors layout: u64 little endian header size, JSON header, then the raw tensor data
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def map_tensors(path: str) -> Tuple[Dict[str, torch.Tensor], dict]:
+    """Tensors of a safetensors file as views into one private (copy-on-write) memory map of the file."""
+    header, data_start = read_header(path)
+    metadata = header.pop("__metadata__", {})
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+
+    tensors = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        tensor_bytes = data[data_start + start:data_start + end]
+        tensors[name] = tensor_bytes.view(SAFETENSORS_DTYPES[info["dtype"]]).view(info["shape"])
+    return tensors, metadata
+
+
+def load_artifact(path: str, device: str = "cpu", load_processor: bool = True, verify_checksum: bool = False):
+    """
+    Build the model from a packed artifact. The model is created on the meta device and every parameter
+    points into the memory-mapped file, so nothing is initialized or copied until the pages are touched.
+    Returns (model, processor), processor is None if `load_processor` is False.
+    """
+    tensors, metadata = map_tensors(path)
+    if metadata.get("format") != ARTIFACT_FORMAT:
+        raise ValueError(f"{path} is not a packed artifact (format {metadata.get('format')!r})")
+    if verify_checksum and tensors_checksum(tensors) != metadata["sha256"]:
+        raise ValueError(f"Checksum mismatch, {path} is corrupted")
+
+    files = {name[len(FILE_PREFIX):]: tensors.pop(name) for name in list(tensors) if name.startswith(FILE_PREFIX)}
+    for alias, name in json.loads(metadata["aliases"]).items():
+        tensors[alias] = tensors[name]
+
+    config = PaliGemmaConfig(**json.loads(metadata["config"]))
+    with torch.device("meta"):
+        model = PaliGemmaForConditionalGeneration(config)
+    # Tied weights map to the same tensor object and so get the same Parameter
+    parameters = {}
+    for name, tensor in tensors.items():
+        module_name, _, tensor_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if tensor_name in module._parameters:
+            if id(tensor) not in parameters:
+                parameters[id(tensor)] = torch.nn.Parameter(tensor, requires_grad=False)
+            module._parameters[tensor_name] = parameters[id(tensor)]
+        else:
+            module._buffers[tensor_name] = tensor
+
+    missing = [name for name, param in list(model.named_parameters()) + list(model.named_buffers()) if param.is_meta]
+    if missing:
+        raise ValueError(f"{path} is missing tensors: {missing[:5]}")
+    model = model.to(device).eval()
+
+    processor = None
+    if load_processor and files:
+        from transformers import AutoProcessor
+
+        # AutoProcessor only reads from disk
+        with tempfile.TemporaryDirectory() as processor_dir:
+            for file_name, data in files.items():
+                with open(os.path.join(processor_dir, file_name), "wb") as f:
+                    f.write(data.numpy().tobytes())
+            processor = AutoProcessor.from_pretrained(processor_dir)
+    return model, processor
+
+
+@torch.no_grad()
+def verify_artifact(artifact_path: str, base_model_name: str, adapter_path: Optional[str] = None,
+                    new_weights_path: Optional[str] = None, dtype: Optional[str] = None, atol: float = 1e-4):
+    """Check the artifact's checksum and that it produces the same logits as the multi-file load."""
+    from lora_merge import load_merged_model
+
+    start = time.perf_counter()
+    packed_model, _ = load_artifact(artifact_path, load_processor=False, verify_checksum=True)
+    packed_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reference_model, _ = load_merged_model(base_model_name, adapter_path, new_weights_path,
+                                           dtype=getattr(torch, dtype) if dtype is not None else None)
+    reference_seconds = time.perf_counter() - start
+
+    config = reference_model.config
+    torch.manual_seed(0)
+    input_ids = torch.randint(2, 1000, (1, config.num_image_tokens + 16))
+    input_ids[:, :config.num_image_tokens] = config.image_token_index
+    image_size = config.vision_config.image_size
+    inputs = {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "pixel_values": torch.randn(1, 3, image_size, image_size, dtype=next(packed_model.parameters()).dtype),
+    }
+    packed_logits = packed_model(**inputs).logits
+    reference_logits = reference_model(**inputs).logits
+    max_diff = (packed_logits - reference_logits).abs().max().item()
+
+    print(f"Checksum OK, max logit difference {max_diff:.2e}")
+    print(f"Load time: packed {packed_seconds:.2f}s, multi-file {reference_seconds:.2f}s")
+    if max_diff > atol:
+        raise ValueError(f"Packed artifact doesn't match the multi-file model (max difference {max_diff:.2e} > {atol})")
+    return max_diff
+
+
+if __name__ == "__main__":
+    import fire
+
+    # python packed_artifact.py export --base_model_name ... --output_path model.safetensors --adapter_path ... --new_weights_path ...
+    # python packed_artifact.py verify --artifact_path model.safetensors --base_model_name ... --adapter_path ... --new_weights_path ...
+    fire.Fire({"export": export_artifact, "verify": verify_artifact})
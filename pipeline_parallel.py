@@ -0,0 +1,251 @@
+import os
+import time
+from collections import deque
+from typing import Callable, List, Optional, Sequence
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+
+from modeling_gemma import KVCache, RollingKVCache
+from pipelined_inference import pin_to_cores
+
+
+def partition(num_layers: int, num_stages: int) -> List[range]:
+    """Contiguous split of `num_layers` layers into `num_stages` stages, the first stages get the remainder."""
+    per_stage, remainder = divmod(num_layers, num_stages)
+    stages, start = [], 0
+    for stage in range(num_stages):
+        end = start + per_stage + (1 if stage < remainder else 0)
+        stages.append(range(start, end))
+        start = end
+    return stages
+
+
+class PipelineStage:
+    """
+    One stage of pipeline-parallel generation with our PaliGemmaForConditionalGeneration. Every rank of a gloo process
+    group runs one. Stage `rank` holds a contiguous slice of SiglipEncoder.layers and a contiguous slice of
+    GemmaModel.layers, so every stage also has work while decoding. The first stage also embeds the image and the text,
+    the last one applies post_layernorm + multi_modal_projector and norm + lm_head. Hidden states go from rank to
+    rank + 1, the image features and the next tokens go from the last rank back to the first.
+
+    `model` is pruned in place down to this stage's modules. Build it on the meta device and map the weights (see
+    evaluation/vqav2_parallel.load_shared_model), then a rank never reads the weights of the other stages.
+    """
+
+    def __init__(self, model, vision_layers: Optional[Sequence[int]] = None, text_layers: Optional[Sequence[int]] = None):
+        self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        self.first_rank, self.last_rank = 0, self.world_size - 1
+        self.model = model.eval()
+        self.config = model.config
+        self.dtype = model.language_model.model.embed_tokens.weight.dtype
+
+        vision_model = model.vision_tower.vision_model
+        language_model = model.language_model
+        if vision_layers is None:
+            vision_layers = partition(len(vision_model.encoder.layers), self.world_size)[self.rank]
+        if text_layers is None:
+            text_layers = partition(len(language_model.model.layers), self.world_size)[self.rank]
+        vision_model.encoder.layers = nn.ModuleList([vision_model.encoder.layers[i] for i in vision_layers])
+        language_model.model.layers = nn.ModuleList([language_model.model.layers[i] for i in text_layers])
+        # Numbered from 0 inside the stage, so the stage's KV caches hold its own layers only
+        for layer_idx, layer in enumerate(language_model.model.layers):
+            layer.self_attn.layer_idx = layer_idx
+        self.sliding_layers = [
+            layer_idx for layer_idx, layer in enumerate(language_model.model.layers) if layer.self_attn.sliding_window is not None
+        ]
+
+        # Drop the modules of the other stages
+        if self.rank != self.first_rank:
+            vision_model.embeddings = None
+            language_model.model.embed_tokens = None
+        if self.rank != self.last_rank:
+            vision_model.post_layernorm = None
+            model.multi_modal_projector = None
+            language_model.model.norm = None
+            language_model.lm_head = None
+
+        # Messages to this rank itself (a single stage, or the last rank being the first)
+        self.local_messages = deque()
+        self.pending_sends = []
+        self.busy_seconds = self.wait_seconds = self.wall_seconds = 0.0
+
+    def _send(self, tensor: torch.Tensor, dst: int):
+        if dst == self.rank:
+            self.local_messages.append(tensor)
+            return
+        tensor = tensor.contiguous()
+        # The tensor has to stay alive until the send completed
+        self.pending_sends.append((dist.isend(tensor, dst), tensor))
+
+    def _recv(self, shape, dtype: torch.dtype, src: int) -> torch.Tensor:
+        if src == self.rank:
+            return self.local_messages.popleft()
+        tensor = torch.empty(shape, dtype=dtype)
+        start = time.perf_counter()
+        dist.recv(tensor, src)
+        self.wait_seconds += time.perf_counter() - start
+        return tensor
+
+    def _make_kv_cache(self) -> KVCache:
+        sliding_window = getattr(self.config.text_config, "sliding_window", None)
+        if sliding_window is not None:
+            return RollingKVCache(sliding_window, self.sliding_layers)
+        return KVCache()
+
+    def _vision_step(self, micro_batch: dict):
+        vision_model = self.model.vision_tower.vision_model
+        pixel_values = micro_batch["pixel_values"]
+        batch_size, _, height, width = pixel_values.shape
+        patch_size = self.config.vision_config.patch_size
+        num_patches = (height // patch_size) * (width // patch_size)
+
+        if self.rank == self.first_rank:
+            # [Batch_Size, Num_Patches, Embed_Dim]
+            hidden_states = vision_model.embeddings(pixel_values.to(self.dtype))
+        else:
+            hidden_states = self._recv((batch_size, num_patches, self.config.vision_config.hidden_size), self.dtype, self.rank - 1)
+        hidden_states = vision_model.encoder(hidden_states)
+
+        if self.rank != self.last_rank:
+            self._send(hidden_states, self.rank + 1)
+        else:
+            # [Batch_Size, Num_Patches, Hidden_Size]
+            image_features = self.model.multi_modal_projector(vision_model.post_layernorm(hidden_states))
+            self._send(image_features, self.first_rank)
+        micro_batch["num_patches"] = num_patches
+
+    def _text_step(self, micro_batch: dict, step: int, max_new_tokens: int):
+        language_model = self.model.language_model
+        hidden_size = self.config.text_config.hidden_size
+        kv_cache = micro_batch["kv_cache"]
+        batch_size = micro_batch["input_ids"].shape[0]
+        if step > 0:
+            micro_batch["attention_mask"] = torch.cat(
+                [micro_batch["attention_mask"], torch.ones_like(micro_batch["attention_mask"][:, :1])], dim=-1
+            )
+        attention_mask = micro_batch["attention_mask"]
+        # The prompt during prefill, then one token per step
+        q_len = micro_batch["input_ids"].shape[1] if step == 0 else 1
+
+        if self.rank == self.first_rank:
+            if step == 0:
+                input_ids = micro_batch["input_ids"]
+                image_features = self._recv((batch_size, micro_batch["num_patches"], hidden_size), self.dtype, self.last_rank)
+            else:
+                input_ids = self._recv((batch_size,), torch.long, self.last_rank).unsqueeze(-1)
+                image_features = None
+            inputs_embeds = language_model.get_input_embeddings()(input_ids)
+            inputs_embeds, causal_mask, position_ids, sliding_mask = self.model._merge_input_ids_with_image_features(
+                image_features, inputs_embeds, input_ids, attention_mask, kv_cache
+            )
+            # [Batch_Size, Seq_Len, Hidden_Size]
+            hidden_states = inputs_embeds * torch.tensor(hidden_size**0.5, dtype=inputs_embeds.dtype)
+        else:
+            hidden_states = self._recv((batch_size, q_len, hidden_size), self.dtype, self.rank - 1)
+            causal_mask, position_ids, sliding_mask = self.model._attention_masks(
+                micro_batch["input_ids"] if step == 0 else None, attention_mask, q_len, self.dtype, hidden_states.device, kv_cache
+            )
+
+        hidden_states = language_model.model.forward_layers(hidden_states, causal_mask, position_ids, kv_cache, sliding_mask)
+
+        if self.rank != self.last_rank:
+            self._send(hidden_states, self.rank + 1)
+            return
+        if step == 0:
+            # Next token after the last non-padding token, works for left and right padding
+            last = attention_mask.cumsum(-1).argmax(-1)
+            hidden_states = hidden_states[torch.arange(batch_size), last]
+        else:
+            hidden_states = hidden_states[:, -1]
+        # Only the positions that predict the next token go through the lm_head
+        next_tokens = language_model.lm_head(language_model.model.norm(hidden_states)).float().argmax(-1)
+        micro_batch["generated"].append(next_tokens)
+        if step < max_new_tokens - 1:
+            self._send(next_tokens, self.first_rank)
+
+    @torch.no_grad()
+    def generate(self, micro_batches: Sequence[dict], max_new_tokens: int = 50) -> List[List[List[int]]]:
+        """
+        Greedy decoding of `micro_batches` ({"input_ids", "attention_mask", "pixel_values"} each), which every rank
+        is called with. All the micro-batches are in flight at once. With at least as many micro-batches as stages,
+        no stage waits once the pipeline is full. Every sequence gets exactly `max_new_tokens` tokens: unlike
+        inference.generate, finished rows can't leave a micro-batch that is spread over all the stages, truncate
+        after the eos token. Returns the generated token ids of every micro-batch on every rank.
+        """
+        start = time.perf_counter()
+        wait_before = self.wait_seconds
+        states = [
+            {
+                "input_ids": micro_batch["input_ids"],
+                "attention_mask": micro_batch["attention_mask"],
+                "pixel_values": micro_batch["pixel_values"],
+                # Local to this stage, it only holds this stage's layers
+                "kv_cache": self._make_kv_cache(),
+                "generated": [],
+            }
+            for micro_batch in micro_batches
+        ]
+
+        # The vision layers of all the micro-batches first, so the first stage is already embedding the next
+        # images while the other stages encode the previous ones
+        for state in states:
+            self._vision_step(state)
+        for step in range(max_new_tokens):
+            for state in states:
+                self._text_step(state, step, max_new_tokens)
+
+        wait_start = time.perf_counter()
+        for work, _ in self.pending_sends:
+            work.wait()
+        self.pending_sends = []
+        self.wait_seconds += time.perf_counter() - wait_start
+        wall_seconds = time.perf_counter() - start
+        self.wall_seconds += wall_seconds
+        self.busy_seconds += wall_seconds - (self.wait_seconds - wait_before)
+
+        # Only the last rank has the generated tokens
+        generated = [[tokens.tolist() for tokens in torch.stack(state["generated"], dim=-1)] if state["generated"] else None
+                     for state in states]
+        objects = [generated]
+        dist.broadcast_object_list(objects, src=self.last_rank)
+        return objects[0]
+
+    def stats(self) -> List[dict]:
+        """Busy (computing) and waiting seconds of every stage over all generate() calls, on every rank."""
+        stats = {
+            "rank": self.rank,
+            "vision_layers": len(self.model.vision_tower.vision_model.encoder.layers),
+            "text_layers": len(self.model.language_model.model.layers),
+            "busy_seconds": self.busy_seconds,
+            "wait_seconds": self.wait_seconds,
+            "utilization": self.busy_seconds / self.wall_seconds if self.wall_seconds > 0 else 0.0,
+        }
+        all_stats = [None] * self.world_size
+        dist.all_gather_object(all_stats, stats)
+        return all_stats
+
+
+def _stage_worker(rank, world_size, master_addr, master_port, cores, fn, args):
+    if cores is not None:
+        pin_to_cores(cores[rank])
+    dist.init_process_group("gloo", init_method=f"tcp://{master_addr}:{master_port}", rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn: Callable, world_size: int, *args, master_addr: str = "127.0.0.1", master_port: int = 29500,
+           pin_cores: bool = True):
+    """
+    Run `fn(rank, world_size, *args)` in `world_size` local processes joined in a gloo process group. With enough
+    cores every process is pinned to its own contiguous range. On several hosts, init the gloo process group on
+    every rank yourself (e.g. under torchrun) and build a PipelineStage there.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    per_rank = len(cores) // world_size
+    rank_cores = [cores[rank * per_rank:(rank + 1) * per_rank] for rank in range(world_size)] if pin_cores and per_rank > 0 else None
+    mp.spawn(_stage_worker, args=(world_size, master_addr, master_port, rank_cores, fn, args), nprocs=world_size)
@@ -0,0 +1,206 @@
+import os
+import queue
+import threading
+import traceback
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+import torch
+import torch.multiprocessing as mp
+
+from inference import generate
+
+# Queue markers: END closes a generate() call, STOP shuts the vision process down
+END = "end"
+STOP = None
+# How often blocked queue operations check whether the vision process is still alive
+POLL_SECONDS = 0.1
+
+
+def split_cores(cores: Optional[Sequence[int]] = None, vision_fraction: float = 0.5):
+    """Split the cores this process may run on into (vision cores, language cores)."""
+    cores = sorted(os.sched_getaffinity(0) if cores is None else cores)
+    if len(cores) < 2:
+        # Nothing to split, both stages share the core
+        return cores, cores
+    num_vision = min(max(1, round(len(cores) * vision_fraction)), len(cores) - 1)
+    return cores[:num_vision], cores[num_vision:]
+
+
+def pin_to_cores(cores: Sequence[int]):
+    # Threads started afterwards (including torch's intra-op pool) inherit the affinity
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+@torch.no_grad()
+def vision_worker(vision_tower, multi_modal_projector, cores, pixel_queue, feature_queue):
+    """
+    Vision stage process: pixel_values from `pixel_queue` -> projected image features into `feature_queue`.
+    `feature_queue` is bounded, so the encoder blocks (backpressure) when the language stage falls behind.
+    """
+    pin_to_cores(cores)
+    try:
+        while True:
+            item = pixel_queue.get()
+            if item is STOP:
+                break
+            if item == END:
+                feature_queue.put(END)
+                continue
+            index, pixel_values = item
+            # [Batch_Size, Num_Patches, Projection_Dim]
+            image_features = multi_modal_projector(vision_tower(pixel_values))
+            feature_queue.put((index, image_features))
+    except Exception:
+        feature_queue.put((None, traceback.format_exc()))
+
+
+class PipelinedGenerator:
+    """
+    Two-stage inference on our PaliGemmaForConditionalGeneration: a separate process pinned to `vision_cores`
+    runs `vision_tower` + `multi_modal_projector` for the next batches while this process, pinned to
+    `language_cores`, decodes the current one with the `language_model` from the precomputed image features.
+
+    The weights are shared with the vision process through shared memory, not copied. At most `queue_size`
+    batches of image features wait between the stages. Use as a context manager, or call `close()`.
+    Once the vision stage fails, the generator is broken and every later generate() call raises.
+    """
+
+    def __init__(self, model, vision_cores: Optional[Sequence[int]] = None, language_cores: Optional[Sequence[int]] = None,
+                 queue_size: int = 2, start_method: str = "spawn"):
+        self.model = model.eval()
+        if vision_cores is None or language_cores is None:
+            vision_cores, language_cores = split_cores()
+        self.vision_cores, self.language_cores = list(vision_cores), list(language_cores)
+
+        context = mp.get_context(start_method)
+        self.pixel_queue = context.Queue(maxsize=queue_size)
+        self.feature_queue = context.Queue(maxsize=queue_size)
+        model.vision_tower.share_memory()
+        model.multi_modal_projector.share_memory()
+        self.process = context.Process(
+            target=vision_worker,
+            args=(model.vision_tower, model.multi_modal_projector, self.vision_cores, self.pixel_queue, self.feature_queue),
+            daemon=True,
+        )
+        self.process.start()
+        # Traceback of the vision stage once it failed
+        self.error = None
+        # Restored by close()
+        self.previous_cores, self.previous_num_threads = os.sched_getaffinity(0), torch.get_num_threads()
+        pin_to_cores(self.language_cores)
+
+    def generate(self, batches: Iterable[dict], max_new_tokens: int = 50,
+                 eos_token_id: Optional[int] = None) -> Iterator[List[List[int]]]:
+        """
+        `batches` of {"input_ids", "attention_mask", "pixel_values"}. Yields the generated token ids of every
+        batch, in order, as soon as it is decoded.
+        """
+        if self.error is not None:
+            raise RuntimeError(f"Vision stage failed in an earlier call:\n{self.error}")
+        batches = iter(batches)
+        pending = []
+        # Set when the caller stops iterating early, the feeder then stops sending this call's batches
+        stop = threading.Event()
+        feed_errors = []
+        # Feeds the vision stage from a thread, so putting on the bounded queue never blocks decoding
+        feeder = threading.Thread(target=self._feed, args=(batches, pending, stop, feed_errors), daemon=True)
+        feeder.start()
+
+        index = 0
+        # True once this call's END (or the vision stage's error) was read from feature_queue
+        finished = False
+        try:
+            while True:
+                item = self._get()
+                if item == END:
+                    finished = True
+                    break
+                item_index, image_features = item
+                if item_index is None:
+                    # The vision process is gone, nothing else comes
+                    finished = True
+                    self._broken(image_features)
+                    raise RuntimeError(f"Vision stage failed:\n{image_features}")
+                # Batches are encoded in order, one at a time
+                assert item_index == index
+                batch = pending[index]
+                pending[index] = None
+                yield generate(
+                    self.model, batch["input_ids"], batch["attention_mask"], image_features=image_features,
+                    max_new_tokens=max_new_tokens, eos_token_id=eos_token_id,
+                )
+                index += 1
+        finally:
+            stop.set()
+            # Drop the features of the batches already sent (break, close()), so they don't end up in the next call
+            while not finished:
+                item = self._get()
+                finished = item == END or item[0] is None
+                if item != END and item[0] is None:
+                    self._broken(item[1])
+            # Finishes once END is sent or the vision process is gone
+            feeder.join()
+        if feed_errors:
+            raise RuntimeError("Reading the batches failed") from feed_errors[0]
+
+    def _get(self):
+        # feature_queue.get() that doesn't wait forever on a vision process that died without posting its error
+        while True:
+            try:
+                return self.feature_queue.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return None, f"The vision process exited with code {self.process.exitcode}"
+
+    def _put(self, item, stop=None) -> bool:
+        # pixel_queue.put() that gives up once nobody will read it, or when `stop` is set. Returns whether it was put
+        while True:
+            try:
+                self.pixel_queue.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                if not self.process.is_alive() or (stop is not None and stop.is_set()):
+                    return False
+
+    def _broken(self, error):
+        self.error = error
+        # Items left on pixel_queue are never read, don't wait for them to be flushed at exit
+        self.pixel_queue.cancel_join_thread()
+
+    def _feed(self, batches, pending, stop, errors):
+        try:
+            for index, batch in enumerate(batches):
+                if stop.is_set():
+                    break
+                pending.append(batch)
+                if not self._put((index, batch["pixel_values"]), stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # Always closes the call, generate() reads up to it, unless the vision process is gone
+            self._put(END)
+
+    def close(self):
+        if self._put(STOP):
+            self.process.join()
+        os.sched_setaffinity(0, self.previous_cores)
+        torch.set_num_threads(self.previous_num_threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@torch.no_grad()
+def serial_generate(model, batches: Iterable[dict], max_new_tokens: int = 50,
+                    eos_token_id: Optional[int] = None) -> Iterator[List[List[int]]]:
+    """The unpipelined path: vision encoding and decoding of every batch one after the other."""
+    for batch in batches:
+        yield generate(
+            model, batch["input_ids"], batch["attention_mask"], pixel_values=batch["pixel_values"],
+            max_new_tokens=max_new_tokens, eos_token_id=eos_token_id,
+        )
@@ -1,6 +1,82 @@
+from typing import Optional
+
 import torch
 import torch.nn as nn
 
+
+def _rstd(x: torch.Tensor, eps: float) -> torch.Tensor:
+    # 1 / sqrt(mean(x^2) + eps) in (at least) float32, without a float32 copy of x. [..., 1]
+    dtype = torch.promote_types(x.dtype, torch.float32)
+    sum_of_squares = torch.linalg.vector_norm(x, dim=-1, keepdim=True, dtype=dtype).pow_(2)
+    return sum_of_squares.div_(x.shape[-1]).add_(eps).rsqrt_()
+
+
+def _rms_norm(x: torch.Tensor, weight: Optional[torch.Tensor], eps: float, unit_offset: bool) -> torch.Tensor:
+    # [..., Dim] float32
+    normed = x * _rstd(x, eps)
+    if unit_offset:
+        return normed.mul_(1.0 + weight.to(normed.dtype)).to(x.dtype)
+    output = normed.to(x.dtype)
+    if weight is not None:
+        output = output * weight
+    return output
+
+
+class RMSNormFunction(torch.autograd.Function):
+    """
+    RMSNorm with a hand-written backward. Only the input (in its own dtype) and the weight are saved, the
+    rstd is recomputed in backward, instead of the float32 copy of the input, its square and the normalized
+    activations autograd would keep.
+
+    unit_offset=False: x.float() normalized, cast to x's dtype, then multiplied by weight (like RMSNorm below).
+    unit_offset=True: Gemma's x.float() normalized times (1 + weight.float()), then cast to x's dtype.
+    float64 inputs are computed in float64.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, eps, unit_offset):
+        output = _rms_norm(x, weight, eps, unit_offset)
+        ctx.save_for_backward(x, weight)
+        ctx.eps = eps
+        ctx.unit_offset = unit_offset
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, weight = ctx.saved_tensors
+        rstd = _rstd(x, ctx.eps)
+        normed = x * rstd
+
+        grad_weight = None
+        if ctx.unit_offset:
+            grad_output = grad_output.to(normed.dtype)
+            if ctx.needs_input_grad[1]:
+                grad_weight = (grad_output * normed).reshape(-1, x.shape[-1]).sum(0).to(weight.dtype)
+            grad_normed = grad_output * (1.0 + weight.to(normed.dtype))
+        elif weight is not None:
+            if ctx.needs_input_grad[1]:
+                grad_weight = (grad_output * normed.to(x.dtype)).reshape(-1, x.shape[-1]).sum(0).to(weight.dtype)
+            # Same casts as autograd through the type_as
+            grad_normed = (grad_output * weight).to(x.dtype).to(normed.dtype)
+        else:
+            grad_normed = grad_output.to(normed.dtype)
+
+        grad_x = None
+        if ctx.needs_input_grad[0]:
+            # d/dx (x * rstd) = rstd * (g - normed * mean(g * normed))
+            projection = (grad_normed * normed).mean(-1, keepdim=True)
+            grad_x = torch.sub(grad_normed, normed.mul_(projection)).mul_(rstd).to(x.dtype)
+        return grad_x, grad_weight, None, None
+
+
+def rms_norm(x: torch.Tensor, weight: Optional[torch.Tensor] = None, eps: float = 1e-6, unit_offset: bool = False) -> torch.Tensor:
+    # torch.compiler.is_exporting is missing before torch 2.4 (requirements.txt pins 2.3.0)
+    if torch.jit.is_tracing() or getattr(torch.compiler, "is_exporting", lambda: False)():
+        # Exported graphs can't hold a Python autograd.Function, the same ops without the custom backward (see export.py)
+        return _rms_norm(x, weight, eps, unit_offset)
+    return RMSNormFunction.apply(x, weight, eps, unit_offset)
+
+
 class RMSNorm(nn.Module):
     def __init__(self, dim: int, eps: float = 1e-6, elementwise_affine=True, memory_efficient=False):
         super().__init__()
@@ -16,10 +92,8 @@ class RMSNorm(nn.Module):
         return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
 
     def forward(self, x):
-        output = self._norm(x.float()).type_as(x)
-        if self.weight is not None:
-            output = output * self.weight
-        return output
+        # Same result as self._norm(x.float()).type_as(x) * self.weight, see RMSNormFunction
+        return rms_norm(x, self.weight, self.eps)
 
     def extra_repr(self) -> str:
-        return f'dim={self.dim}, eps={self.eps}, elementwise_affine={self.elementwise_affine}'
\ No newline at end of file
+        return f'dim={self.dim}, eps={self.eps}, elementwise_affine={self.elementwise_affine}'
@@ -0,0 +1,120 @@
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+from modeling_gemma import GemmaAttention, GemmaMLP
+
+
+class RowParallelLinear(nn.Linear):
+    """
+    nn.Linear holding a slice of the input features (the output of a column-split layer on this rank). The partial
+    outputs of all the ranks are summed with an all-reduce, the bias is added once after it. Inference only.
+    """
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        output = nn.functional.linear(x, self.weight)
+        if torch.is_grad_enabled() and output.requires_grad:
+            raise RuntimeError("Tensor-parallel layers are inference only, run them under torch.no_grad()")
+        dist.all_reduce(output)
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+
+def _shard_linear(linear: nn.Linear, dim: int, start: int, length: int, cls=nn.Linear) -> nn.Linear:
+    """
+    A `cls` with `length` of the output features (dim 0, column split) or of the input features (dim 1, row split)
+    of `linear`, from `start`. `shards` records the slices, so load_sharded_state_dict can cut full checkpoints.
+    Works on the meta device too.
+    """
+    in_features, out_features = (length, linear.out_features) if dim == 1 else (linear.in_features, length)
+    with torch.device("meta"):
+        sharded = cls(in_features, out_features, bias=linear.bias is not None)
+    sharded.weight = nn.Parameter(linear.weight.narrow(dim, start, length).clone(), requires_grad=linear.weight.requires_grad)
+    sharded.shards = {"weight": (dim, start, length)}
+    if linear.bias is not None:
+        # Only the output features are split in the bias
+        bias = linear.bias.narrow(0, start, length) if dim == 0 else linear.bias
+        sharded.bias = nn.Parameter(bias.clone(), requires_grad=linear.bias.requires_grad)
+        if dim == 0:
+            sharded.shards["bias"] = (0, start, length)
+    return sharded
+
+
+def shard_mlp(mlp: GemmaMLP, rank: int, world_size: int):
+    # Column-split gate_proj and up_proj, row-split down_proj: gelu(gate) * up is elementwise, so each rank
+    # computes its slice of the intermediate activations and one all-reduce sums the down projections
+    if mlp.intermediate_size % world_size != 0:
+        raise ValueError(f"intermediate_size {mlp.intermediate_size} is not divisible by {world_size} ranks")
+    local_size = mlp.intermediate_size // world_size
+    start = rank * local_size
+    mlp.gate_proj = _shard_linear(mlp.gate_proj, 0, start, local_size)
+    mlp.up_proj = _shard_linear(mlp.up_proj, 0, start, local_size)
+    mlp.down_proj = _shard_linear(mlp.down_proj, 1, start, local_size, RowParallelLinear)
+    mlp.intermediate_size = local_size
+
+
+def shard_attention(attention: GemmaAttention, rank: int, world_size: int):
+    # Each rank gets a contiguous range of query heads and the KV heads they read (replicated when there are fewer
+    # KV heads than ranks, e.g. the single KV head of MQA). The lambdas and the subln are per layer and stay
+    # replicated, o_proj is row-split and all-reduced
+    num_heads, num_groups, head_dim = attention.num_heads, attention.num_key_value_groups, attention.head_dim
+    if num_heads % world_size != 0:
+        raise ValueError(f"num_attention_heads {num_heads} is not divisible by {world_size} ranks")
+    local_heads = num_heads // world_size
+    if local_heads % num_groups != 0 and num_groups % local_heads != 0:
+        raise ValueError(f"{local_heads} query heads per rank would split the {num_groups} query heads of a KV head")
+    first_head = rank * local_heads
+    first_kv_head, local_kv_heads = first_head // num_groups, max(1, local_heads // num_groups)
+
+    attention.q_proj = _shard_linear(attention.q_proj, 0, first_head * head_dim, local_heads * head_dim)
+    attention.k_proj = _shard_linear(attention.k_proj, 0, first_kv_head * head_dim, local_kv_heads * head_dim)
+    attention.v_proj = _shard_linear(attention.v_proj, 0, first_kv_head * head_dim, local_kv_heads * head_dim)
+    attention.o_proj = _shard_linear(attention.o_proj, 1, first_head * head_dim, local_heads * head_dim, RowParallelLinear)
+    attention.num_heads, attention.num_key_value_heads = local_heads, local_kv_heads
+    attention.num_key_value_groups = local_heads // local_kv_heads
+
+
+def shard_model(model, rank: Optional[int] = None, world_size: Optional[int] = None):
+    """
+    Tensor parallelism for every GemmaMLP and GemmaAttention of our PaliGemmaForConditionalGeneration (or any module
+    containing them), in place. Everything else (embeddings, norms, the vision tower, the lm_head) stays replicated,
+    so every rank of the gloo process group runs the same code on the same inputs, e.g. inference.generate, and gets
+    the same tokens. Works on a meta-device model, then load the weights with load_sharded_state_dict.
+    """
+    rank = dist.get_rank() if rank is None else rank
+    world_size = dist.get_world_size() if world_size is None else world_size
+    for module in model.modules():
+        if isinstance(module, GemmaMLP):
+            shard_mlp(module, rank, world_size)
+        elif isinstance(module, GemmaAttention):
+            shard_attention(module, rank, world_size)
+    return model
+
+
+def load_sharded_state_dict(model, state_dict: dict):
+    """
+    Point the parameters and buffers of a sharded `model` at this rank's slices of the full, unsharded `state_dict`.
+    With a memory-mapped state dict (torch.load(mmap=True)) the column slices stay views of the mapped file and only
+    the row slices are copied, so a rank never materializes the other ranks' weights.
+    """
+    tensors = list(model.named_parameters(remove_duplicate=False)) + list(model.named_buffers(remove_duplicate=False))
+    for name, _ in tensors:
+        if name not in state_dict:
+            # e.g. non-persistent buffers, which keep the value the model was built with
+            continue
+        module_name, _, tensor_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        tensor = state_dict[name]
+        if tensor_name in getattr(module, "shards", {}):
+            dim, start, length = module.shards[tensor_name]
+            tensor = tensor.narrow(dim, start, length).contiguous()
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[tensor_name] = tensor
+    if hasattr(model, "tie_weights"):
+        model.tie_weights()
+    return model.eval()
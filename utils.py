@@ -1,13 +1,16 @@
-from modeling_gemma import PaliGemmaForConditionalGeneration, PaliGemmaConfig
-from transformers import AutoTokenizer
+from modeling_gemma import PaliGemmaForConditionalGeneration, PaliGemmaConfig, no_init_weights, init_missing_weights
 import json
 import glob
 from safetensors import safe_open
-from typing import Tuple
+from typing import TYPE_CHECKING, Tuple
 import os
 
-def load_hf_model(model_path: str, device: str) -> Tuple[PaliGemmaForConditionalGeneration, AutoTokenizer]:
-    # Load the tokenizer
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+def load_hf_model(model_path: str, device: str) -> Tuple[PaliGemmaForConditionalGeneration, "AutoTokenizer"]:
+    # Load the tokenizer, AutoTokenizer is imported here since it pulls in the tokenizers of every model
+    from transformers import AutoTokenizer
     tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side="right")
     assert tokenizer.padding_side == "right"
 
@@ -26,13 +29,43 @@ def load_hf_model(model_path: str, device: str) -> Tuple[PaliGemmaForConditional
         model_config_file = json.load(f)
         config = PaliGemmaConfig(**model_config_file)
 
-    # Create the model using the configuration
-    model = PaliGemmaForConditionalGeneration(config).to(device)
+    # Create the model using the configuration, without a random init: the checkpoint overwrites it
+    with no_init_weights():
+        model = PaliGemmaForConditionalGeneration(config).to(device)
 
-    # Load the state dict of the model
-    model.load_state_dict(tensors, strict=False)
+    # Load the state dict of the model, the weights the checkpoint doesn't have (e.g. the subln of the
+    # differential attention) get the init they would have had
+    missing_keys = model.load_state_dict(tensors, strict=False).missing_keys
+    init_missing_weights(model, missing_keys)
 
     # Tie weights
     model.tie_weights()
 
-    return (model, tokenizer)
\ No newline at end of file
+    return (model, tokenizer)
+
+def build_prompt_strings(processor, texts, suffix=None, image_seq_len=None):
+    # Same prompt layout as PaliGemmaProcessor: <image> * image_seq_len + <bos> + prompt + "\n" (+ suffix + <eos>)
+    tokenizer = processor.tokenizer
+    if image_seq_len is None:
+        image_seq_len = processor.image_seq_length
+    input_strings = [f"{'<image>' * image_seq_len}{tokenizer.bos_token}{text}\n" for text in texts]
+    if suffix is not None:
+        suffix = [sfx + tokenizer.eos_token for sfx in suffix]
+    return input_strings, suffix
+
+
+def tokenize_prompts(processor, texts, suffix=None, padding="longest", image_seq_len=None):
+    # Tokenize like PaliGemmaProcessor, but without loading or preprocessing any images
+    input_strings, suffix = build_prompt_strings(processor, texts, suffix=suffix, image_seq_len=image_seq_len)
+    inputs = processor.tokenizer(
+        input_strings,
+        text_pair=suffix,
+        return_tensors="pt",
+        padding=padding,
+        return_token_type_ids=suffix is not None,
+    )
+    inputs = dict(inputs)
+    if suffix is not None:
+        # Only the suffix (the answer) is supervised
+        inputs["labels"] = inputs["input_ids"].masked_fill(inputs["token_type_ids"] == 0, -100)
+    return inputs
@@ -0,0 +1,120 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import torch
+
+
+class VisionBatcher:
+    """
+    asyncio micro-batcher in front of the vision tower + projector of our PaliGemmaForConditionalGeneration.
+    Concurrent `encode(pixel_values)` calls are collected until `max_batch_size` images are waiting, or until
+    the oldest one has waited `max_wait_ms`. They are then encoded in one batch on a worker thread (the event loop
+    keeps accepting requests meanwhile) and every caller gets its own image features back.
+
+    Use as an async context manager, or call `start()` and `close()`.
+    """
+
+    def __init__(self, model, max_batch_size: int = 8, max_wait_ms: float = 5.0):
+        self.vision_tower = model.vision_tower
+        self.multi_modal_projector = model.multi_modal_projector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # (pixel_values, future, arrival time) of the requests not encoded yet
+        self.pending = []
+        # Futures of the batch being encoded, already taken out of `pending`
+        self.in_flight = []
+        self.arrived = None
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Sizes of the batches encoded so far
+        self.batch_sizes: List[int] = []
+
+    async def start(self):
+        self.arrived = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for _, future, _ in self.pending:
+            future.cancel()
+        for future in self.in_flight:
+            future.cancel()
+        self.pending, self.in_flight = [], []
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def encode(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """[Channels, Height, Width] -> image features [Num_Patches, Hidden_Size]"""
+        if self.task is None:
+            raise RuntimeError("VisionBatcher is not running, call start() or use it as an async context manager")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((pixel_values, future, loop.time()))
+        self.arrived.set()
+        return await future
+
+    @torch.no_grad()
+    def _encode(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        # [Batch_Size, Channels, Height, Width] -> [Batch_Size, Num_Patches, Hidden_Size]
+        return self.multi_modal_projector(self.vision_tower(pixel_values))
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        while not self.pending:
+            self.arrived.clear()
+            await self.arrived.wait()
+        # The deadline of the oldest request, requests that queued up during the previous batch go right away
+        deadline = self.pending[0][2] + self.max_wait
+        while len(self.pending) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+        # Callers that gave up don't need their images encoded
+        return [(pixel_values, future) for pixel_values, future, _ in batch if not future.cancelled()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.in_flight = [future for _, future in batch]
+            # Images of different resolutions can't be stacked, one encode per resolution
+            by_shape = {}
+            for pixel_values, future in batch:
+                by_shape.setdefault(tuple(pixel_values.shape), []).append((pixel_values, future))
+            for requests in by_shape.values():
+                self.batch_sizes.append(len(requests))
+                try:
+                    features = await loop.run_in_executor(
+                        self.executor, self._encode, torch.stack([pixel_values for pixel_values, _ in requests])
+                    )
+                except Exception as error:
+                    for _, future in requests:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                for (_, future), image_features in zip(requests, features):
+                    if not future.done():
+                        future.set_result(image_features)
+            self.in_flight = []
+
+    def mean_batch_size(self) -> Optional[float]:
+        return sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None